@@ -1,4 +1,18 @@
 #/usr/bin/env python3
-"""Module Init"""
-import core.prism, core.prism_era5_gfs
+"""
+Module Init
 
+Prism variants are imported lazily on first attribute access,
+e.g. core.prism_era5_gfs does not load core.prism.
+"""
+import importlib
+
+_SUBMODULES=('prism', 'prism_era5_gfs')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('core.'+name)
+    raise AttributeError("module 'core' has no attribute '%s'" % name)
+
+def __dir__():
+    return sorted(list(globals())+list(_SUBMODULES))
@@ -16,11 +16,10 @@ import sys, os
 import json, datetime
 
 from utils import utils
-import minisom
-import pickle
+import lib.hist_store, lib.analog, lib.som_trainer, lib.regridder
+import pickle, shutil
 
-# calculate metrics
-import sklearn.metrics as skm
+# minisom and sklearn are imported lazily in train() and evaluate()
 
 CWD=sys.path[0]
 print_prefix='core.prism_era5_gfs>>'
@@ -36,6 +35,7 @@ class Prism:
     Methods
     -----------
     train(), train the model by historical WRF data
+    update(), fine-tune the archived model on newly arriving records
     cast(), cast on real-time data 
     evaluate(), evaluate the model performance by several metrics
 
@@ -54,14 +54,20 @@ class Prism:
 
         self.lat, self.lon=era_hdl.lat, era_hdl.lon
         
-        # self.data(recl, nvar, nrow*ncol)
-        self.data=np.empty([self.nrec,self.nvar,nrow*ncol])
+        # adopt the loader buffer without copy and release the mesh reference
+        # self.data(recl, nvar*nrow*ncol=ngrids)            
+        self.data=era_hdl.data
+        era_hdl.data=None
+        
+        # flat normalization statistics, None for original
+        self.mean, self.std=None, None
+        
+        # minisom loops, or compiled (numba) / numpy kernels
+        self.kernel_backend=cfg_hdl['SHARE'].get('kernel_backend', fallback='minisom')
+        if self.kernel_backend!='minisom':
+            self.kernel_backend=lib.som_kernels.get_backend(self.kernel_backend)
 
         if call_from=='trainning':
-            for idx, var in enumerate(varlist):
-                raw_data=era_hdl.data_dic[var].values.reshape((self.nrec,-1))
-                self.data[:,idx,:]=raw_data
-                
             self.preprocess=cfg_hdl['TRAINING']['preprocess_method']
             self.n_nodex=int(cfg_hdl['TRAINING']['n_nodex'])
             self.n_nodey=int(cfg_hdl['TRAINING']['n_nodey'])
@@ -69,15 +75,58 @@ class Prism:
             self.lrate=float(cfg_hdl['TRAINING']['learning_rate'])
             self.iterations=int(cfg_hdl['TRAINING']['iterations'])
             self.nb_func=cfg_hdl['TRAINING']['nb_func']
+            # truncate neighbourhood at nb_cutoff*sigma, 0 for the full map
+            self.nb_cutoff=float(cfg_hdl['TRAINING'].get('nb_cutoff', fallback='0'))
+            
+            # online (MiniSom) or data-parallel batch training
+            self.train_mode=cfg_hdl['TRAINING'].get('train_mode', fallback='online')
+            self.train_nworkers=int(cfg_hdl['TRAINING'].get('train_nworkers', fallback='4'))
+            self.batch_epochs=int(cfg_hdl['TRAINING'].get('batch_epochs', fallback='20'))
+
+            # convergence-based early stopping, iterations as the budget
+            self.early_stop=cfg_hdl['TRAINING'].getboolean('early_stop', fallback=False)
+            self.es_segment=int(cfg_hdl['TRAINING'].get('es_segment', fallback='1000'))
+            self.es_tol=float(cfg_hdl['TRAINING'].get('es_tol', fallback='0.001'))
+            self.es_patience=int(cfg_hdl['TRAINING'].get('es_patience', fallback='2'))
+            self.es_holdout=float(cfg_hdl['TRAINING'].get('es_holdout', fallback='0.1'))
+            
+            # history store options
+            self.hist_dtype=cfg_hdl['TRAINING'].get('hist_dtype', fallback='float32')
+            self.hist_chunk=int(cfg_hdl['TRAINING'].get('hist_chunk', fallback='256'))
+            self.hist_complevel=int(cfg_hdl['TRAINING'].get('hist_complevel', fallback='4'))
+
+            # records per normalization chunk, silhouette subsample (0 for all)
+            self.norm_chunk=int(cfg_hdl['TRAINING'].get('norm_chunk', fallback='1024'))
+            self.eval_sample=int(cfg_hdl['TRAINING'].get('eval_sample', fallback='0'))
 
             if self.preprocess == 'temporal_norm':
-                self.data, self.mean, self.std=utils.get_std_dim0(self.data)
+                self.data, self.mean, self.std=utils.get_std_dim0(self.data, chunk=self.norm_chunk)
+            
+            # records behind the model and its statistics
+            self.nsamples=self.nrec
  
-        elif call_from=='inference':
+        elif call_from=='update':
+            db_in=xr.load_dataset(CWD+'/db/som_cluster_era5.nc')
+
+            self.preprocess=db_in.attrs['preprocess_method']
+            self.nb_func=db_in.attrs['neighbourhood_function']
+            self.n_nodex=db_in.sizes['n_nodex']
+            self.n_nodey=db_in.sizes['n_nodey']
             
-            # rename handler
-            gfs_hdl=era_hdl
+            # models archived before updates existed, count training records
+            self.nsamples=int(db_in.attrs.get('nsamples', len(
+                pd.read_csv(CWD+'/db/train_cluster_era5.csv', index_col=0))))
+            
+            # small learning rate and sigma to fine-tune the codebook
+            self.sigma=float(cfg_hdl['UPDATE'].get('sigma', fallback='0.01'))
+            self.lrate=float(cfg_hdl['UPDATE'].get('learning_rate', fallback='0.001'))
+            self.iterations=int(cfg_hdl['UPDATE'].get('iterations', fallback='1000'))
 
+            if self.preprocess == 'temporal_norm':
+                self.mean=db_in['mean'].values.reshape(-1)
+                self.std=db_in['std'].values.reshape(-1)
+ 
+        elif call_from=='inference':
             db_in=xr.load_dataset(CWD+'/db/som_cluster_era5.nc')            
             
             self.preprocess=db_in.attrs['preprocess_method']
@@ -86,33 +135,28 @@ class Prism:
             self.n_nodey=db_in.dims['n_nodey']
             self.resamp_frq=cfg_hdl['INFERENCE']['resamp_freq']
             self.match_hist=cfg_hdl['INFERENCE'].getboolean('match_hist')
+
+            # GFS on another grid than the training one
+            self._to_model_grid(db_in['lat'].values, db_in['lon'].values, cfg_hdl)
     
             if self.match_hist:
-                utils.write_log(print_prefix+'load history vectors...')
-                self.hist_data=db_in['var_vector']
-                self.hist_dateseries=db_in['ntimes']
+                # history store, opened only while matching
+                self.hist_fn=CWD+'/db/som_hist_era5.nc'
+                # top-k analogs, within +/-match_window_days (-1 for all)
+                # and/or restricted to the same SOM node as the query
+                self.match_topk=int(cfg_hdl['INFERENCE'].get('match_topk', fallback='1'))
+                self.match_window=int(cfg_hdl['INFERENCE'].get('match_window_days', fallback='-1'))
+                self.match_same_node=cfg_hdl['INFERENCE'].getboolean('match_same_node', fallback=False)
+                # brute: scan candidates; node: exact node-partitioned search
+                self.match_method=cfg_hdl['INFERENCE'].get('match_method', fallback='node')
 
-            # dispatch era_hdl.data
-            for idx, var in enumerate(varlist):
-                
-                raw_values=gfs_hdl.data_dic[var].values
-                
-                # note here use [::-1] to reverse lat in gfs data
-                raw_data=raw_values[:,::-1,:].reshape((self.nrec,-1))
-                
-                # self.data(recl, nvar, nrow*ncol)
-                self.data[:,idx,:]=raw_data
- 
             if self.preprocess == 'temporal_norm':
-                mean, std = db_in['mean'].values, db_in['std'].values
-                mean = mean.reshape(self.nvar,-1)
-                std = std.reshape(self.nvar,-1)
+                mean=self.mean=db_in['mean'].values.reshape(-1)
+                std=self.std=db_in['std'].values.reshape(-1)
 
+                # normalize in place
                 for ii in range(0, self.nrec):
-                    self.data[ii,:,:]=(self.data[ii,:,:]-mean)/std
-
-        # self.data(recl, nvar*nrow*ncol=ngrids)            
-        self.data=self.data.reshape((self.nrec,-1))
+                    self.data[ii,:]=(self.data[ii,:]-mean)/std
 
     def train(self, train_data=None, verbose=True):
         """ train the prism classifier """
@@ -122,6 +166,8 @@ class Prism:
         if train_data is None:
             train_data = self.data
         
+        import minisom
+        
         # init som
         som = minisom.MiniSom(
                 self.n_nodex, self.n_nodey, self.nvar*self.nfea, 
@@ -129,12 +175,72 @@ class Prism:
                 learning_rate=self.lrate) 
         
         # train som
-        som.train(train_data, self.iterations, verbose=verbose) 
-
-        self.q_err=som.quantization_error(train_data)
+        if self.train_mode=='batch':
+            som.random_weights_init(train_data)
+            self.iterations_used, self.convergence=lib.som_trainer.train_batch(
+                    som, train_data, self.batch_epochs, 
+                    nworkers=self.train_nworkers, 
+                    tol=self.es_tol if self.early_stop else None,
+                    patience=self.es_patience, nb_cutoff=self.nb_cutoff, 
+                    verbose=verbose)
+        elif self.early_stop or self.nb_cutoff > 0 or self.kernel_backend!='minisom':
+            train_idx, monitor_idx=None, None
+            if self.early_stop:
+                train_idx, monitor_idx=lib.som_trainer.split_holdout(
+                        train_data.shape[0], self.es_holdout)
+            self.iterations_used, self.convergence=lib.som_trainer.train_online(
+                    som, train_data, self.iterations, 
+                    train_idx=train_idx, monitor_idx=monitor_idx,
+                    segment=self.es_segment if self.early_stop else self.iterations, 
+                    tol=self.es_tol if self.early_stop else None, 
+                    patience=self.es_patience, nb_cutoff=self.nb_cutoff, 
+                    backend=self.kernel_backend, verbose=verbose)
+        else:
+            som.train(train_data, self.iterations, verbose=verbose) 
+            self.iterations_used, self.convergence=self.iterations, []
 
-        self.winners=[som.winner(x) for x in train_data]
         self.som=som
+        self.winners, self.q_err=self._bmu(train_data)
+
+    def update(self):
+        """ fine-tune the archived som on the new records """
+        utils.write_log(print_prefix+'updating on %d new records...' % self.nrec)
+        self.load()
+
+        # new records must be later than the archived ones
+        last_ts=pd.read_csv(
+                CWD+'/db/train_cluster_era5.csv', index_col=0, parse_dates=True).index[-1]
+        if self.dateseries[0] <= last_ts:
+            utils.throw_error(print_prefix, 
+                    'new records start at %s, not after the archived %s' % (
+                        self.dateseries[0], last_ts))
+
+        if self.preprocess == 'temporal_norm':
+            mean0, std0=self.mean, self.std
+            self.data, self.mean, self.std=utils.update_std_dim0(
+                    self.data, mean0, std0, self.nsamples)
+            
+            # re-express the codebook in the updated statistics
+            weights=self.som._weights.reshape(self.n_nodex*self.n_nodey, -1)
+            weights*=std0
+            weights+=mean0-self.mean
+            weights/=self.std
+        
+        self.nsamples+=self.nrec
+
+        # continue from the archived codebook with small sigma/lrate
+        self.som._sigma=self.sigma
+        self.som._learning_rate=self.lrate
+        if self.kernel_backend!='minisom':
+            lib.som_trainer.train_online(
+                    self.som, self.data, self.iterations, segment=self.iterations,
+                    backend=self.kernel_backend)
+        else:
+            self.som.train(self.data, self.iterations)
+        
+        self.winners, self.q_err=self._bmu(self.data)
+        
+        utils.write_log(print_prefix+'quantization error on new records: %.4f' % self.q_err)
         
     def cast(self):
         """ cast the prism on new synoptic maps """
@@ -144,19 +250,21 @@ class Prism:
         data_list=[]
         
         # match clusters 
-        winners=[self.som.winner(x) for x in self.data]
+        winners, _=self._bmu(self.data, q_err=False)
         
         # match historical data
         if self.match_hist:
-            self._match_hist()
+            self._match_hist([winner[0]*self.n_nodey+winner[1] for winner in winners])
             
-            for datestamp, winner in zip(self.match_ts, winners):
+            for match_ts, winner in zip(self.match_ts, winners):
                 data_list.append(
                         ['('+str(winner[0])+','+str(winner[1])+')', 
-                        winner[0]*self.n_nodey+winner[1],datestamp])
+                        winner[0]*self.n_nodey+winner[1]]+match_ts)
             
+            match_cols=['best_match']+[
+                    'best_match_%d' % (ii+1) for ii in range(1, self.match_topk)]
             df_out = pd.DataFrame(
-                    data_list, columns=['type2d_cor', 'type_id', 'best_match'],
+                    data_list, columns=['type2d_cor', 'type_id']+match_cols,
                     index=self.dateseries)
         else:
             for winner in winners:
@@ -181,13 +289,20 @@ class Prism:
         if verbose: 
             utils.write_log(print_prefix+'prism evaluates...')
         
+        # calculate metrics
+        import sklearn.metrics as skm
+        
         if train_data is None:
             train_data = self.data
         
-        edic={'quatization_error':self.q_err}
+        edic={'quatization_error':self.q_err, 
+                'iterations_used':self.iterations_used,
+                'convergence':self.convergence}
         
         label=[str(winner[0])+str(winner[1]) for winner in self.winners]
-        s_score=skm.silhouette_score(train_data, label, metric='euclidean')
+        sample_size=self.eval_sample if 0 < self.eval_sample < len(label) else None
+        s_score=skm.silhouette_score(train_data, label, metric='euclidean', 
+                sample_size=sample_size, random_state=0)
         
         edic.update({'silhouette_score':s_score})
         
@@ -225,8 +340,9 @@ class Prism:
 
         df_out.to_csv(CWD+'/db/train_cluster_era5.csv')
 
-        # archive classification result in netcdf
-        centroid=self.som.get_weights()
+        # archive classification result in netcdf,
+        # copy to keep the som weights normalized 
+        centroid=self.som.get_weights().copy()
         centroid=centroid.reshape(
                 self.n_nodex, self.n_nodey, self.nvar, self.nrow, self.ncol)
         
@@ -234,25 +350,127 @@ class Prism:
         out_fn=CWD+'/db/som_cluster_era5.nc'
         ds_out.to_netcdf(out_fn)
         
+        # archive training vectors in the history store
+        hist_fn=CWD+'/db/som_hist_era5.nc'
+        lib.hist_store.write_hist(
+                hist_fn, self.data, self.dateseries, 
+                dtype=self.hist_dtype, chunk=self.hist_chunk, 
+                complevel=self.hist_complevel, mean=self.mean, std=self.std)
+        
+        # per-calendar-day and per-node candidate indexes, records 
+        # in each node sorted by distance to the node centroid
+        nnodes=self.n_nodex*self.n_nodey
+        type_ids=[winner[0]*self.n_nodey+winner[1] for winner in self.winners]
+        with lib.hist_store.open_hist(hist_fn) as hist_ds:
+            index=lib.analog.build_index(
+                    self.dateseries, type_ids, nnodes, hist_ds=hist_ds, 
+                    centroids=self.som.get_weights().reshape(nnodes,-1))
+        lib.hist_store.append_index(hist_fn, index)
+        
         utils.write_log(print_prefix+'prism construction is completed!')
 
+    def archive_update(self):
+        """ 
+        archive the updated classifier, append new records to the database,
+        all artifacts are written to temporary files and replaced together
+        once every write succeeds, so a failed update leaves the db intact
+        """
+
+        utils.write_log(print_prefix+'prism archives update...')
+        
+        db_dir=CWD+'/db/'
+        edic_fn, som_fn=db_dir+'edic_era5.json', db_dir+'som_era5.archive'
+        train_fn, hist_fn=db_dir+'train_cluster_era5.csv', db_dir+'som_hist_era5.nc'
+        cluster_fn=db_dir+'som_cluster_era5.nc'
+        nnodes=self.n_nodex*self.n_nodey
+        
+        # validate before touching anything
+        if len(self.winners)!=len(self.dateseries):
+            utils.throw_error(print_prefix, '%d winners for %d records' % (
+                len(self.winners), len(self.dateseries)))
+        with lib.hist_store.open_hist(hist_fn) as hist_ds:
+            hist_arr=lib.hist_store.to_hist_frame(
+                    self.data, self.mean, self.std, hist_ds)
+        lib.hist_store.check_append(hist_fn, hist_arr, self.dateseries)
+        
+        tmp={fn:fn+'.tmp' for fn in (edic_fn, som_fn, train_fn, hist_fn, cluster_fn)}
+        try:
+            # keep the evaluation dict of the build, log each update
+            with open(edic_fn) as f:
+                edic=json.load(f)
+            edic.setdefault('updates', []).append({
+                'start':str(self.dateseries[0]), 'end':str(self.dateseries[-1]),
+                'nrec':self.nrec, 'quatization_error':self.q_err})
+            with open(tmp[edic_fn], 'w') as f:
+                json.dump(edic,f)
+
+            # archive model
+            with open(tmp[som_fn], 'wb') as outfile:
+                pickle.dump(self.som, outfile)
+
+            # append classification result in csv
+            data_list=[]
+            for winner in self.winners:
+                data_list.append(
+                        ['('+str(winner[0])+','+str(winner[1])+')', 
+                        winner[0]*self.n_nodey+winner[1]])
+            
+            df_out = pd.DataFrame(
+                    data_list, columns=['type2d_cor', 'type_id'],
+                    index=self.dateseries)
+            shutil.copyfile(train_fn, tmp[train_fn])
+            df_out.to_csv(tmp[train_fn], mode='a', header=False)
+
+            # append new records in the frame of the history store,
+            # archived records keep their node assignments
+            shutil.copyfile(hist_fn, tmp[hist_fn])
+            lib.hist_store.append_hist(tmp[hist_fn], hist_arr, self.dateseries)
+            
+            # rebuild candidate indexes over the whole store
+            type_ids=pd.read_csv(tmp[train_fn], index_col=0)['type_id'].values
+            with lib.hist_store.open_hist(tmp[hist_fn]) as hist_ds:
+                centroids=lib.hist_store.to_hist_frame(
+                        self.som.get_weights().reshape(nnodes,-1), 
+                        self.mean, self.std, hist_ds)
+                index=lib.analog.build_index(
+                        hist_ds['ntimes'].values, type_ids, nnodes, 
+                        hist_ds=hist_ds, centroids=centroids)
+            lib.hist_store.append_index(tmp[hist_fn], index)
+            
+            # archive classification result in netcdf, with updated statistics
+            centroid=self.som.get_weights().copy()
+            centroid=centroid.reshape(
+                    self.n_nodex, self.n_nodey, self.nvar, self.nrow, self.ncol)
+            ds_out=self.org_output_nc(centroid)
+            ds_out.to_netcdf(tmp[cluster_fn])
+        except BaseException:
+            # throw_error exits, clean up on SystemExit as well
+            for tmp_fn in tmp.values():
+                if os.path.exists(tmp_fn):
+                    os.remove(tmp_fn)
+            raise
+        
+        for fn, tmp_fn in tmp.items():
+            os.replace(tmp_fn, fn)
+        
+        utils.write_log(print_prefix+'prism update is completed!')
+
 
     def org_output_nc(self, centroid):
         """ organize output file """
         ds_vars={   
                 'som_cluster':([
                     'n_nodex','n_nodey','nvar', 'nrow','ncol'], centroid),
-                'var_vector':(['ntimes','ngrids'], self.data),
                 'lat':(['nrow'], self.lat),
                 'lon':(['ncol'], self.lon)}
             
         ds_coords={
-                'nvar':self.varlist,
-                'ntimes':self.dateseries}
+                'nvar':self.varlist}
 
         ds_attrs={
                 'preprocess_method':self.preprocess,
-                'neighbourhood_function':self.nb_func}
+                'neighbourhood_function':self.nb_func,
+                'nsamples':self.nsamples}
             
         if self.preprocess == 'temporal_norm':
             self.mean=self.mean.reshape(self.nvar, self.nrow, self.ncol)
@@ -272,33 +490,62 @@ class Prism:
 
         return ds_out
 
-    def _match_hist(self):
-        """ match current inference frame to historical vectors """
+    def _to_model_grid(self, lat, lon, cfg_hdl):
+        ''' regrid self.data to the model grid (lat, lon) by cached weights '''
+        if lib.regridder.same_grid((self.lat, self.lon), (lat, lon)):
+            return
+        method=cfg_hdl['INFERENCE'].get('regrid_method', fallback='bilinear')
+        if method=='none':
+            utils.throw_error(print_prefix, 'inference grid %dx%d differs from the model grid %dx%d' % (
+                self.nrow, self.ncol, len(lat), len(lon)))
+        cache_dir=cfg_hdl['INFERENCE'].get('regrid_cache_dir', fallback='./db/')
+        if not os.path.isabs(cache_dir):
+            cache_dir=os.path.join(CWD, cache_dir)
+
+        rgd=lib.regridder.get_regridder((self.lat, self.lon), (lat, lon), method, cache_dir)
+        # all records and variables in one sparse matmul
+        self.data=rgd.apply(self.data.reshape(self.nrec, self.nvar, self.nfea)).reshape(self.nrec, -1)
+        self.lat, self.lon=lat, lon
+        self.nrow, self.ncol=len(lat), len(lon)
+        self.nfea=self.nrow*self.ncol
+        utils.write_log('%sregridded %d records to the %dx%d model grid by %s weights' % (
+            print_prefix, self.nrec, self.nrow, self.ncol, method))
+
+    def _match_hist(self, type_ids):
+        """ match current inference frame to top-k historical vectors """
         # match_arr(recl, nvar*nrow*ncol=ngrids)            
-        # hist_arr(ntimes, ngrids)
+        # hist store var_vector(ntimes, ngrids), only candidates are read
+        utils.write_log(print_prefix+'match %d frames in hist vectors...' % self.nrec)
         
-        self.match_ts=[]
-
-        match_arr=self.data
-        hist_arr=self.hist_data.values
-       
-        for curr_ts, curr_arr in zip(self.dateseries, match_arr):
-
-            utils.write_log(print_prefix+'match %s in hist vectors...' % 
-                    curr_ts.strftime('%Y-%m-%d:%HZ'))
+        # queries and centroids in the frame of the store
+        nnodes=self.n_nodex*self.n_nodey
+        with lib.hist_store.open_hist(self.hist_fn) as hist_ds:
+            query=lib.hist_store.to_hist_frame(
+                    self.data, self.mean, self.std, hist_ds)
+            centroids=lib.hist_store.to_hist_frame(
+                    self.som.get_weights().reshape(nnodes,-1), 
+                    self.mean, self.std, hist_ds)
             
-            min_dis=np.linalg.norm(curr_arr-hist_arr[0,:])
-            min_time=self.hist_dateseries[0]
-
-            for datestamp, hist0_arr in zip(self.hist_dateseries, hist_arr):
-                curr_dis=np.linalg.norm(curr_arr-hist0_arr)
-                if (curr_dis<min_dis):
-                    min_dis=curr_dis
-                    min_time=datestamp.values
-            # convert to datetime obj
-            min_time=datetime.datetime.utcfromtimestamp(min_time.tolist()/1e9)
-            self.match_ts.append(min_time)
+            match_idx, self.match_dis=lib.analog.retrieve_analogs(
+                    query, hist_ds, k=self.match_topk, 
+                    query_ts=self.dateseries, window_days=self.match_window,
+                    query_nodes=type_ids, same_node=self.match_same_node,
+                    centroids=centroids, method=self.match_method)
+            hist_ts=pd.to_datetime(hist_ds['ntimes'].values).to_pydatetime()
+        
+        # convert to datetime obj, None if no candidate
+        self.match_ts=[[hist_ts[idx] if idx>=0 else None for idx in row] 
+                for row in match_idx]
+        
+    def _bmu(self, data, q_err=True):
+        """ winners (x, y) of data on the som, and quantization error if q_err """
+        if self.kernel_backend=='minisom':
+            winners=[self.som.winner(x) for x in data]
+            return winners, self.som.quantization_error(data) if q_err else None
         
+        idx, dis=lib.som_kernels.bmu(self.som, data, self.kernel_backend)
+        winners=[divmod(int(ii), self.n_nodey) for ii in idx]
+        return winners, dis.mean() if q_err else None
 
     def load(self):
         """ load the archived prism classifier in database """
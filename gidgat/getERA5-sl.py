@@ -1,43 +1,22 @@
 #
-# !!!Area: North/West/South/East!!!
+# Retrieve ERA5 single levels (YYYYMM-surf.nc) into TRAINING.era5_src.
+# Period, area (N/W/S/E) and requests in flight are set by the era5_*
+# options of conf/config.era5-gfs.ini, rerun to resume after a failure.
 #
+# Usage: python3 gidgat/getERA5-sl.py [config file]
+#
+
+import os, sys, logging
 
-import cdsapi
-import datetime
+PRISM_ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PRISM_ROOT)
 
-c = cdsapi.Client()
+import lib
 
-for i in range(1979,2021):
-    int_time_obj = datetime.datetime.strptime(str(i)+'0101', '%Y%m%d')
-    end_time_obj = datetime.datetime.strptime(str(i)+'0101', '%Y%m%d')
-    day_delta=datetime.timedelta(days=1)
-    curr_time_obj = int_time_obj
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
 
-    # mon looper
-    for j in range(0,12):
-        
-        curr_year=curr_time_obj.strftime('%Y')
-        curr_mon=curr_time_obj.strftime('%m')
-        dayinmon_list=[]
+cfg_fn=sys.argv[1] if len(sys.argv) > 1 else os.path.join(PRISM_ROOT, 'conf', 'config.era5-gfs.ini')
+cfg_hdl=lib.cfgparser.read_cfg(cfg_fn)
 
-        # obtain day list
-        while curr_time_obj.strftime('%m') ==curr_mon:
-            dayinmon_list.append(curr_time_obj.strftime('%d'))
-            curr_time_obj=curr_time_obj+day_delta
-       
-        # retrieve data
-        c.retrieve(
-            'reanalysis-era5-single-levels',
-            {
-                'product_type':'reanalysis',
-                'format':'netcdf',
-                'variable':[
-                    '10m_u_component_of_wind','10m_v_component_of_wind','mean_sea_level_pressure',
-                ],
-                'year':curr_year,
-                'month':curr_mon,
-                'day':dayinmon_list,
-                'area':'60/60/-10/170',
-                'time':'00/to/23/by/6',
-            },
-            curr_year+curr_mon+'-surf.nc')
+failed=lib.era5_fetcher.ERA5Retriever(cfg_hdl, groups=['surf']).run()
+sys.exit(1 if failed else 0)
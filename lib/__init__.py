@@ -1,6 +1,25 @@
 #/usr/bin/env python3
-"""Module Init"""
-import lib.cfgparser, lib.time_manager
-import lib.preprocess_wrfinp, lib.preprocess_erainp
-import lib.preprocess_gfsinp
-import lib.grid_searcher
+"""
+Module Init
+
+Submodules are imported lazily on first attribute access, e.g. 
+lib.preprocess_gfsinp pulls in xarray only when a GFS run needs it,
+and wrf-python is only imported by lib.preprocess_wrfinp.
+"""
+import importlib
+
+_SUBMODULES=(
+        'cfgparser', 'time_manager', 
+        'preprocess_wrfinp', 'preprocess_erainp', 'preprocess_gfsinp',
+        'grid_searcher', 'prefetch_reader', 'hist_store', 'analog', 
+        'som_trainer', 'som_kernels', 'gs_broker', 'source_catalog', 'gfs_fetcher', 'era5_fetcher',
+        'log_manager', 'reclassifier', 'composites', 'regridder',
+        'type_analytics', 'build_planner')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('lib.'+name)
+    raise AttributeError("module 'lib' has no attribute '%s'" % name)
+
+def __dir__():
+    return sorted(list(globals())+list(_SUBMODULES))
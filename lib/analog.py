@@ -0,0 +1,283 @@
+#/usr/bin/env python
+"""
+Analog retrieval in the history store
+
+    Functions:
+    -----------
+        calendar_day(dateseries): month/day as a day index of a leap year
+        build_index(dateseries, nodes, nnodes): per-calendar-day and
+            per-node candidate indexes in CSR form
+        load_index(hist_ds): load (or rebuild) candidate indexes of a store
+        get_candidates(index, cday, node, window_days): candidate records
+        retrieve_analogs(query, hist_ds, k, ...): top-k analogs with distances
+        node_search(query, hist_ds, centroids, index, k, ...): exact top-k
+            search partitioned by SOM nodes with triangle-inequality pruning
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils import utils
+import lib
+
+print_prefix='lib.analog>>'
+
+# calendar days 0..365 of a leap year, Feb 29 is day 59 and Mar 1 is
+# day 60 in any year, Dec 31 is day 365
+NDOY=366
+FEB29=59
+MONTH_START=np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+# relative slack of the triangle-inequality bounds against rounding
+PRUNE_TOL=1e-9
+
+def calendar_day(dateseries):
+    ''' month/day of dateseries as a day index 0..365 of a leap year '''
+    dateseries=pd.DatetimeIndex(dateseries)
+    return MONTH_START[dateseries.month.values-1]+dateseries.day.values-1
+
+def build_index(dateseries, nodes=None, nnodes=None, hist_ds=None, centroids=None):
+    '''
+    per-calendar-day and per-node candidate indexes in CSR form,
+    records of calendar day d are cday_order[cday_offset[d]:cday_offset[d+1]],
+    records of node n are node_order[node_offset[n]:node_offset[n+1]]
+
+    if hist_ds and centroids(nnodes, ngrids) are given, records of each
+    node are sorted by their distance to the node centroid, kept in
+    node_cdis aligned with node_order, for the exact node search
+    '''
+    index=_csr(calendar_day(dateseries), NDOY, 'cday')
+    if nodes is not None:
+        nodes=np.asarray(nodes)
+        if centroids is None:
+            index.update(_csr(nodes, nnodes, 'node'))
+        else:
+            # distance of each stored record to its node centroid
+            cdis=np.empty(len(nodes))
+            for start, hist_arr in lib.hist_store.iter_hist(hist_ds):
+                end=start+hist_arr.shape[0]
+                cdis[start:end]=np.linalg.norm(
+                        hist_arr.astype(np.float64, copy=False)
+                        -centroids[nodes[start:end]], axis=1)
+            index.update(_csr(nodes, nnodes, 'node', cdis))
+            index['node_cdis']=cdis[index['node_order']]
+    return index
+
+def _csr(keys, nkeys, name, sort_by=None):
+    ''' group record indexes by integer keys in [0, nkeys), optionally sorted within key '''
+    if sort_by is None:
+        order=np.argsort(keys, kind='stable')
+    else:
+        order=np.lexsort((sort_by, keys))
+    offset=np.zeros(nkeys+1, dtype=np.int64)
+    offset[1:]=np.cumsum(np.bincount(keys, minlength=nkeys))
+    return {name+'_order':order, name+'_offset':offset}
+
+def load_index(hist_ds):
+    '''
+    load candidate indexes of a history store, the calendar index is
+    rebuilt if absent (stores written before it keep a stale doy index)
+    '''
+    index={name:hist_ds[name].values for name in (
+        'cday_order', 'cday_offset', 'node_order', 'node_offset', 'node_cdis')
+        if name in hist_ds}
+    if 'cday_order' not in index:
+        index.update(build_index(hist_ds['ntimes'].values))
+    return index
+
+def get_candidates(index, cday=None, node=None, window_days=None):
+    '''
+    candidate records (sorted) within a +/-window_days calendar window
+    around calendar day cday (see calendar_day) and/or in the same SOM
+    node, None for the whole archive
+    '''
+    cand=None
+    if window_days is not None and window_days >= 0 and cday is not None:
+        # window counted on the 365-day calendar, Feb 29 goes with Feb 28
+        day365=cday-(cday >= FEB29)
+        days=np.arange(day365-window_days, day365+window_days+1) % (NDOY-1)
+        days=np.unique(days+(days >= FEB29))
+        if FEB29-1 in days:
+            days=np.union1d(days, [FEB29])
+        order, offset=index['cday_order'], index['cday_offset']
+        cand=np.concatenate([order[offset[d]:offset[d+1]] for d in days])
+
+    if node is not None:
+        if 'node_order' not in index:
+            utils.throw_error(print_prefix, 'no node index in the history store')
+        order, offset=index['node_order'], index['node_offset']
+        node_cand=order[offset[node]:offset[node+1]]
+        if cand is None:
+            cand=node_cand
+        else:
+            cand=np.intersect1d(cand, node_cand, assume_unique=True)
+
+    if cand is not None:
+        cand=np.sort(cand)
+    return cand
+
+def retrieve_analogs(query, hist_ds, k=1, query_ts=None, window_days=None,
+        query_nodes=None, index=None, chunk=1024, centroids=None, 
+        same_node=None, method='brute'):
+    '''
+    top-k analogs of query(nquery, ngrids) in the history store by
+    euclidean distance, candidates can be restricted to a +/-window_days
+    calendar window around query_ts and/or to the same SOM node given
+    by query_nodes. Only candidate records are read from the store.
+
+    method='node' uses node_search() with centroids when no calendar 
+    window is set, query_nodes then gives the node searched first and
+    same_node (default: query_nodes given) keeps the search in it.
+
+    return (idx, dis), each (nquery, k), sorted by distance, then by
+    record on ties, idx=-1 and dis=inf where fewer than k candidates exist
+    '''
+    nquery=query.shape[0]
+    use_window=window_days is not None and window_days >= 0
+    if same_node is None:
+        same_node=query_nodes is not None
+    if index is None and (use_window or query_nodes is not None or method=='node'):
+        index=load_index(hist_ds)
+
+    if method=='node' and not use_window:
+        if 'node_cdis' in index and centroids is not None:
+            return node_search(query, hist_ds, centroids, index, k=k,
+                    query_nodes=query_nodes, same_node=same_node)
+        utils.write_log(print_prefix+'no sorted node index, fall back to brute search', 30)
+    
+    if not same_node:
+        query_nodes=None
+
+    # group queries sharing the same candidate set
+    cdays=calendar_day(query_ts) if use_window else None
+    groups={}
+    for iq in range(nquery):
+        key=(cdays[iq] if use_window else None,
+             int(query_nodes[iq]) if query_nodes is not None else None)
+        groups.setdefault(key, []).append(iq)
+
+    best_idx=np.full((nquery, k), -1, dtype=np.int64)
+    best_dis=np.full((nquery, k), np.inf)
+
+    for (cday, node), qidx in groups.items():
+        cand=None
+        if index is not None:
+            cand=get_candidates(index, cday, node, window_days if use_window else None)
+        qidx=np.asarray(qidx)
+        best_idx[qidx], best_dis[qidx]=_topk_scan(
+                query[qidx], hist_ds, k, cand, chunk)
+
+    return best_idx, best_dis
+
+def _topk_scan(query, hist_ds, k, cand=None, chunk=1024):
+    ''' top-k scan of query over candidate records, read block by block '''
+    da=hist_ds['var_vector']
+    nquery=query.shape[0]
+    q2=(query**2).sum(axis=1)
+
+    top_idx=np.full((nquery, k), -1, dtype=np.int64)
+    top_dis2=np.full((nquery, k), np.inf)
+
+    if cand is None:
+        blocks=(np.arange(s, min(s+chunk, da.shape[0]))
+                for s in range(0, da.shape[0], chunk))
+    else:
+        blocks=(cand[s:s+chunk] for s in range(0, len(cand), chunk))
+
+    for block in blocks:
+        if len(block)==0:
+            continue
+        if cand is None:
+            hist_arr=da[block[0]:block[-1]+1].values
+        else:
+            hist_arr=da.isel(ntimes=block).values
+        hist_arr=hist_arr.astype(np.float64, copy=False)
+
+        # |q-h|^2 = |q|^2 + |h|^2 - 2 q.h
+        dis2=q2[:,np.newaxis]+(hist_arr**2).sum(axis=1)[np.newaxis,:] \
+                -2.0*query.dot(hist_arr.T)
+
+        # merge block into running top-k, ties go to the earlier record
+        all_idx=np.concatenate(
+                [top_idx, np.broadcast_to(block, (nquery, len(block)))], axis=1)
+        all_dis2=np.concatenate([top_dis2, dis2], axis=1)
+        sel=np.lexsort((all_idx, all_dis2), axis=1)[:,:k]
+        top_idx=np.take_along_axis(all_idx, sel, axis=1)
+        top_dis2=np.take_along_axis(all_dis2, sel, axis=1)
+
+    return top_idx, np.sqrt(np.maximum(top_dis2, 0.0))
+
+def node_search(query, hist_ds, centroids, index, k=1, query_nodes=None, 
+        same_node=False):
+    '''
+    exact top-k search partitioned by SOM nodes. The query's own node
+    is searched first, other nodes are visited by increasing lower bound
+    max(0, |q-c|-r) (r: node radius) only while the bound is below the 
+    current k-th distance. Within a node, records are sorted by their 
+    distance cd to the centroid and only those with |cd-|q-c|| below 
+    the k-th distance are read (triangle inequality). Bounds are
+    widened by PRUNE_TOL so rounding never prunes a record at the k-th
+    distance, ties go to the earlier record as in the brute scan.
+
+    return (idx, dis), each (nquery, k), sorted by distance
+    '''
+    da=hist_ds['var_vector']
+    order, offset, cdis=index['node_order'], index['node_offset'], index['node_cdis']
+    nnodes=len(offset)-1
+    nquery=query.shape[0]
+
+    # node radius, inf lower bound for empty nodes
+    radius=np.full(nnodes, np.nan)
+    for n in range(nnodes):
+        if offset[n+1]>offset[n]:
+            radius[n]=cdis[offset[n+1]-1]
+
+    # query to centroid distances (nquery, nnodes)
+    dqc=np.sqrt(np.maximum(
+        (query**2).sum(axis=1)[:,np.newaxis]+(centroids**2).sum(axis=1)[np.newaxis,:]
+        -2.0*query.dot(centroids.T), 0.0))
+    if query_nodes is None:
+        query_nodes=dqc.argmin(axis=1)
+
+    best_idx=np.full((nquery, k), -1, dtype=np.int64)
+    best_dis=np.full((nquery, k), np.inf)
+    nread=0
+
+    for iq in range(nquery):
+        own=int(query_nodes[iq])
+        lb=np.where(np.isnan(radius), np.inf, np.maximum(dqc[iq]-radius, 0.0))
+        if same_node:
+            node_seq=[own]
+        else:
+            node_seq=[own]+[n for n in np.argsort(lb) if n!=own]
+
+        top_idx, top_dis=best_idx[iq], best_dis[iq]
+        for n in node_seq:
+            kth=top_dis[-1]*(1.0+PRUNE_TOL)+PRUNE_TOL
+            if n!=own and lb[n]>kth:
+                break
+            if np.isinf(lb[n]):
+                continue
+            # records with |cd-|q-c|| <= kth, cd sorted within node
+            seg=cdis[offset[n]:offset[n+1]]
+            lo=np.searchsorted(seg, dqc[iq,n]-kth, side='left')
+            hi=np.searchsorted(seg, dqc[iq,n]+kth, side='right')
+            if hi<=lo:
+                continue
+            rec=np.sort(order[offset[n]+lo:offset[n]+hi])
+            nread+=len(rec)
+            hist_arr=da.isel(ntimes=rec).values.astype(np.float64, copy=False)
+            dis=np.linalg.norm(hist_arr-query[iq], axis=1)
+
+            # merge into running top-k
+            all_idx=np.concatenate([top_idx, rec])
+            all_dis=np.concatenate([top_dis, dis])
+            sel=np.lexsort((all_idx, all_dis))[:k]
+            top_idx, top_dis=all_idx[sel], all_dis[sel]
+
+        best_idx[iq], best_dis[iq]=top_idx, top_dis
+
+    utils.write_log(print_prefix+'node search read %d records for %d queries (%.2f%% of history)' % (
+        nread, nquery, 100.0*nread/max(nquery*da.shape[0], 1)))
+
+    return best_idx, best_dis
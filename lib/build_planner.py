@@ -0,0 +1,408 @@
+#/usr/bin/env python
+"""
+Memory and runtime planner of a build
+
+Before any file is loaded, the records (dateseries of the TRAINING
+selection), the subset grid, the variables, the node counts and the grid
+search size give the size of the training buffer and of the temporaries
+of each stage. The runtime of each stage is scaled from the source bytes
+and a short benchmark of this host (matmul rate, memory bandwidth, one
+online SOM iteration). Worker counts, the normalization chunk and the
+evaluation sample size are then fitted to the available memory and the
+cores, the plan is logged, and the fitted values either overwrite the
+config (plan_auto) or are reported as warnings.
+
+    Classes:
+    -----------
+        BuildPlan: estimates and fitted options of one build
+
+    Functions:
+    -----------
+        plan(cfg, pipeline, apply): estimate, log and apply the plan
+        host_resources(): available memory (bytes) and cores
+        get_dateseries(cfg, pipeline): training records of the config
+        measure_rates(nfea, nnodes): benchmark of this host
+"""
+
+import os, sys, time, datetime, itertools
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import lib
+from utils import utils
+
+print_prefix='lib.build_planner>>'
+CWD=sys.path[0]
+
+GB=1024.0**3
+
+# bytes of one training value (shared float64 buffer)
+NBYTES=8
+
+# sklearn pairwise distances are chunked by working_memory (1024 MB)
+EVAL_WORKING_MEM=1024*1024**2
+
+# grid spacing of the ERA5 files if none is found to read
+ERA5_RES=0.25
+
+def host_resources():
+    ''' available memory in bytes and usable cores of this host '''
+    mem=None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    mem=int(line.split()[1])*1024
+                    break
+    except OSError:
+        pass
+    if mem is None:
+        mem=os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+    try:
+        ncpu=len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpu=os.cpu_count() or 1
+    return mem, ncpu
+
+def get_dateseries(cfg, pipeline):
+    ''' training records selected by the TRAINING section, as the meshes do '''
+    start, end=cfg['TRAINING']['training_start'], cfg['TRAINING']['training_end']
+    if pipeline=='wrf':
+        all_dates=pd.date_range(
+                start=datetime.datetime.strptime(start+'12','%Y%m%d%H'),
+                end=datetime.datetime.strptime(end+'12','%Y%m%d%H'), freq='H')
+        all_hrs=range(0, 24)
+    else:
+        all_dates=pd.date_range(
+                start=datetime.datetime.strptime(start+'00','%Y%m%d%H'),
+                end=datetime.datetime.strptime(end+'23','%Y%m%d%H'), freq='6H')
+        all_hrs=[0, 6, 12, 18]
+    subhr_list=lib.cfgparser.cfg_get_varlist(cfg,'TRAINING','sub_hrs')
+    submon_list=lib.cfgparser.cfg_get_varlist(cfg,'TRAINING','sub_mons')
+    hrs=all_hrs if subhr_list[0]=='-1' else [int(hr) for hr in subhr_list]
+    mons=range(1,13) if submon_list[0]=='-1' else [int(mon) for mon in submon_list]
+    sel_dates=all_dates[all_dates.hour.isin(hrs)]
+    return sel_dates[sel_dates.month.isin(mons)]
+
+def measure_rates(nfea, nnodes):
+    '''
+    matmul rate (flop/s), memory bandwidth (byte/s) and the seconds of
+    one online iteration on a (nnodes, nfea) codebook, by a short benchmark
+    '''
+    rng=np.random.default_rng(0)
+    a, b=rng.random((256, 1024)), rng.random((1024, 256))
+    rates={'gemm':_time_rate(lambda: a.dot(b), 2.0*256*1024*256)}
+
+    x=np.ones(4*1024**2)
+    rates['membw']=_time_rate(lambda: np.multiply(x, 2.0, out=x), 2.0*x.nbytes)
+
+    # update of minisom: distances, neighbourhood, weight update
+    nfea_sub=min(nfea, max(1, 32*1024**2//(NBYTES*nnodes)))
+    weights, vec=rng.random((nnodes, nfea_sub)), rng.random(nfea_sub)
+    def online_iter():
+        dis=np.linalg.norm(vec-weights, axis=-1)
+        g=np.exp(-dis/dis.max())
+        np.add(weights, 0.01*g[:,np.newaxis]*(vec-weights), out=weights)
+    rates['iter']=nfea/nfea_sub/_time_rate(online_iter, 1.0)
+    return rates
+
+def _time_rate(func, work, min_secs=0.05):
+    ''' work units per second of func, repeated for at least min_secs '''
+    func()
+    nrep, tic=0, time.time()
+    while True:
+        func()
+        nrep+=1
+        elapsed=time.time()-tic
+        if elapsed >= min_secs:
+            return work*nrep/elapsed
+
+class BuildPlan:
+
+    '''
+    Estimated peak memory and runtime of each build stage, and the
+    worker counts, chunk and sample sizes fitted to this host
+
+    Attributes
+    -----------
+    nrec, nvar, nrow, ncol, int, size of the training buffer
+    nfea, int, features per record, nvar*nrow*ncol
+    mem_avail, ncpu, available bytes and cores of this host
+    budget, float, bytes the build may use (plan_mem_frac of mem_avail)
+    stages, list of (stage, peak bytes, seconds, note)
+    fitted, dict, (section, option) to the fitted value
+    warnings, list of str, limits of the host or the config
+    advice, list of str, configured options beyond the fitted ones
+
+    Methods
+    -----------
+    estimate(), fill stages by the configured options
+    fit(), fit worker counts, chunk and sample sizes to the host
+    report(), log the plan
+    apply(cfg), write the fitted options into cfg
+
+    '''
+
+    def __init__(self, cfg, pipeline):
+        """ construct plan from the config, no training file is loaded """
+        self.cfg=cfg
+        self.pipeline=pipeline
+        self.mem_avail, self.ncpu=host_resources()
+        self.mem_frac=float(cfg.get('PLAN', 'plan_mem_frac', fallback='0.8'))
+        self.budget=self.mem_frac*self.mem_avail
+        self.eval_secs=float(cfg.get('PLAN', 'plan_eval_seconds', fallback='60'))
+        self.io_rate=float(cfg.get('PLAN', 'plan_io_rate', fallback='100'))*1024**2
+        self.stages, self.fitted, self.warnings, self.advice=[], {}, [], []
+
+        self.dateseries=get_dateseries(cfg, pipeline)
+        self.nrec=len(self.dateseries)
+        if self.nrec==0:
+            utils.throw_error(print_prefix, 'no training record selected by the TRAINING section')
+        if pipeline=='wrf':
+            self.varlist=lib.cfgparser.cfg_get_varlist(cfg, 'SHARE', 'var')
+        else:
+            self.varlist=['u10','v10','msl','z']
+        self.nvar=len(self.varlist)
+        self._get_grid()
+        self.nfea=self.nvar*self.nrow*self.ncol
+        self.buf_bytes=float(self.nrec)*self.nfea*NBYTES
+
+        self.nnodes=int(cfg['TRAINING']['n_nodex'])*int(cfg['TRAINING']['n_nodey'])
+        self.combs=[]
+        if cfg['TRAINING'].getboolean('grid_search_opt'):
+            self.combs=list(itertools.product(*[
+                lib.cfgparser.cfg_get_varlist(cfg, 'GRID_SEARCH', key) for key in (
+                    'gs_sigma', 'gs_learning_rate', 'gs_nodexy', 'gs_nb_func', 'gs_iterations')]))
+
+        self.rates=measure_rates(self.nfea, self.nnodes)
+
+    def _get_grid(self):
+        ''' subset grid (nrow, ncol) and source bytes of the training files '''
+        cfg=self.cfg
+        s_sn, e_sn=int(cfg['SHARE']['s_sn']), int(cfg['SHARE']['e_sn'])
+        s_we, e_we=int(cfg['SHARE']['s_we']), int(cfg['SHARE']['e_we'])
+        dsmp=int(cfg['SHARE']['dsmp_interval'])
+        if self.pipeline=='wrf':
+            self.nrow=len(np.arange(s_sn, e_sn, dsmp))
+            self.ncol=len(np.arange(s_we, e_we, dsmp))
+            self.nunits=self.nrec
+            # wrfout variables are read on the full window before subsetting
+            self.unit_bytes=2.0*self.nvar*self.nrow*self.ncol*dsmp*dsmp*NBYTES
+            fn=CWD+'/input/training/wrfout_d01_'+self.dateseries[0].strftime('%Y-%m-%d_%H:%M:%S')
+            if os.path.exists(fn):
+                self.src_bytes=float(os.path.getsize(fn))*self.nrec
+            else:
+                self.src_bytes=self.unit_bytes/2.0*self.nrec
+            return
+
+        months=self.dateseries.to_period('M')
+        self.nunits=len(months.unique())
+        era_src=cfg['TRAINING']['era5_src']
+        fn=lib.preprocess_erainp.get_var_fn(era_src, self.dateseries[0], self.varlist[0])
+        if os.path.exists(fn):
+            with xr.open_dataset(fn) as ds:
+                ds_sub=ds.sel(latitude=slice(e_sn, s_sn), longitude=slice(s_we, e_we))
+                self.nrow, self.ncol=ds_sub.sizes['latitude'], ds_sub.sizes['longitude']
+        else:
+            self.warnings.append('%s not found, assume a %.2f degree grid' % (fn, ERA5_RES))
+            self.nrow=int(round((e_sn-s_sn)/ERA5_RES))+1
+            self.ncol=int(round((e_we-s_we)/ERA5_RES))+1
+        # a month of 6-hourly fields of all variables is decoded at once
+        self.unit_bytes=2.0*31*4*self.nvar*self.nrow*self.ncol*NBYTES
+        src_bytes=0.0
+        for month in months.unique():
+            for grp in sorted({lib.preprocess_erainp.get_var_group(var) for var in self.varlist}):
+                fn=era_src+'/'+month.strftime('%Y%m')+'-'+grp+'.nc'
+                src_bytes+=os.path.getsize(fn) if os.path.exists(fn) else \
+                        month.days_in_month*4*self.nrow*self.ncol*2.0
+        self.src_bytes=src_bytes
+
+    def _cfg_int(self, section, key, fallback):
+        ''' integer option of cfg '''
+        return int(self.cfg[section].get(key, fallback=fallback))
+
+    def _eval_cost(self, nsample):
+        ''' peak bytes and seconds of one silhouette score on nsample records '''
+        mem=min(float(nsample)**2*NBYTES, EVAL_WORKING_MEM)
+        if nsample < self.nrec:
+            # sampled records are copied by sklearn
+            mem+=float(nsample)*self.nfea*NBYTES
+        return mem, 2.0*float(nsample)**2*self.nfea/self.rates['gemm']
+
+    def _train_cost(self, iterations, nnodes, nworkers=1):
+        ''' peak bytes (besides the buffer) and seconds of training and BMUs '''
+        codebook=float(nnodes)*self.nfea*NBYTES
+        bmu_secs=2.0*self.nrec*nnodes*self.nfea/self.rates['gemm']
+        if self.cfg['TRAINING'].get('train_mode', fallback='online')=='batch':
+            epochs=self._cfg_int('TRAINING', 'batch_epochs', '20')
+            secs=epochs*(bmu_secs/max(min(nworkers, self.ncpu), 1)+self.buf_bytes/self.rates['membw'])
+            return codebook*(2+2*nworkers), secs+bmu_secs
+        secs=iterations*self.rates['iter']*nnodes/self.nnodes
+        if self.cfg['TRAINING'].getboolean('early_stop', fallback=False):
+            # monitor BMUs of the holdout after each segment
+            nseg=iterations/self._cfg_int('TRAINING', 'es_segment', '1000')
+            secs+=nseg*bmu_secs*float(self.cfg['TRAINING'].get('es_holdout', fallback='0.1'))
+        return codebook*4, secs+bmu_secs
+
+    def _gs_worker_bytes(self, eval_sample):
+        ''' bytes of one grid search worker, largest node count '''
+        nodes=max(int(nxy.split('x')[0])*int(nxy.split('x')[1]) for nxy in
+                lib.cfgparser.cfg_get_varlist(self.cfg, 'GRID_SEARCH', 'gs_nodexy'))
+        return self._eval_cost(eval_sample)[0]+self._train_cost(1, nodes)[0]
+
+    def estimate(self, ntasks=None, norm_chunk=None, eval_sample=None,
+            gs_nworkers=None, train_nworkers=None):
+        ''' stages by the given options, the configured ones if None '''
+        cfg=self.cfg
+        ntasks=ntasks or self._cfg_int('SHARE', 'ntasks', '4')
+        norm_chunk=norm_chunk or self._cfg_int('TRAINING', 'norm_chunk', '1024')
+        if eval_sample is None:
+            eval_sample=self._cfg_int('TRAINING', 'eval_sample', '0')
+        eval_sample=self.nrec if eval_sample <= 0 else min(eval_sample, self.nrec)
+        gs_nworkers=gs_nworkers or self._cfg_int('GRID_SEARCH', 'gs_nworkers', '4')
+        train_nworkers=train_nworkers or self._cfg_int('TRAINING', 'train_nworkers', '4')
+        buf=self.buf_bytes
+        stages=[]
+
+        nread=min(ntasks, self.nunits)
+        stages.append(('load', buf+nread*self.unit_bytes,
+            self.src_bytes/(self.io_rate*min(nread, self.ncpu)),
+            '%d %s, %.1f GB source, ntasks=%d' % (
+                self.nunits, 'files' if self.pipeline=='wrf' else 'months',
+                self.src_bytes/GB, ntasks)))
+
+        if cfg['TRAINING']['preprocess_method']=='temporal_norm':
+            stages.append(('normalize', buf+(2.0*min(norm_chunk, self.nrec)+3)*self.nfea*NBYTES,
+                4*buf/self.rates['membw'], 'in place, norm_chunk=%d' % norm_chunk))
+
+        if self.combs:
+            secs, nworkers=0.0, min(gs_nworkers, len(self.combs))
+            for comb in self.combs:
+                nodes=int(comb[2].split('x')[0])*int(comb[2].split('x')[1])
+                secs+=self._train_cost(int(comb[4]), nodes)[1]+self._eval_cost(eval_sample)[1]
+            stages.append(('grid search', buf+nworkers*self._gs_worker_bytes(eval_sample),
+                secs/min(nworkers, self.ncpu), '%d combinations, gs_nworkers=%d%s' % (
+                    len(self.combs), gs_nworkers,
+                    ' (broker)' if cfg['GRID_SEARCH'].get('gs_mode', fallback='local')=='broker' else '')))
+
+        train_bytes, train_secs=self._train_cost(
+                self._cfg_int('TRAINING', 'iterations', '10000'), self.nnodes, train_nworkers)
+        stages.append(('train', buf+train_bytes, train_secs, '%s, %d nodes' % (
+            cfg['TRAINING'].get('train_mode', fallback='online'), self.nnodes)))
+
+        eval_bytes, eval_secs=self._eval_cost(eval_sample)
+        stages.append(('evaluate', buf+eval_bytes, eval_secs, 'silhouette on %d of %d records' % (
+            eval_sample, self.nrec)))
+
+        # the store is encoded in one piece by xarray
+        hist_dtype=cfg['TRAINING'].get('hist_dtype', fallback='float32')
+        enc_bytes={'float64':0.0, 'float32':0.5, 'int16':1.25}.get(hist_dtype, 1.0)*buf
+        stages.append(('archive', buf+enc_bytes, 2*buf/self.rates['membw']+buf/(50*1024**2),
+            'history store as '+hist_dtype))
+
+        self.stages=stages
+        return stages
+
+    def fit(self):
+        ''' fit worker counts, chunk and sample sizes to the memory budget and cores '''
+        cfg=self.cfg
+        spare=self.budget-self.buf_bytes
+        if spare <= 0:
+            self.warnings.append(
+                'training buffer (%.1f GB) exceeds the memory budget (%.1f GB), shorten '
+                'the period, select fewer sub_hrs/sub_mons or raise dsmp_interval' % (
+                    self.buf_bytes/GB, self.budget/GB))
+            spare=0.0
+
+        # loader tasks: cores, units, and decoded units in memory
+        ntasks=min(self.ncpu, self.nunits, max(int(spare//self.unit_bytes), 1))
+        self.fitted[('SHARE', 'ntasks')]=max(ntasks, 1)
+
+        # normalization temporaries within 5% of the spare memory
+        norm_chunk=1024
+        while norm_chunk > 16 and 2.0*norm_chunk*self.nfea*NBYTES > 0.05*spare:
+            norm_chunk//=2
+        self.fitted[('TRAINING', 'norm_chunk')]=norm_chunk
+
+        # silhouette within plan_eval_seconds, a smaller configured sample is kept
+        nsample=max(int(np.sqrt(self.eval_secs*self.rates['gemm']/(2.0*self.nfea))), 1000)
+        nsample=0 if nsample >= self.nrec else nsample
+        conf=self._cfg_int('TRAINING', 'eval_sample', '0')
+        if 0 < conf < (nsample or self.nrec):
+            nsample=conf
+        self.fitted[('TRAINING', 'eval_sample')]=nsample
+        eval_sample=self.fitted[('TRAINING', 'eval_sample')] or self.nrec
+
+        if cfg['TRAINING'].get('train_mode', fallback='online')=='batch':
+            per_worker=2.0*self.nnodes*self.nfea*NBYTES
+            self.fitted[('TRAINING', 'train_nworkers')]=max(
+                    min(self.ncpu, self.nrec, int(spare//per_worker)), 1)
+
+        if self.combs:
+            per_worker=self._gs_worker_bytes(eval_sample)
+            self.fitted[('GRID_SEARCH', 'gs_nworkers')]=max(
+                    min(self.ncpu, len(self.combs), int(spare//per_worker)), 1)
+
+        for (section, key), value in self.fitted.items():
+            conf=cfg[section].get(key)
+            if conf is None or key=='norm_chunk':
+                continue
+            conf=int(conf)
+            if key=='eval_sample':
+                if conf <= 0 < value:
+                    self.advice.append('silhouette on all %d records takes ~%s, '
+                        'eval_sample=%d fits plan_eval_seconds' % (
+                            self.nrec, _fmt_secs(self._eval_cost(self.nrec)[1]), value))
+            elif conf > value:
+                self.advice.append('%s.%s=%d exceeds the %d this host fits' % (
+                    section, key, conf, value))
+        self.estimate()
+
+    def report(self, title='configured'):
+        ''' log the stages and the fitted options '''
+        utils.write_log('%sbuild plan (%s): %d records x %d vars x %dx%d grid, %.2f GB buffer' % (
+            print_prefix, title, self.nrec, self.nvar, self.nrow, self.ncol, self.buf_bytes/GB))
+        utils.write_log('%shost: %d cores, %.1f GB available, budget %.1f GB (plan_mem_frac=%.2f)' % (
+            print_prefix, self.ncpu, self.mem_avail/GB, self.budget/GB, self.mem_frac))
+        total=0.0
+        for stage, peak, secs, note in self.stages:
+            total+=secs
+            utils.write_log('%s  %-12s peak %8.2f GB  ~%10s  %s' % (
+                print_prefix, stage, peak/GB, _fmt_secs(secs), note))
+        utils.write_log('%s  %-12s peak %8.2f GB  ~%10s' % (
+            print_prefix, 'total', max(stage[1] for stage in self.stages)/GB, _fmt_secs(total)))
+        utils.write_log(print_prefix+'fitted: '+', '.join('%s.%s=%s' % (
+            section, key, value) for (section, key), value in self.fitted.items()))
+        # stages beyond the budget, not repeated if the buffer alone is
+        over=['%s peaks at %.1f GB over the %.1f GB budget' % (stage, peak/GB, self.budget/GB)
+                for stage, peak, secs, note in self.stages
+                if peak > self.budget and self.buf_bytes <= self.budget]
+        for msg in self.warnings+self.advice+over:
+            utils.write_log(print_prefix+msg, 30)
+
+    def apply(self, cfg):
+        ''' write the fitted options into cfg '''
+        for (section, key), value in self.fitted.items():
+            cfg[section][key]=str(value)
+        self.advice=[]
+        self.estimate()
+
+def _fmt_secs(secs):
+    ''' seconds as h:mm:ss '''
+    return str(datetime.timedelta(seconds=int(round(secs))))
+
+def plan(cfg, pipeline, apply=None):
+    '''
+    estimate, fit and log the build plan of cfg, the fitted options are
+    written into cfg if apply (default PLAN.plan_auto), return the plan
+    '''
+    if apply is None:
+        apply=cfg.getboolean('PLAN', 'plan_auto', fallback=False)
+    build_plan=BuildPlan(cfg, pipeline)
+    build_plan.fit()
+    build_plan.report()
+    if apply:
+        build_plan.apply(cfg)
+        build_plan.report(title='fitted')
+    return build_plan
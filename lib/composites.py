@@ -0,0 +1,278 @@
+#/usr/bin/env python
+"""
+Per-type composites of any variable from the source files
+
+The records of an assignment csv (db/train_cluster*.csv by default, or
+the reclassified archive) are grouped into units, one wrfout file or one
+ERA5 month, and split over ntasks processes. Each process streams its
+units once and accumulates per-node sums, sums of squares and counts, so
+memory is bounded by the composite size, not by the length of the record.
+The reduced mean, variance and count of each node are written to netCDF.
+
+    Classes:
+    -----------
+        Composer: accumulate and write the composites of one pipeline
+
+    Functions:
+    -----------
+        new_acc(nnodes, shape): empty accumulator
+        accumulate(acc, type_ids, fields): add records to an accumulator
+        merge(acc_list): sum the accumulators of all tasks
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4 as nc4
+from multiprocessing import Pool
+
+import lib
+from utils import utils
+
+print_prefix='lib.composites>>'
+CWD=sys.path[0]
+
+def new_acc(nnodes, shape):
+    ''' empty accumulator of nnodes nodes, fields of shape (nvar, nrow, ncol) '''
+    return {
+        'sum':np.zeros((nnodes,)+shape),
+        'sumsq':np.zeros((nnodes,)+shape),
+        'count':np.zeros(nnodes, dtype=np.int64)}
+
+def accumulate(acc, type_ids, fields):
+    ''' add fields(nrec, nvar, nrow, ncol) of records assigned to type_ids '''
+    for node in np.unique(type_ids):
+        sel=fields[type_ids==node]
+        acc['sum'][node]+=sel.sum(axis=0)
+        acc['sumsq'][node]+=(sel*sel).sum(axis=0)
+        acc['count'][node]+=len(sel)
+
+def merge(acc_list):
+    ''' sum the accumulators of all tasks '''
+    acc=acc_list[0]
+    for other in acc_list[1:]:
+        for key in acc:
+            acc[key]+=other[key]
+    return acc
+
+class Composer:
+
+    '''
+    Composites of comp_vars over the records assigned to each SOM node
+
+    Attributes
+    -----------
+    pipeline, str, wrf or era5-gfs
+    varlist, list of str, composite variables
+    type_ids, pd.Series, node of each record, indexed by time
+    units, list, wrf: (file, [type_id]), era5: (month, times, type_ids)
+
+    Methods
+    -----------
+    run(), accumulate over a process pool and write comp_out
+
+    '''
+
+    def __init__(self, cfg, pipeline):
+        """ construct composer from the COMPOSITE section """
+        utils.write_log(print_prefix+'Init composer...')
+        self.pipeline=pipeline
+        sfx='' if pipeline=='wrf' else '_era5'
+
+        self.varlist=lib.cfgparser.cfg_get_varlist(cfg, 'COMPOSITE', 'comp_vars')
+        self.assign_fn=get_path(cfg['COMPOSITE'].get(
+            'comp_assign', fallback='./db/train_cluster'+sfx+'.csv'))
+        self.out_fn=get_path(cfg['COMPOSITE'].get(
+            'comp_out', fallback='./output/composite'+sfx+'.nc'))
+        self.ntasks=int(cfg['SHARE']['ntasks'])
+        self.use_catalog=cfg['SHARE'].getboolean('use_catalog', fallback=False)
+
+        # same window as the meshes
+        self.s_sn, self.e_sn = int(cfg['SHARE']['s_sn']),int(cfg['SHARE']['e_sn'])
+        self.s_we, self.e_we = int(cfg['SHARE']['s_we']),int(cfg['SHARE']['e_we'])
+        self.dsmp_interval=int(cfg['SHARE']['dsmp_interval'])
+        self.sn_range=np.arange(self.s_sn, self.e_sn, self.dsmp_interval)
+        self.we_range=np.arange(self.s_we, self.e_we, self.dsmp_interval)
+
+        # node layout of the archived model
+        with xr.open_dataset(CWD+'/db/som_cluster'+sfx+'.nc') as db_in:
+            self.n_nodex, self.n_nodey=db_in.sizes['n_nodex'], db_in.sizes['n_nodey']
+        self.nnodes=self.n_nodex*self.n_nodey
+
+        df=pd.read_csv(self.assign_fn, index_col=0, parse_dates=True)
+        self.type_ids=df['type_id'].astype(np.int64)
+        if (self.type_ids >= self.nnodes).any():
+            utils.throw_error(print_prefix, '%s has types beyond the %dx%d model' % (
+                self.assign_fn, self.n_nodex, self.n_nodey))
+
+        if pipeline=='wrf':
+            self._wrf_units(cfg)
+        else:
+            self.era_src=cfg['TRAINING']['era5_src']
+            self._era5_units(cfg)
+        utils.write_log('%s%d records of %s in %d units' % (
+            print_prefix, len(self.type_ids), self.assign_fn, len(self.units)))
+
+    def _wrf_units(self, cfg):
+        ''' one wrfout file per record, missing files are skipped '''
+        dateseries=self.type_ids.index
+        if self.use_catalog:
+            catalog=lib.source_catalog.load_catalog(cfg, 'wrf')
+            dateseries, fn_list=lib.source_catalog.lookup(
+                    catalog, dateseries, 'wrfout_d01 times')
+        else:
+            fn_list=[CWD+'/input/training/wrfout_d01_'+ts.strftime('%Y-%m-%d_%H:%M:%S')
+                    for ts in dateseries]
+            found=np.array([os.path.exists(fn) for fn in fn_list], dtype=bool)
+            if not found.all():
+                lib.source_catalog.report_missing(
+                        dateseries[~found], len(dateseries), 'wrfout_d01 times', hint=False)
+            dateseries=dateseries[found]
+            fn_list=[fn for fn, exist in zip(fn_list, found) if exist]
+        ids=self.type_ids.loc[dateseries].values
+        self.units=[(fn, ids[ii:ii+1]) for ii, fn in enumerate(fn_list)]
+        self.unit_name='files'
+        if not self.units:
+            utils.throw_error(print_prefix, 'no wrfout file of '+self.assign_fn+' found')
+
+        ncfile=nc4.Dataset(self.units[0][0])
+        self.xlat=lib.preprocess_wrfinp.get_var_sub(ncfile, 'XLAT', self).values
+        self.xlong=lib.preprocess_wrfinp.get_var_sub(ncfile, 'XLONG', self).values
+        ncfile.close()
+
+    def _era5_units(self, cfg):
+        ''' records grouped by monthly file, missing months are skipped '''
+        dateseries=self.type_ids.index
+        groups=sorted({lib.preprocess_erainp.get_var_group(var) for var in self.varlist})
+        self.fn_dic=None
+        if self.use_catalog:
+            catalog=lib.source_catalog.load_catalog(cfg, 'era5')
+            dateseries, self.fn_dic=lib.source_catalog.lookup_monthly(
+                    catalog, dateseries, groups, 'era5 months')
+
+        months=dateseries.to_period('M')
+        self.units, missing=[], []
+        for month in months.unique():
+            sub_ts=dateseries[months==month]
+            month_ts=month.to_timestamp()
+            if not self.use_catalog and not all(os.path.exists(
+                    lib.preprocess_erainp.get_var_fn(self.era_src, month_ts, var))
+                    for var in self.varlist):
+                missing.append(month_ts)
+                continue
+            self.units.append((month_ts, sub_ts, self.type_ids.loc[sub_ts].values))
+        if missing:
+            lib.source_catalog.report_missing(pd.DatetimeIndex(missing), 
+                    len(months.unique()), 'era5 months', hint=False)
+        self.unit_name='months'
+        if not self.units:
+            utils.throw_error(print_prefix, 'no era5 month of '+self.assign_fn+' found')
+
+        # vars are mapped to a file group by name, check they are in its file
+        fn_dic={}
+        for var in self.varlist:
+            fn_dic.setdefault(lib.preprocess_erainp.get_var_fn(
+                self.era_src, self.units[0][0], var, self.fn_dic), []).append(var)
+        unsupported, available=[], set()
+        for nc_fn, fn_vars in fn_dic.items():
+            with xr.open_dataset(nc_fn) as ds:
+                available.update(ds.data_vars)
+                unsupported+=[var for var in fn_vars if var not in ds.data_vars]
+        if unsupported:
+            utils.throw_error(print_prefix, 'comp_vars %s not in the monthly files, available: %s' % (
+                ', '.join(unsupported), ', '.join(sorted(available))))
+
+        with xr.open_dataset(list(fn_dic)[0]) as ds:
+            ds_sub=ds.sel(
+                latitude=slice(self.e_sn,self.s_sn),
+                longitude=slice(self.s_we, self.e_we))
+            self.lon=ds_sub['longitude'].values
+            self.lat=ds_sub['latitude'].values
+
+    def run(self):
+        ''' accumulate the units over a process pool and write the composites '''
+        if self.pipeline=='wrf':
+            self.nrow, self.ncol=self.xlat.shape
+        else:
+            self.nrow, self.ncol=len(self.lat), len(self.lon)
+
+        ntasks=min(self.ntasks, len(self.units))
+        len_per_task=-(-len(self.units)//ntasks)
+        progress=lib.log_manager.Progress(
+                len(self.units), print_prefix+'composite', self.unit_name)
+
+        # each task returns its own accumulator, reduced in the master
+        process_pool=Pool(processes=ntasks, initializer=_init, initargs=(progress,))
+        results=[process_pool.apply_async(run_mtsk, args=(
+            itsk, self.units[itsk*len_per_task:(itsk+1)*len_per_task], self, ))
+            for itsk in range(ntasks)]
+        process_pool.close()
+        process_pool.join()
+        acc=merge([res.get() for res in results])
+        progress.close()
+
+        self.write(acc)
+
+    def write(self, acc):
+        ''' write mean, variance (ddof=0) and count of each node '''
+        count=acc['count'].reshape((-1,1,1,1)).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean=acc['sum']/count
+            var=np.maximum(acc['sumsq']/count-mean*mean, 0.0)
+
+        shape=(self.n_nodex, self.n_nodey, len(self.varlist), self.nrow, self.ncol)
+        dims=['n_nodex','n_nodey','nvar','nrow','ncol']
+        ds_vars={
+                'comp_mean':(dims, mean.reshape(shape)),
+                'comp_var':(dims, var.reshape(shape)),
+                'count':(['n_nodex','n_nodey'], acc['count'].reshape(shape[:2]))}
+        if self.pipeline=='wrf':
+            ds_vars.update({
+                'xlat':(['nrow', 'ncol'], self.xlat),
+                'xlong':(['nrow', 'ncol'], self.xlong)})
+        else:
+            ds_vars.update({
+                'lat':(['nrow'], self.lat),
+                'lon':(['ncol'], self.lon)})
+
+        ds_out=xr.Dataset(data_vars=ds_vars, coords={'nvar':self.varlist},
+                attrs={'assignment':self.assign_fn, 'nrecords':int(acc['count'].sum())})
+        os.makedirs(os.path.dirname(self.out_fn), exist_ok=True)
+        ds_out.to_netcdf(self.out_fn)
+        utils.write_log('%s%d records composited into %s' % (
+            print_prefix, acc['count'].sum(), self.out_fn))
+
+def run_mtsk(itsk, units, comp_hdl):
+    """
+    accumulate the units of one task, return the accumulator
+    """
+    acc=new_acc(comp_hdl.nnodes, (len(comp_hdl.varlist), comp_hdl.nrow, comp_hdl.ncol))
+    for unit in units:
+        if comp_hdl.pipeline=='wrf':
+            fn, type_ids=unit
+            ncfile=nc4.Dataset(fn)
+            fields=np.stack([lib.preprocess_wrfinp.get_var_sub(ncfile, var, comp_hdl).values
+                for var in comp_hdl.varlist])[np.newaxis]
+            ncfile.close()
+        else:
+            month_ts, sub_ts, type_ids=unit
+            ds=lib.preprocess_erainp.get_mon_xr(comp_hdl.era_src, month_ts, sub_ts, comp_hdl)
+            fields=np.stack([ds[var].values for var in comp_hdl.varlist], axis=1)
+        accumulate(acc, type_ids, fields.astype(np.float64))
+        s_progress.update()
+    return acc
+
+def _init(progress):
+    """
+        Each pool process calls this initializer. Map the progress
+        meter into that process's global namespace
+    """
+    global s_progress
+    s_progress=progress
+
+def get_path(fn):
+    ''' paths relative to the Prism root '''
+    if os.path.isabs(fn):
+        return fn
+    return os.path.join(CWD, fn)
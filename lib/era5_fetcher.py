@@ -0,0 +1,223 @@
+#/usr/bin/env python
+"""
+ERA5 retrieval manager for the monthly training files
+
+Month requests (YYYYMM-surf.nc, YYYYMM-h500.nc) are queued and kept
+several in flight against the CDS, existing files are verified and
+skipped, failed requests are retried, and the progress is kept in
+era5_src/fetch_progress.json so that a restart resumes where it stopped.
+Retrievers of different groups running at once (getERA5-sl.py and
+getERA5-pl.py) share the progress file, records are merged under a
+file lock.
+
+    Classes:
+    -----------
+        ERA5Retriever: queue, retrieve and verify monthly ERA5 files
+
+    Functions:
+    -----------
+        month_request(yyyymm, group, area): CDS dataset and request
+        verify_file(fn, yyyymm, group): check vars and time steps of a file
+"""
+
+import os, json, time, fcntl, datetime, threading
+import pandas as pd
+import netCDF4 as nc4
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import utils
+
+try:
+    import cdsapi
+    HAS_CDSAPI=True
+except ImportError:
+    HAS_CDSAPI=False
+
+print_prefix='lib.era5_fetcher>>'
+
+# file group: CDS dataset, request items, variables in the file
+GROUPS={
+    'surf':('reanalysis-era5-single-levels', {
+        'variable':['10m_u_component_of_wind', '10m_v_component_of_wind',
+            'mean_sea_level_pressure']}, ['u10', 'v10', 'msl']),
+    'h500':('reanalysis-era5-pressure-levels', {
+        'pressure_level':['500'], 'variable':['geopotential']}, ['z'])}
+
+# 00/06/12/18 UTC
+STEPS_PER_DAY=4
+
+# the netCDF/HDF5 library is not thread-safe
+NC_LOCK=threading.Lock()
+
+def month_request(yyyymm, group, area):
+    ''' CDS dataset name and request of one month, area: N/W/S/E '''
+    dataset, items, varlist=GROUPS[group]
+    month=pd.Timestamp(yyyymm+'01')
+    req={
+        'product_type':'reanalysis',
+        'format':'netcdf',
+        'year':month.strftime('%Y'),
+        'month':month.strftime('%m'),
+        'day':['%02d' % dd for dd in range(1, month.days_in_month+1)],
+        'area':area,
+        'time':'00/to/23/by/6'}
+    req.update(items)
+    return dataset, req
+
+def verify_file(fn, yyyymm, group):
+    ''' True if fn holds the variables of group at all 6-hourly steps of the month '''
+    try:
+        with NC_LOCK, nc4.Dataset(fn) as ds:
+            tname='time' if 'time' in ds.dimensions else 'valid_time'
+            ntime=len(ds.dimensions[tname]) if tname in ds.dimensions else 0
+            has_vars=all(var in ds.variables for var in GROUPS[group][2])
+    except (OSError, ValueError):
+        return False
+    return has_vars and ntime==pd.Timestamp(yyyymm+'01').days_in_month*STEPS_PER_DAY
+
+class ERA5Retriever:
+
+    '''
+    Retrieve the monthly ERA5 files of a period into era5_src
+
+    Attributes
+    -----------
+    months, list of str, YYYYMM to retrieve
+    groups, list of str, file groups (surf, h500)
+    client_factory, func() returning a client with
+        retrieve(dataset, request, target), default cdsapi.Client
+    progress, dict, '<YYYYMM>-<group>' to status record
+
+    Methods
+    -----------
+    run(), retrieve all missing files, return the failed ones
+
+    '''
+
+    def __init__(self, cfg, groups=None, client_factory=None):
+        """ construct retriever from the TRAINING section """
+        self.era_src=cfg['TRAINING']['era5_src']
+        self.area=cfg['TRAINING'].get('era5_area', fallback='60/60/-10/170')
+        self.nrequests=int(cfg['TRAINING'].get('era5_nrequests', fallback='4'))
+        self.retries=int(cfg['TRAINING'].get('era5_retries', fallback='3'))
+        self.backoff=float(cfg['TRAINING'].get('era5_backoff', fallback='60'))
+
+        self.months=[ts.strftime('%Y%m') for ts in pd.date_range(
+            start=cfg['TRAINING'].get('era5_fetch_start', fallback='197901')+'01',
+            end=cfg['TRAINING'].get('era5_fetch_end', fallback='202012')+'01',
+            freq='MS')]
+        self.groups=groups or list(GROUPS)
+
+        if client_factory is None:
+            if not HAS_CDSAPI:
+                utils.throw_error(print_prefix, 'cdsapi is required to retrieve ERA5')
+            client_factory=cdsapi.Client
+        self.client_factory=client_factory
+        self._local=threading.local()
+
+        self.progress_fn=os.path.join(self.era_src, 'fetch_progress.json')
+        self._lock=threading.Lock()
+        self.progress=self._read_progress()
+
+    def get_fn(self, yyyymm, group):
+        ''' target file of one month '''
+        return os.path.join(self.era_src, yyyymm+'-'+group+'.nc')
+
+    def _read_progress(self):
+        ''' records of the progress file, empty if not written yet '''
+        if not os.path.exists(self.progress_fn):
+            return {}
+        with open(self.progress_fn) as f:
+            return json.load(f)
+
+    def _update(self, key, **kwargs):
+        '''
+        update and persist the record of key, the file is re-read and
+        merged under a file lock as other retrievers may write to it
+        '''
+        with self._lock, open(self.progress_fn+'.lock', 'a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            self.progress=self._read_progress()
+            self.progress.setdefault(key, {}).update(kwargs)
+            tmp_fn='%s.%d.tmp' % (self.progress_fn, os.getpid())
+            with open(tmp_fn, 'w') as f:
+                json.dump(self.progress, f, indent=1, sort_keys=True)
+            os.replace(tmp_fn, self.progress_fn)
+
+    def pending(self):
+        '''
+        (yyyymm, group) to retrieve, files recorded done with the same
+        size are trusted, other existing files are verified
+        '''
+        todo=[]
+        for yyyymm in self.months:
+            for group in self.groups:
+                fn=self.get_fn(yyyymm, group)
+                rec=self.progress.get(yyyymm+'-'+group, {})
+                if os.path.exists(fn):
+                    if rec.get('status')=='done' and rec.get('size')==os.path.getsize(fn):
+                        continue
+                    if verify_file(fn, yyyymm, group):
+                        self._update(yyyymm+'-'+group, status='done', size=os.path.getsize(fn))
+                        continue
+                    utils.write_log(print_prefix+fn+' incomplete, retrieve again', 30)
+                todo.append((yyyymm, group))
+        return todo
+
+    def run(self):
+        ''' retrieve all missing files, return [(yyyymm, group)] that failed '''
+        os.makedirs(self.era_src, exist_ok=True)
+        todo=self.pending()
+        utils.write_log('%s%d of %d monthly files to retrieve, %d requests in flight' % (
+            print_prefix, len(todo), len(self.months)*len(self.groups), self.nrequests))
+
+        failed=[]
+        with ThreadPoolExecutor(max_workers=self.nrequests) as pool:
+            futures={pool.submit(self.retrieve, yyyymm, group):(yyyymm, group)
+                    for yyyymm, group in todo}
+            for idone, fut in enumerate(as_completed(futures)):
+                yyyymm, group=futures[fut]
+                if fut.result():
+                    utils.write_log('%s%s-%s done (%d/%d)' % (
+                        print_prefix, yyyymm, group, idone+1, len(todo)))
+                else:
+                    failed.append((yyyymm, group))
+
+        if failed:
+            utils.write_log('%s%d files failed: %s' % (print_prefix, len(failed),
+                ', '.join(yyyymm+'-'+group for yyyymm, group in sorted(failed))), 30)
+        return failed
+
+    def retrieve(self, yyyymm, group):
+        '''
+        retrieve one month into a partial file, verified before it
+        replaces the target, return True on success
+        '''
+        key=yyyymm+'-'+group
+        fn=self.get_fn(yyyymm, group)
+        part_fn=fn+'.part'
+        dataset, req=month_request(yyyymm, group, self.area)
+
+        # one client per request thread
+        if not hasattr(self._local, 'client'):
+            self._local.client=self.client_factory()
+
+        for attempt in range(self.retries+1):
+            if attempt > 0:
+                time.sleep(self.backoff*2**(attempt-1))
+            self._update(key, status='running', attempts=attempt+1,
+                    time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            try:
+                self._local.client.retrieve(dataset, req, part_fn)
+                if not verify_file(part_fn, yyyymm, group):
+                    raise ValueError('verification failed')
+                os.replace(part_fn, fn)
+                self._update(key, status='done', size=os.path.getsize(fn), error=None)
+                return True
+            except Exception as err:
+                utils.write_log('%s%s attempt %d/%d: %s' % (
+                    print_prefix, key, attempt+1, self.retries+1, err), 30)
+                self._update(key, error=str(err))
+
+        self._update(key, status='failed')
+        return False
@@ -0,0 +1,270 @@
+#/usr/bin/env python
+"""
+Concurrent GFS fetcher, download from the NOMADS grib filter and
+convert to netCDF, in place of gidgat/gfs_slicer.sh
+
+Downloads run over a bounded pool of connections, an interrupted file
+is resumed by an HTTP Range request on retry, and each grib2 file is
+converted (ncl_convert2nc) as soon as it lands while other lead times
+are still downloading. Conversions run in a temporary directory and the
+netCDF file is moved in only on success, netCDF files left by an earlier
+run are checked before reuse. With gfs_fmt=grib2 the conversion is skipped and
+GFSMesh reads the grib2 files directly. Iterating the fetcher yields the
+lead times in the order they are ready, so GFSMesh can decode them on
+arrival.
+
+    Classes:
+    -----------
+        GFSFetcher: fetch and convert the lead times of one GFS cycle
+
+    Functions:
+    -----------
+        build_url(base_url, init_ts, lead, bounds): grib filter url
+"""
+
+import os, time, glob, shlex, shutil, datetime, tempfile, subprocess
+import http.client, urllib.request, urllib.error
+import netCDF4 as nc4
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import utils
+
+print_prefix='lib.gfs_fetcher>>'
+
+BASE_URL='https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl'
+LV_FILTER='&lev_500_mb=on&lev_10_m_above_ground=on&lev_mean_sea_level=on'
+VAR_FILTER='&var_HGT=on&var_PRMSL=on&var_UGRD=on&var_VGRD=on'
+
+# bytes per read of the response stream
+BLOCK=1<<16
+
+def build_url(base_url, init_ts, lead, bounds):
+    ''' grib filter url of one lead time, bounds=(lon_w, lon_e, lat_n, lat_s) '''
+    lon_w, lon_e, lat_n, lat_s=bounds
+    return (base_url
+        +'?file=gfs.t%sz.pgrb2.0p25.f%03d' % (init_ts.strftime('%H'), lead)
+        +LV_FILTER+VAR_FILTER
+        +'&subregion=&leftlon=%s&rightlon=%s&toplat=%s&bottomlat=%s' % (
+            lon_w, lon_e, lat_n, lat_s)
+        +'&dir=%%2Fgfs.%s%%2F%s%%2Fatmos' % (
+            init_ts.strftime('%Y%m%d'), init_ts.strftime('%H')))
+
+class GFSFetcher:
+
+    '''
+    Fetch and convert (gfs_fmt=nc) the lead times of one GFS cycle into gfs_src
+
+    Attributes
+    -----------
+    init_ts, datetime, forecast initial time
+    leads, list of int, lead hours 0..gfs_days*24 every gfs_frq hours
+    failed, list of int, lead hours given up after all retries
+
+    Methods
+    -----------
+    __iter__(), yield (ilead, fn) as each lead time is ready
+    fetch_all(), fetch all lead times, return the files by lead
+
+    '''
+
+    def __init__(self, cfg):
+        """ construct fetcher of the realtime cycle """
+        self.gfs_src=cfg['INFERENCE']['gfs_src']
+        self.base_url=cfg['INFERENCE'].get('gfs_url', fallback=BASE_URL)
+        self.nconn=int(cfg['INFERENCE'].get('gfs_nconn', fallback='4'))
+        self.nconvert=int(cfg['INFERENCE'].get('gfs_nconvert', fallback='2'))
+        self.retries=int(cfg['INFERENCE'].get('gfs_retries', fallback='3'))
+        self.backoff=float(cfg['INFERENCE'].get('gfs_backoff', fallback='5'))
+        self.timeout=float(cfg['INFERENCE'].get('gfs_timeout', fallback='60'))
+        self.converter=cfg['INFERENCE'].get('gfs_converter', fallback='ncl_convert2nc')
+        # grib2: files are read directly, no conversion
+        self.fmt=cfg['INFERENCE'].get('gfs_fmt', fallback='nc')
+
+        self.bounds=(cfg['SHARE']['s_we'], cfg['SHARE']['e_we'],
+                cfg['SHARE']['e_sn'], cfg['SHARE']['s_sn'])
+
+        today=datetime.datetime.now()-datetime.timedelta(
+                days=int(cfg['INFERENCE']['realtime_offsetday']))
+        self.init_ts=datetime.datetime.strptime(
+                today.strftime('%Y%m%d')+cfg['INFERENCE']['gfs_init'], '%Y%m%d%H')
+
+        frq=int(cfg['INFERENCE']['gfs_frq'])
+        self.leads=list(range(0, int(cfg['INFERENCE']['gfs_days'])*24+1, frq))
+        self.failed=[]
+
+    def get_fn(self, lead, ext=None):
+        ''' local file name of lead, ext: .grib2 or .nc, default the gfs_fmt file '''
+        if ext is None:
+            ext='.'+self.fmt
+        return os.path.join(self.gfs_src, 'gfs.t%sz.pgrb2.0p25.f%03d%s' % (
+            self.init_ts.strftime('%H'), lead, ext))
+
+    def _prepare(self):
+        '''
+            mark the cycle in gfs_src/init_time, files of another cycle
+            are removed, files of the same cycle are kept for a rerun
+        '''
+        os.makedirs(self.gfs_src, exist_ok=True)
+        init_fn=os.path.join(self.gfs_src, 'init_time')
+        init_str=self.init_ts.strftime('%Y%m%d%H')
+
+        same_cycle=False
+        if os.path.exists(init_fn):
+            with open(init_fn) as f:
+                same_cycle=(f.readline().strip()==init_str)
+        if not same_cycle:
+            for fn in glob.glob(os.path.join(self.gfs_src, 'gfs.t*z.pgrb2.0p25.f*')):
+                os.remove(fn)
+        # conversions killed in an earlier run
+        for tmp_dir in glob.glob(os.path.join(self.gfs_src, '.convert_*')):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with open(init_fn, 'w') as f:
+            f.write(init_str)
+
+    def __iter__(self):
+        ''' fetch and convert, yield (ilead, fn) in the order they are ready '''
+        self._prepare()
+        self.failed=[]
+        utils.write_log('%sfetch %d lead times of %s, %d connections' % (
+            print_prefix, len(self.leads), self.init_ts.strftime('%Y%m%d%H'), self.nconn))
+
+        ready=[]
+        with ThreadPoolExecutor(max_workers=self.nconn) as dl_pool, \
+                ThreadPoolExecutor(max_workers=self.nconvert) as cv_pool:
+            pending={}
+            for ilead, lead in enumerate(self.leads):
+                fn=self.get_fn(lead)
+                if os.path.exists(fn) and self.check(fn):
+                    ready.append((ilead, fn))
+                elif os.path.exists(self.get_fn(lead, '.grib2')):
+                    pending[cv_pool.submit(self.convert, self.get_fn(lead, '.grib2'))]=(
+                            'convert', ilead)
+                else:
+                    pending[dl_pool.submit(self.download, lead)]=('download', ilead)
+
+            # fetched in a previous run of this cycle
+            for item in ready:
+                yield item
+
+            while pending:
+                done, _=wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    stage, ilead=pending.pop(fut)
+                    lead=self.leads[ilead]
+                    try:
+                        fn=fut.result()
+                    except Exception as err:
+                        utils.write_log('%s%s f%03d failed: %s' % (
+                            print_prefix, stage, lead, err), 30)
+                        self.failed.append(lead)
+                        continue
+                    if stage=='download' and self.fmt=='nc':
+                        pending[cv_pool.submit(self.convert, fn)]=('convert', ilead)
+                    else:
+                        yield ilead, fn
+
+        if self.failed:
+            utils.write_log('%s%d lead times failed: %s' % (
+                print_prefix, len(self.failed), sorted(self.failed)), 30)
+
+    def fetch_all(self):
+        ''' fetch all lead times, return files in lead order (None if failed) '''
+        fn_list=[None]*len(self.leads)
+        for ilead, fn in self:
+            fn_list[ilead]=fn
+        return fn_list
+
+    def download(self, lead):
+        '''
+        download lead into its grib2 file, the partial file is kept
+        between attempts and resumed by a Range request
+        '''
+        url=build_url(self.base_url, self.init_ts, lead, self.bounds)
+        grib_fn=self.get_fn(lead, '.grib2')
+        part_fn=grib_fn+'.part'
+
+        for attempt in range(self.retries+1):
+            if attempt > 0:
+                time.sleep(self.backoff*2**(attempt-1))
+            try:
+                self._get(url, part_fn)
+                os.replace(part_fn, grib_fn)
+                utils.write_log('%sf%03d downloaded (%d bytes)' % (
+                    print_prefix, lead, os.path.getsize(grib_fn)))
+                return grib_fn
+            except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as err:
+                utils.write_log('%sf%03d attempt %d/%d: %s' % (
+                    print_prefix, lead, attempt+1, self.retries+1, err), 30)
+        raise IOError('gave up after %d attempts' % (self.retries+1))
+
+    def _get(self, url, part_fn):
+        ''' one request, append to part_fn from its current size if the server allows '''
+        offset=os.path.getsize(part_fn) if os.path.exists(part_fn) else 0
+        req=urllib.request.Request(url)
+        if offset > 0:
+            req.add_header('Range', 'bytes=%d-' % offset)
+
+        try:
+            resp=urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as err:
+            if err.code==416:
+                # nothing left beyond offset, restart from scratch
+                os.remove(part_fn)
+            raise
+
+        with resp:
+            if resp.status!=206:
+                # full body, range ignored
+                offset=0
+            mode='ab' if offset > 0 else 'wb'
+            length=resp.headers.get('Content-Length')
+            total=offset+int(length) if length is not None else -1
+            with open(part_fn, mode) as f:
+                while True:
+                    block=resp.read(BLOCK)
+                    if not block:
+                        break
+                    f.write(block)
+
+        size=os.path.getsize(part_fn)
+        if total >= 0 and size!=total:
+            raise ValueError('incomplete body, %d of %d bytes' % (size, total))
+        if size==0:
+            raise ValueError('empty body')
+
+    def check(self, fn):
+        '''
+        True if fn left by an earlier run is complete, a netCDF file is
+        opened and the end of each variable read, a broken one is removed
+        '''
+        if self.fmt!='nc':
+            # grib2 files are only moved in once fully downloaded
+            return os.path.getsize(fn) > 0
+        try:
+            with nc4.Dataset(fn) as nc:
+                for var in nc.variables.values():
+                    var[(slice(-1, None),)*var.ndim]
+            return True
+        except (OSError, RuntimeError, IndexError) as err:
+            utils.write_log('%sbroken %s removed: %s' % (print_prefix, fn, err), 30)
+            os.remove(fn)
+            return False
+
+    def convert(self, grib_fn):
+        '''
+        convert grib_fn to netCDF in a temporary directory of gfs_src,
+        move it in on success, return the netCDF file
+        '''
+        nc_fn=os.path.splitext(grib_fn)[0]+'.nc'
+        tmp_dir=tempfile.mkdtemp(prefix='.convert_', dir=self.gfs_src)
+        try:
+            subprocess.run(shlex.split(self.converter)+[grib_fn, '-o', tmp_dir],
+                    check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            tmp_fn=os.path.join(tmp_dir, os.path.basename(nc_fn))
+            if not os.path.exists(tmp_fn):
+                raise IOError(nc_fn+' not produced by '+self.converter)
+            os.replace(tmp_fn, nc_fn)
+        finally:
+            # partial output of a failed conversion goes with the directory
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return nc_fn
@@ -4,10 +4,11 @@ from utils import utils
 import lib
 
 import numpy as np
-import itertools, os, time
+import itertools, os, sys, time
 from multiprocessing import Pool, sharedctypes
 
 print_prefix='lib.grid_searcher>>'
+CWD=sys.path[0]
 
 class GridSearcher:
     '''
@@ -36,6 +37,21 @@ class GridSearcher:
             self.gs_nodexy=lib.cfgparser.cfg_get_varlist(cfg_hdl,'GRID_SEARCH','gs_nodexy')
             self.gs_nb_func=lib.cfgparser.cfg_get_varlist(cfg_hdl,'GRID_SEARCH','gs_nb_func')
             self.gs_iter=lib.cfgparser.cfg_get_varlist(cfg_hdl,'GRID_SEARCH','gs_iterations')
+            
+            # local pool, or broker serving combinations to workers on any host
+            self.gs_mode=cfg_hdl['GRID_SEARCH'].get('gs_mode', fallback='local')
+            if self.gs_mode=='broker':
+                self.gs_broker=lib.gs_broker.parse_address(
+                        cfg_hdl['GRID_SEARCH'].get('gs_broker', fallback='127.0.0.1:50000'))
+                self.gs_authkey=lib.gs_broker.get_authkey(cfg_hdl)
+                self.gs_local_workers=int(cfg_hdl['GRID_SEARCH'].get(
+                        'gs_local_workers', fallback='0'))
+                self.gs_cache=os.path.join(CWD, cfg_hdl['GRID_SEARCH'].get(
+                        'gs_cache', fallback='./db/gs_features.npy'))
+                self.gs_timeout=float(cfg_hdl['GRID_SEARCH'].get(
+                        'gs_timeout', fallback='300'))
+                self.gs_retries=int(cfg_hdl['GRID_SEARCH'].get(
+                        'gs_retries', fallback='1'))
         else:
             utils.write_log(print_prefix+'Single hyper-para comb, no need grid search...')
 
@@ -45,7 +61,6 @@ class GridSearcher:
         
         if self.gs_flag:
 
-            best_score=-1
             # all possible combs            
             comb=list(itertools.product(
                 self.gs_sigma,self.gs_lr,
@@ -55,58 +70,17 @@ class GridSearcher:
 
             utils.write_log(print_prefix+'Grid Search through '+str(num_comb)+' possible combinations...')
             
-            # ------Below for multitaks grid search with shared memory on training data----------
-            utils.write_log(print_prefix+'Multitask Grid Search with master process %s.' % os.getpid())
-            ntasks=self.nworkers
-            
-            # Initial shared data and delete prism attr refrence
-            # this is used for lowering copy overhead 
-            # in multiprocessing forking
-            train_data=prism.data
-            shared_data = create_share_type(train_data)
-            delattr(prism,'data')
-            
-            len_per_task=num_comb//ntasks
-            results=[]
-            
-            # start process pool
-            process_pool = Pool(processes=ntasks, 
-                    initializer=_init, initargs=(shared_data,))
-
-            # open tasks ID 0 to ntasks-2
-            for itsk in range(ntasks-1): 
-                icomb_lst=comb[itsk*len_per_task:(itsk+1)*len_per_task]
-                results.append(process_pool.apply_async(run_mtsk,
-                        args=(itsk, icomb_lst, prism, cfg, )))
-
-            # open ID ntasks-1 in case of residual
-            icomb_lst=comb[(ntasks-1)*len_per_task:]
-            results.append(process_pool.apply_async(run_mtsk, 
-                    args=(ntasks-1, icomb_lst, prism, cfg, )))
-
-            utils.write_log('Waiting for all subprocesses done...')
-            
-            # wait childs come
-            process_pool.close()
-            process_pool.join()
-
-           
-            # ------Upper for multitaks grid search with shared memory on training data----------
-            best_score=-1
-            best_idx=-1
-            
-            for idx, res in enumerate(results):
-                edic=res.get()
-                if edic['silhouette_score'] > best_score:
-                    best_score=edic['silhouette_score']
-                    best_idx=idx
-
-            best_edic=results[best_idx].get()
-            utils.write_log(print_prefix+'''All search done, best silhouette_score:'''+str(best_score)+', archiving model...')
-            prism.sigma, prism.lrate=best_edic['best_sigma'], best_edic['best_lrate']
-            prism.n_nodey, prism.nb_func=best_edic['best_1dnodey'], best_edic['best_nb_func']
-            prism.data=train_data             
-        
+            if self.gs_mode=='broker':
+                train_data=prism.data
+                delattr(prism,'data')
+                edic_list=lib.gs_broker.serve(
+                        prism, cfg, comb, train_data, self.gs_broker, 
+                        self.gs_authkey, self.gs_cache, nlocal=self.gs_local_workers,
+                        timeout=self.gs_timeout, retries=self.gs_retries)
+                self._set_best(prism, edic_list)
+                prism.data=train_data
+            else:
+                self._search_local(cfg, prism, comb)
         
         # execute for single run or for best grid search
         prism.train()
@@ -116,58 +90,93 @@ class GridSearcher:
             prism.edic.update({
                     'best_sigma':prism.sigma,
                     'best_lrate':prism.lrate,
+                    'best_1dnodex':prism.n_nodex,
                     'best_1dnodey':prism.n_nodey,
-                    'best_nb_func':prism.nb_func
+                    'best_nb_func':prism.nb_func,
+                    'best_iterations':prism.iterations
                     }) 
         # model archive
         prism.archive()
 
+    def _search_local(self, cfg, prism, comb):
+        """ grid search over a local process pool """
+        num_comb=len(comb)
+        
+        # ------Below for multitaks grid search with shared memory on training data----------
+        utils.write_log(print_prefix+'Multitask Grid Search with master process %s.' % os.getpid())
+        ntasks=self.nworkers
+        
+        # Initial shared data and delete prism attr refrence
+        # this is used for lowering copy overhead 
+        # in multiprocessing forking
+        train_data=prism.data
+        shared_data = create_share_type(train_data)
+        delattr(prism,'data')
+        
+        len_per_task=num_comb//ntasks
+        results=[]
+        progress=lib.log_manager.Progress(num_comb, print_prefix+'grid search', 'combinations')
+        
+        # start process pool
+        process_pool = Pool(processes=ntasks, 
+                initializer=_init, initargs=(shared_data, progress,))
+
+        # open tasks ID 0 to ntasks-2
+        for itsk in range(ntasks-1): 
+            icomb_lst=comb[itsk*len_per_task:(itsk+1)*len_per_task]
+            results.append(process_pool.apply_async(run_mtsk,
+                    args=(itsk, icomb_lst, prism, cfg, )))
+
+        # open ID ntasks-1 in case of residual
+        icomb_lst=comb[(ntasks-1)*len_per_task:]
+        results.append(process_pool.apply_async(run_mtsk, 
+                args=(ntasks-1, icomb_lst, prism, cfg, )))
+
+        utils.write_log('Waiting for all subprocesses done...')
+        
+        # wait childs come
+        process_pool.close()
+        process_pool.join()
+        progress.close()
+           
+        # ------Upper for multitaks grid search with shared memory on training data----------
+        self._set_best(prism, [res.get() for res in results])
+        prism.data=train_data             
+
+    def _set_best(self, prism, edic_list):
+        """ set prism hyper-parameters to the best of evaluated edics """
+        best_edic=max(edic_list, key=lambda edic: edic['silhouette_score'])
+        utils.write_log(print_prefix+'''All search done, best silhouette_score:'''+str(best_edic['silhouette_score'])+', archiving model...')
+        prism.sigma, prism.lrate=best_edic['best_sigma'], best_edic['best_lrate']
+        prism.n_nodex, prism.n_nodey=best_edic['best_1dnodex'], best_edic['best_1dnodey']
+        prism.nb_func, prism.iterations=best_edic['best_nb_func'], best_edic['best_iterations']
+
 def run_mtsk(itsk, comb, prism, cfg):
     """
     run grid search in multitasks!
     """
      
     start = time.time()
-    train_data = np.ctypeslib.as_array(s_data)
-    num_comb=len(comb)
+    train_data = np.ctypeslib.as_array(s_data).reshape((prism.nrec,-1))
     best_score=-1
 
-    for idx, itms in enumerate(comb):
-        
-        # assignment
-        prism.sigma, prism.lrate=float(itms[0]), float(itms[1])
-        prism.nb_func=itms[3]
-        prism.n_nodex= int(itms[2].split('x')[0])
-        prism.n_nodey= int(itms[2].split('x')[1])
-        prism.iterations=int(itms[4])
-
-        # debug output
-        utils.write_log('%sTASK[%02d]: Grid Search round: %04d/%04d' % (
-            print_prefix, itsk, idx+1, num_comb))
-        utils.write_log('''%sTASK[%02d]: Grid Search para combinations:
-                 sigma=%s, lrate=%s, nodexy=%s, 
-                 nb_func=%s, iterations=%s''' %(
-                    print_prefix, itsk, itms[0],itms[1], itms[2], 
-                    itms[3], itms[4]))
+    for itms in comb:
         
         # execute
-        prism.train(train_data=train_data, verbose=False)
-        prism.evaluate(cfg, train_data=train_data, verbose=False)
+        edic=run_comb(prism, cfg, itms, train_data)
+        s_progress.update()
         
         # store best model in this child process
-        curr_score=prism.edic['silhouette_score']
+        curr_score=edic['silhouette_score']
         if curr_score > best_score:
-            utils.write_log('%sTASK[%02d]: Grid Search Found best silhouette_score: %5.3f' % (
-                print_prefix, itsk, curr_score))
+            utils.write_log('''%sTASK[%02d]: Grid Search Found best silhouette_score: %5.3f
+                 sigma=%s, lrate=%s, nodexy=%s, 
+                 nb_func=%s, iterations=%s''' % (
+                    print_prefix, itsk, curr_score, itms[0], itms[1], itms[2], 
+                    itms[3], itms[4]))
             
             best_score=curr_score
-            best_edic=prism.edic
-            best_edic.update({
-                    'best_sigma':prism.sigma,
-                    'best_lrate':prism.lrate,
-                    'best_1dnodey':prism.n_nodey,
-                    'best_nb_func':prism.nb_func
-                    })  
+            best_edic=edic
 
     end = time.time()
     utils.write_log('%sTASK[%02d]: Grid Search Run completed with %0.3f seconds elapsed.' % (
@@ -175,20 +184,51 @@ def run_mtsk(itsk, comb, prism, cfg):
     
     return best_edic 
 
+def run_comb(prism, cfg, itms, train_data):
+    """ train and evaluate one hyper-parameter combination, return edic """
+    
+    # assignment
+    prism.sigma, prism.lrate=float(itms[0]), float(itms[1])
+    prism.nb_func=itms[3]
+    prism.n_nodex= int(itms[2].split('x')[0])
+    prism.n_nodey= int(itms[2].split('x')[1])
+    prism.iterations=int(itms[4])
+
+    prism.train(train_data=train_data, verbose=False)
+    prism.evaluate(cfg, train_data=train_data, verbose=False)
+    
+    edic=prism.edic
+    edic.update({
+            'best_sigma':prism.sigma,
+            'best_lrate':prism.lrate,
+            'best_1dnodex':prism.n_nodex,
+            'best_1dnodey':prism.n_nodey,
+            'best_nb_func':prism.nb_func,
+            'best_iterations':prism.iterations
+            })  
+    return edic
+
 def create_share_type(np_array):
     ''' create shared memory among processors with training data '''
     
+    # reuse the loader buffer if it already lives in shared memory
+    raw_buf=utils.get_shared_raw(np_array)
+    if raw_buf is not None:
+        return raw_buf
+
     np_carr = np.ctypeslib.as_ctypes(np_array)
     shared_array = sharedctypes.Array(np_carr._type_, np_carr, lock=True) 
     return shared_array
 
-def _init(shared_data):
+def _init(shared_data, progress):
     """ 
         Each pool process calls this initializer. Load the array
-        to be populated into that process's global namespace 
+        to be populated and the progress meter into that process's 
+        global namespace 
     """
-    global s_data
+    global s_data, s_progress
     s_data=shared_data
+    s_progress=progress
 
 
 
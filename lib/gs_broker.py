@@ -0,0 +1,297 @@
+#/usr/bin/env python3
+"""
+Work broker for distributed grid search
+
+The broker serves hyper-parameter combinations over TCP and collects
+the evaluation dicts, workers started on any host pull combinations,
+train and evaluate them on the feature cache, and push back metrics.
+Workers keep a heartbeat of the combination in hand, combinations of a
+worker that died (local process gone, or no heartbeat for timeout
+seconds) or that raised are requeued up to retries times, then dropped.
+
+    Functions:
+    -----------
+        serve(prism, cfg, comb, train_data, address, authkey, ...): run
+            the broker until all combinations are evaluated
+        run_worker(address, authkey, cache_fn): pull and evaluate
+            combinations until the broker is done
+        parse_address(addr_str): 'host:port' to (host, port)
+        get_authkey(cfg): gs_authkey, refused if unset or the default
+"""
+
+import os, sys, time, socket, queue, pickle, threading
+import numpy as np
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager, DictProxy
+
+import lib
+from utils import utils
+
+print_prefix='lib.gs_broker>>'
+CWD=sys.path[0]
+
+# workers unpickle the prism and cfg served by the broker, so the
+# broker only runs with a key of the user's own
+DEFAULT_AUTHKEY='prism'
+
+class _ServerManager(BaseManager):
+    ''' broker side manager, owns the queues '''
+    pass
+
+class _ClientManager(BaseManager):
+    ''' worker side manager, connects to the broker '''
+    pass
+
+for _name in ('get_jobs', 'get_results'):
+    _ClientManager.register(_name)
+for _name in ('get_meta', 'get_running'):
+    _ClientManager.register(_name, proxytype=DictProxy)
+
+def parse_address(addr_str):
+    ''' 'host:port' to (host, port) '''
+    host, port=addr_str.rsplit(':', 1)
+    return host, int(port)
+
+def get_authkey(cfg):
+    ''' gs_authkey of cfg as bytes, refused if unset or the old default '''
+    authkey=cfg['GRID_SEARCH'].get('gs_authkey', fallback='').strip()
+    if authkey in ('', DEFAULT_AUTHKEY):
+        utils.throw_error(print_prefix, 'set a secret GRID_SEARCH.gs_authkey '
+                'before broker mode, workers unpickle what the broker serves')
+    return authkey.encode()
+
+def serve(prism, cfg, comb, train_data, address, authkey, cache_fn,
+        nlocal=0, poll=5, timeout=300, retries=1):
+    '''
+    serve grid search combinations at address, with nlocal workers on
+    this host, return the evaluation dicts of the combinations that
+    succeeded, in the order of comb.
+
+    training data is written once to the feature cache cache_fn, which
+    workers on other hosts read from a shared path. A combination is
+    requeued if its worker raised, its local process died, or its
+    heartbeat stopped for timeout seconds, and dropped after retries
+    '''
+    utils.write_log(print_prefix+'write feature cache %s...' % cache_fn)
+    np.save(cache_fn, train_data)
+
+    # filled before the server process starts, workers connecting at
+    # once find the prism, cfg and all combinations in place
+    job_q, result_q, running=queue.Queue(), queue.Queue(), {}
+    meta={'prism':pickle.dumps(prism), 'cfg':pickle.dumps(cfg),
+        'cache':os.path.abspath(cache_fn), 'done':False}
+    for icomb, itms in enumerate(comb):
+        job_q.put((icomb, itms))
+    _ServerManager.register('get_jobs', callable=lambda: job_q)
+    _ServerManager.register('get_results', callable=lambda: result_q)
+    _ServerManager.register('get_meta', callable=lambda: meta, proxytype=DictProxy)
+    _ServerManager.register('get_running', callable=lambda: running, proxytype=DictProxy)
+
+    mgr=_ServerManager(address=address, authkey=authkey)
+    mgr.start()
+    utils.write_log(print_prefix+'broker serves %d combinations at %s:%d' % (
+        len(comb), address[0], address[1]))
+
+    jobs, results, shared_meta=mgr.get_jobs(), mgr.get_results(), mgr.get_meta()
+    running=mgr.get_running()
+
+    # local workers connect through the loopback if bound to all interfaces
+    local_addr=address
+    if address[0] in ('', '0.0.0.0'):
+        local_addr=('127.0.0.1', address[1])
+    workers=[_start_local(local_addr, authkey, poll) for ii in range(nlocal)]
+
+    # icomb to edic or error, attempts of each icomb,
+    # last heartbeat (count, broker time) of each worker
+    edic_dic, failed, tries, beats={}, {}, {}, {}
+    hosts=set()
+    last_change=time.time()
+    progress=lib.log_manager.Progress(len(comb), print_prefix+'grid search', 'combinations')
+
+    def retry(icomb, reason):
+        ''' requeue icomb, or drop it after retries '''
+        nonlocal last_change
+        if icomb in edic_dic or icomb in failed:
+            return
+        last_change=time.time()
+        tries[icomb]=tries.get(icomb, 0)+1
+        if tries[icomb] > retries:
+            failed[icomb]=reason
+            progress.update()
+            utils.write_log('%scombination %s dropped after %d attempts: %s' % (
+                print_prefix, str(comb[icomb]), tries[icomb], reason), 40)
+        else:
+            utils.write_log('%scombination %s requeued: %s' % (
+                print_prefix, str(comb[icomb]), reason), 30)
+            jobs.put((icomb, comb[icomb]))
+
+    while len(edic_dic)+len(failed) < len(comb):
+        try:
+            icomb, edic, wid=results.get(timeout=poll)
+        except queue.Empty:
+            workers=_check_workers(workers, running, beats, timeout, retry,
+                    local_addr, authkey, poll)
+            # a worker lost between pulling a job and its first heartbeat
+            # leaves nothing queued or running
+            if time.time()-last_change > timeout and jobs.qsize()==0 and len(running)==0:
+                for icomb in range(len(comb)):
+                    retry(icomb, 'lost without heartbeat')
+                last_change=time.time()
+            continue
+        last_change=time.time()
+        if 'error' in edic:
+            retry(icomb, 'worker %s raised %s' % (wid, edic['error']))
+            continue
+        if icomb in edic_dic or icomb in failed:
+            continue
+        edic_dic[icomb]=edic
+        hosts.add(wid.rsplit(':', 1)[0])
+        progress.update()
+    progress.close()
+    utils.write_log('%s%d combinations evaluated on %d hosts, %d failed' % (
+        print_prefix, len(edic_dic), len(hosts), len(failed)))
+
+    # workers leave once the job queue is drained and done is set
+    shared_meta['done']=True
+    for worker in workers:
+        worker.join()
+    mgr.shutdown()
+
+    if not edic_dic:
+        utils.throw_error(print_prefix, 'all %d combinations failed' % len(comb))
+    return [edic_dic[icomb] for icomb in range(len(comb)) if icomb in edic_dic]
+
+def _start_local(address, authkey, poll):
+    ''' start a worker process on this host '''
+    worker=Process(target=run_worker, args=(address, authkey, None, poll))
+    worker.start()
+    return worker
+
+def _check_workers(workers, running, beats, timeout, retry, address, authkey, poll):
+    '''
+    retry the combinations of dead local workers and of workers without
+    heartbeat for timeout seconds, restart dead local workers while
+    combinations are left, return the local workers
+    '''
+    now=time.time()
+    host=socket.gethostname()
+    dead=set()
+    for ii, worker in enumerate(workers):
+        if not worker.is_alive():
+            dead.add('%s:%d' % (host, worker.pid))
+            utils.write_log('%slocal worker %d exited with code %s, restart' % (
+                print_prefix, worker.pid, worker.exitcode), 30)
+            workers[ii]=_start_local(address, authkey, poll)
+
+    for wid, (icomb, count) in running.items():
+        # heartbeats are counted, not stamped, hosts may not share a clock
+        if beats.get(wid, (None,))[0]!=count:
+            beats[wid]=(count, now)
+        if wid in dead:
+            reason='local worker %s died' % wid
+        elif now-beats[wid][1] > timeout:
+            reason='no heartbeat from %s for %d seconds' % (wid, timeout)
+        else:
+            continue
+        running.pop(wid, None)
+        beats.pop(wid, None)
+        retry(icomb, reason)
+    return workers
+
+def run_worker(address, authkey, cache_fn=None, poll=5):
+    '''
+    pull combinations from the broker at address and push back the
+    evaluation dicts, cache_fn overrides the feature cache path if the
+    shared path is mounted elsewhere on this host
+    '''
+    host=socket.gethostname()
+    wid='%s:%d' % (host, os.getpid())
+    mgr=_ClientManager(address=address, authkey=authkey)
+    mgr.connect()
+    jobs, results, meta=mgr.get_jobs(), mgr.get_results(), mgr.get_meta()
+
+    prism=pickle.loads(meta.get('prism'))
+    cfg=pickle.loads(meta.get('cfg'))
+    train_data=np.load(cache_fn or meta.get('cache'), mmap_mode='r')
+    utils.write_log('%sworker %s joins, %d records in cache' % (
+        print_prefix, wid, train_data.shape[0]))
+    heartbeat=_Heartbeat(address, authkey, wid, poll)
+
+    ndone=0
+    while True:
+        try:
+            icomb, itms=jobs.get(timeout=poll)
+        except queue.Empty:
+            try:
+                if meta.get('done'):
+                    break
+            except (EOFError, ConnectionError):
+                break
+            continue
+        except (EOFError, ConnectionError):
+            # broker is gone
+            break
+
+        heartbeat.start_job(icomb)
+        try:
+            edic=lib.grid_searcher.run_comb(prism, cfg, itms, train_data)
+            ndone+=1
+        except Exception as err:
+            utils.write_log('%sworker %s failed on %s: %r' % (
+                print_prefix, wid, str(itms), err), 40)
+            edic={'error':repr(err)}
+        results.put((icomb, edic, wid))
+        heartbeat.end_job()
+
+    heartbeat.stop()
+    utils.write_log('%sworker %s leaves after %d combinations' % (
+        print_prefix, wid, ndone))
+
+class _Heartbeat:
+
+    '''
+    Thread counting up running[wid]=(icomb, count) every poll seconds
+    while a combination is in hand, on its own broker connection
+    '''
+
+    def __init__(self, address, authkey, wid, poll):
+        """ connect and start the heartbeat thread """
+        mgr=_ClientManager(address=address, authkey=authkey)
+        mgr.connect()
+        self.running=mgr.get_running()
+        self.wid, self.poll=wid, poll
+        self.icomb, self.count=None, 0
+        self._lock=threading.Lock()
+        self._stop=threading.Event()
+        self._thread=threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        with self._lock:
+            if self.icomb is not None:
+                self.count+=1
+                self.running[self.wid]=(self.icomb, self.count)
+
+    def _run(self):
+        while not self._stop.wait(self.poll):
+            try:
+                self._beat()
+            except (EOFError, ConnectionError):
+                break
+
+    def start_job(self, icomb):
+        ''' combination icomb in hand '''
+        with self._lock:
+            self.icomb=icomb
+        self._beat()
+
+    def end_job(self):
+        ''' combination done, its result is pushed '''
+        with self._lock:
+            self.icomb=None
+            self.running.pop(self.wid, None)
+
+    def stop(self):
+        ''' stop the heartbeat thread '''
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,175 @@
+#/usr/bin/env python
+"""
+History store of the training vectors, chunked by time and compressed
+
+    Functions:
+    -----------
+        write_hist(out_fn, data, dateseries, ...): write the history store
+        check_append(out_fn, data, dateseries): validate records before append
+        append_hist(out_fn, data, dateseries): append records to the store
+        append_index(out_fn, index): write (or rewrite) candidate indexes
+        open_hist(fn): open the history store lazily
+        iter_hist(hist_ds): iterate over the store by time chunks
+        to_hist_frame(arr, mean, std, hist_ds): re-express normalized 
+            vectors in the normalization frame of the store
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4 as nc4
+
+from utils import utils
+
+print_prefix='lib.hist_store>>'
+
+# int16 range kept for data, -32768 reserved for _FillValue
+INT16_MAX=32767
+
+def write_hist(out_fn, data, dateseries, dtype='float32', chunk=256, complevel=4,
+        mean=None, std=None):
+    '''
+    write the history store, data(ntimes, ngrids), ntimes is unlimited
+    so that records can be appended by model updates
+
+    dtype: float64, float32, or int16 (scaled by scale_factor/add_offset)
+    chunk: records per time chunk
+    complevel: zlib compression level, 0 for no compression
+    mean, std: flat normalization statistics of data, kept as the frame 
+        of the store while the model statistics drift with updates
+    '''
+    utils.write_log(print_prefix+'write history store %s (%s, chunk=%d)...' % (
+        out_fn, dtype, chunk))
+
+    nrec, ngrids=data.shape
+    enc={
+        'dtype':dtype,
+        'chunksizes':(min(chunk, nrec), ngrids),
+        'zlib':complevel>0,
+        'complevel':complevel,
+        'shuffle':True}
+
+    if dtype=='int16':
+        vmin, vmax=float(data.min()), float(data.max())
+        scale=(vmax-vmin)/(2*INT16_MAX)
+        if scale==0.0:
+            scale=1.0
+        enc.update({
+            'scale_factor':scale,
+            'add_offset':(vmax+vmin)/2.0,
+            '_FillValue':np.int16(-INT16_MAX-1)})
+    elif dtype not in ('float64', 'float32'):
+        utils.throw_error(print_prefix, 'unsupported hist_dtype: '+dtype)
+
+    ds_vars={'var_vector':(['ntimes','ngrids'], data)}
+    if mean is not None:
+        ds_vars.update({
+            'frame_mean':(['ngrids'], mean.reshape(-1)),
+            'frame_std':(['ngrids'], std.reshape(-1))})
+
+    ds_out=xr.Dataset(data_vars=ds_vars, coords={'ntimes':dateseries})
+    ds_out.to_netcdf(
+            out_fn, encoding={'var_vector':enc}, unlimited_dims=['ntimes'])
+
+def check_append(out_fn, data, dateseries):
+    '''
+    throw error if records data(nnew, ngrids) at dateseries can not be
+    appended to the store, nothing is written
+    '''
+    if not os.path.exists(out_fn):
+        utils.throw_error(print_prefix, 'history store %s not found, rebuild the model' % out_fn)
+    with nc4.Dataset(out_fn, 'r') as nc:
+        if not nc.dimensions['ntimes'].isunlimited():
+            utils.throw_error(print_prefix, 
+                    'history store %s is not appendable, rebuild the model' % out_fn)
+        ngrids=len(nc.dimensions['ngrids'])
+        tvar=nc['ntimes']
+        last=nc4.num2date(tvar[-1], tvar.units, 
+                calendar=getattr(tvar, 'calendar', 'standard')) if len(tvar) else None
+    
+    dateseries=pd.DatetimeIndex(dateseries)
+    if data.ndim!=2 or data.shape[1]!=ngrids:
+        utils.throw_error(print_prefix, 'records of shape %s do not match %d grids of %s' % (
+            str(data.shape), ngrids, out_fn))
+    if data.shape[0]!=len(dateseries) or data.shape[0]==0:
+        utils.throw_error(print_prefix, '%d records for %d times' % (
+            data.shape[0], len(dateseries)))
+    if not np.isfinite(data).all():
+        utils.throw_error(print_prefix, 'records hold non-finite values')
+    if not dateseries.is_monotonic_increasing or not dateseries.is_unique:
+        utils.throw_error(print_prefix, 'record times are not increasing')
+    if last is not None and dateseries[0] <= pd.Timestamp(str(last)):
+        utils.throw_error(print_prefix, 'records from %s overlap %s, archived up to %s' % (
+            dateseries[0], out_fn, last))
+
+def append_hist(out_fn, data, dateseries):
+    ''' append records data(nnew, ngrids), already in the store frame '''
+    utils.write_log(print_prefix+'append %d records to history store %s...' % (
+        data.shape[0], out_fn))
+
+    with nc4.Dataset(out_fn, 'a') as nc:
+        if not nc.dimensions['ntimes'].isunlimited():
+            utils.throw_error(print_prefix, 
+                    'history store %s is not appendable, rebuild the model' % out_fn)
+        
+        var, tvar=nc['var_vector'], nc['ntimes']
+        nrec=len(nc.dimensions['ntimes'])
+        
+        if var.dtype==np.int16:
+            # keep within the scaled range of the store
+            vmin=var.add_offset-var.scale_factor*INT16_MAX
+            vmax=var.add_offset+var.scale_factor*INT16_MAX
+            nclip=np.count_nonzero((data<vmin)|(data>vmax))
+            if nclip>0:
+                utils.write_log(print_prefix+'%d values clipped to the int16 range' % nclip, 30)
+                data=np.clip(data, vmin, vmax)
+
+        var[nrec:nrec+data.shape[0]]=data
+        tvar[nrec:nrec+data.shape[0]]=nc4.date2num(
+                pd.DatetimeIndex(dateseries).to_pydatetime(), 
+                tvar.units, calendar=getattr(tvar, 'calendar', 'standard'))
+
+def append_index(out_fn, index):
+    ''' 
+    write 1-d candidate index arrays (see lib.analog.build_index) to the 
+    store, per-record arrays share the ntimes dim and grow with appends,
+    existing arrays are overwritten
+    '''
+    with nc4.Dataset(out_fn, 'a') as nc:
+        for name, arr in index.items():
+            if name not in nc.variables:
+                if name.endswith('_offset'):
+                    dim='n'+name
+                    nc.createDimension(dim, len(arr))
+                else:
+                    dim='ntimes'
+                nc.createVariable(name, arr.dtype, (dim,))
+            nc[name][:]=arr
+
+def open_hist(fn):
+    ''' open the history store lazily, nothing is decoded until sliced '''
+    return xr.open_dataset(fn)
+
+def iter_hist(hist_ds, chunk=None):
+    ''' yield (start, values) of the history store by time chunks '''
+    da=hist_ds['var_vector']
+    if chunk is None:
+        chunk=da.encoding.get('chunksizes', (1024,))[0]
+    nrec=da.shape[0]
+    for start in range(0, nrec, chunk):
+        yield start, da[start:start+chunk].values
+
+def to_hist_frame(arr, mean, std, hist_ds):
+    ''' 
+    re-express vectors arr(n, ngrids) normalized by the flat (mean, std) 
+    in the frame of the store, arr is returned as is if the frames match
+    '''
+    if mean is None or 'frame_mean' not in hist_ds:
+        return arr
+    frame_mean=hist_ds['frame_mean'].values
+    frame_std=hist_ds['frame_std'].values
+    mean, std=mean.reshape(-1), std.reshape(-1)
+    if np.array_equal(mean, frame_mean) and np.array_equal(std, frame_std):
+        return arr
+    return (arr*std+(mean-frame_mean))/frame_std
@@ -0,0 +1,129 @@
+#/usr/bin/env python
+"""
+Multiprocess logging and progress meters
+
+Records of the master and all forked workers go through a QueueHandler
+on the root logger to one QueueListener thread in the master, which owns
+the handlers of conf/logging_config.ini, so the console and prism.log are
+written by a single writer. Per-file progress of loaders and grid search
+is counted in shared memory and logged as a throughput summary (rate,
+ETA) at most every INTERVAL seconds, instead of one line per file.
+
+    Classes:
+    -----------
+        Progress: shared counter with rate-limited throughput lines
+
+    Functions:
+    -----------
+        setup(config_fn): route the records of all processes to one writer
+        shutdown(): flush and stop the writer
+        set_interval(interval): seconds between progress lines
+"""
+
+import time, atexit, datetime
+import logging, logging.config, logging.handlers
+import multiprocessing
+
+from utils import utils
+
+print_prefix='lib.log_manager>>'
+
+# seconds between progress lines
+INTERVAL=10.0
+
+_listener=None
+
+def setup(config_fn):
+    '''
+    configure logging by config_fn, the configured root handlers are
+    moved behind a QueueListener and replaced by one QueueHandler,
+    workers forked later inherit the handler and send records to the queue
+    '''
+    global _listener
+    logging.config.fileConfig(config_fn)
+    if _listener is not None:
+        _listener.stop()
+
+    root=logging.getLogger()
+    handlers=root.handlers[:]
+    for hdl in handlers:
+        root.removeHandler(hdl)
+
+    log_q=multiprocessing.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(log_q))
+    _listener=logging.handlers.QueueListener(
+            log_q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    ''' write the queued records and stop the writer thread '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for hdl in _listener.handlers:
+            hdl.flush()
+        _listener=None
+
+def set_interval(interval):
+    ''' seconds between progress lines '''
+    global INTERVAL
+    INTERVAL=float(interval)
+
+class Progress:
+
+    '''
+    Progress meter shared by forked workers, the counter lives in shared
+    memory so the meter is handed to pool workers by inheritance (pool
+    initializer), not as a task argument
+
+    Attributes
+    -----------
+    total, int, number of items
+    name, str, prefix of the progress lines
+    unit, str, item unit in the progress lines
+
+    Methods
+    -----------
+    update(n), count n done items, log a line if INTERVAL has passed
+    close(), log the final summary
+
+    '''
+
+    def __init__(self, total, name, unit='files'):
+        """ construct meter, interval is taken from INTERVAL """
+        self.total=total
+        self.name=name
+        self.unit=unit
+        self.interval=INTERVAL
+        self.start=time.time()
+        self._count=multiprocessing.Value('q', 0)
+        self._last=multiprocessing.Value('d', self.start, lock=False)
+
+    def update(self, n=1):
+        ''' count n done items, at most one line per interval among all processes '''
+        with self._count.get_lock():
+            self._count.value+=n
+            count=self._count.value
+            now=time.time()
+            if now-self._last.value < self.interval:
+                return
+            self._last.value=now
+        self._report(count, now)
+
+    def _report(self, count, now):
+        ''' log count/total, rate and ETA '''
+        elapsed=max(now-self.start, 1e-6)
+        rate=count/elapsed
+        eta=(self.total-count)/rate if rate > 0 else 0.0
+        utils.write_log('%s: %d/%d %s (%.1f%%), %.2f %s/s, ETA %s' % (
+            self.name, count, self.total, self.unit, 100.0*count/max(self.total, 1),
+            rate, self.unit, datetime.timedelta(seconds=round(eta))))
+
+    def close(self):
+        ''' log the final summary '''
+        elapsed=time.time()-self.start
+        count=self._count.value
+        utils.write_log('%s: %d/%d %s in %.1f seconds, %.2f %s/s' % (
+            self.name, count, self.total, self.unit, elapsed,
+            count/max(elapsed, 1e-6), self.unit))
@@ -0,0 +1,151 @@
+#/usr/bin/env python
+"""
+Thread-based prefetching reader backend for netCDF loading
+
+A compute pool decodes the units from their paths, at most depth units
+in flight. Decoders keep their hyperslab reads and no file body is held
+in or pickled from the master process. With warm on, I/O threads first
+read the whole files of the next units into the page cache, bounded in
+file bytes (max_bytes) so they are still cached when decoded. Warming
+reads every byte of a file, leave it off when decoders read subsets
+(strided or windowed hyperslabs) from a shared filesystem.
+
+    Classes:
+    -----------
+        PrefetchReader: bounded prefetch queue, I/O threads + compute pool
+
+    Functions:
+    -----------
+        unit_bytes(fn_list): size of the files in one unit
+        warm_unit(fn_list): read the files of one unit into the page cache
+        stream_to_buffer(reader, varlist, offsets, buf): fill output buffer
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import lib
+from utils import utils
+
+print_prefix='lib.prefetch_reader>>'
+
+# bytes per read of the I/O threads
+BLOCK=1<<20
+
+class PrefetchReader:
+
+    '''
+    Bounded prefetch reader. A compute pool decodes units by path
+    (wrf.getvar, interpolation, hyperslab selection), optionally after
+    I/O threads read their files into the page cache, completed units
+    are yielded as soon as they are decoded, not necessarily in order.
+
+    Attributes
+    -----------
+    units, list of file lists, each unit is read and decoded as one task
+    decode_func, func(idx, fn_list, *decode_args) in compute pool
+    nio, int, number of I/O threads, keep small on shared filesystems
+    nworkers, int, number of compute processes
+    depth, int, max number of units being read or decoded at once
+    max_bytes, int, max file bytes of the units being read or decoded,
+        one unit is always let through
+    warm, bool, read whole files into the page cache before decoding
+
+    Methods
+    -----------
+    __iter__(), yield (idx, decoded) pairs as they complete
+
+    '''
+
+    def __init__(self, units, decode_func, decode_args=(),
+            nio=2, nworkers=4, depth=8, max_bytes=1<<30, warm=False):
+        """ construct prefetch reader """
+        self.units=units
+        self.decode_func=decode_func
+        self.decode_args=decode_args
+        self.nio=nio
+        self.nworkers=nworkers
+        # at least one unit per worker in flight
+        self.depth=max(depth, nworkers)
+        self.max_bytes=max_bytes
+        self.warm=warm
+
+        if self.warm:
+            utils.write_log('%sPrefetch reader with %d I/O threads, %d workers, depth %d, %d MB' % (
+                print_prefix, self.nio, self.nworkers, self.depth, self.max_bytes//1024**2))
+        else:
+            utils.write_log('%sPrefetch reader with %d workers, depth %d, no warming' % (
+                print_prefix, self.nworkers, self.depth))
+
+    def __iter__(self):
+        """ yield (idx, decoded) pairs as they complete """
+        nunits=len(self.units)
+        next_unit=0
+        reads, decodes, nbytes={}, {}, {}
+
+        with ThreadPoolExecutor(max_workers=self.nio) as io_pool, \
+                ProcessPoolExecutor(max_workers=self.nworkers) as cpu_pool:
+
+            while next_unit < nunits or reads or decodes:
+
+                # keep the prefetch queue filled up to depth and max_bytes
+                while next_unit < nunits and len(reads)+len(decodes) < self.depth:
+                    if not self.warm:
+                        # decoders read their hyperslabs straight from the files
+                        decodes[cpu_pool.submit(
+                            self.decode_func, next_unit, self.units[next_unit],
+                            *self.decode_args)]=next_unit
+                        next_unit+=1
+                        continue
+                    size=unit_bytes(self.units[next_unit])
+                    if nbytes and sum(nbytes.values())+size > self.max_bytes:
+                        break
+                    fut=io_pool.submit(warm_unit, self.units[next_unit])
+                    reads[fut]=next_unit
+                    nbytes[next_unit]=size
+                    next_unit+=1
+
+                done, _=wait(
+                        list(reads)+list(decodes), return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    if fut in reads:
+                        # files cached, hand the paths over to compute pool
+                        idx=reads.pop(fut)
+                        fut.result()
+                        decodes[cpu_pool.submit(
+                            self.decode_func, idx, self.units[idx],
+                            *self.decode_args)]=idx
+                    else:
+                        idx=decodes.pop(fut)
+                        nbytes.pop(idx, None)
+                        yield idx, fut.result()
+
+def unit_bytes(fn_list):
+    """ size of all files in one unit """
+    return sum(os.path.getsize(fn) for fn in fn_list)
+
+def warm_unit(fn_list):
+    """ read all files in one unit into the page cache, nothing is kept """
+    block=bytearray(BLOCK)
+    for fn in fn_list:
+        with open(fn, 'rb', buffering=0) as f:
+            while f.readinto(block):
+                pass
+
+def stream_to_buffer(reader, varlist, offsets, buf):
+    '''
+    stream decoded units into the output buffer buf(nrec, nvar, nrow, ncol)
+
+    each decoded unit is a xr.Dataset with leading dim 'time',
+    unit idx is written to records [offsets[idx], offsets[idx]+ntime)
+    '''
+    progress=lib.log_manager.Progress(len(offsets), print_prefix+'decoded', 'units')
+
+    for idx, ds in reader:
+        off=offsets[idx]
+        for ivar, var in enumerate(varlist):
+            buf[off:off+ds.sizes['time'], ivar]=ds[var].values
+        progress.update()
+    progress.close()
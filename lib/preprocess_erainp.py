@@ -38,6 +38,16 @@ class ERAMesh:
         self.ntasks=int(cfg['SHARE']['ntasks'])
         self.varlist=['u10','v10','msl', 'z']
         self.dsmp_interval=int(cfg['SHARE']['dsmp_interval'])
+        
+        # reader backend: pool (static split) or prefetch (I/O threads + compute pool)
+        self.io_backend=cfg['SHARE'].get('io_backend', fallback='pool')
+        self.io_threads=int(cfg['SHARE'].get('io_threads', fallback='2'))
+        self.prefetch_depth=int(cfg['SHARE'].get('prefetch_depth', fallback='8'))
+        self.prefetch_mb=int(cfg['SHARE'].get('prefetch_mb', fallback='1024'))
+        self.prefetch_warm=cfg['SHARE'].getboolean('prefetch_warm', fallback=False)
+        
+        # monthly files resolved by the source catalog, None for era5_src/YYYYMM-*.nc
+        self.fn_dic=None
 
         self.s_sn, self.e_sn = int(cfg['SHARE']['s_sn']),int(cfg['SHARE']['e_sn'])
         self.s_we, self.e_we = int(cfg['SHARE']['s_we']),int(cfg['SHARE']['e_we'])
@@ -52,6 +62,11 @@ class ERAMesh:
                     start=timestamp_start, end=timestamp_end, freq='6H')
 
             self.dateseries=self._pick_date_frame(cfg, all_dateseries)
+            if cfg['SHARE'].getboolean('use_catalog', fallback=False):
+                catalog=lib.source_catalog.load_catalog(cfg, 'era5')
+                self.dateseries, self.fn_dic=lib.source_catalog.lookup_monthly(
+                        catalog, self.dateseries, 
+                        sorted({get_var_group(var) for var in self.varlist}), 'era5 months')
         
         elif call_from=='inference':
             fn_stream=subprocess.check_output(
@@ -91,15 +106,8 @@ class ERAMesh:
 
     def load_data(self):
         ''' load datasets '''
-        era_src=self.era_src
         init_ts=self.dateseries[0] 
-        
         varlist=self.varlist
-        ntasks=self.ntasks
-        da_dic={}
-       
-        # let's do the multiprocessing magic!
-        utils.write_log(print_prefix+'Multiprocessing initiated. Master process %s.' % os.getpid())
 
         # get monthly frq list (align with file convention)
         curr_yyyymm=init_ts.strftime('%Y%m')
@@ -109,12 +117,55 @@ class ERAMesh:
                 curr_yyyymm=itime.strftime('%Y%m')
                 file_yyyymm.append(itime)
         
+        # record offset of each month in the output buffer
+        offsets=[]
+        off=0
+        for its_yyyymm in file_yyyymm:
+            offsets.append(off)
+            off+=len(get_sub_ts(self.dateseries, its_yyyymm))
+        
+        # read the first file for metadata
+        utils.write_log(print_prefix+'Read first file for metadata')
+        with xr.open_dataset(get_var_fn(self.era_src, init_ts, varlist[0], self.fn_dic)) as ds:
+            ds_sub=ds.sel(
+                latitude=slice(self.e_sn,self.s_sn),
+                longitude=slice(self.s_we, self.e_we))
+            self.lon=ds_sub['longitude'].values
+            self.lat=ds_sub['latitude'].values
+        
+        # shape
+        self.nrec=off
+        self.nrow=len(self.lat)
+        self.ncol=len(self.lon)
+        
+        # loaders fill one contiguous (nrec, nvar*nrow*ncol) buffer,
+        # which is adopted by prism without copy
+        shape=(self.nrec, len(varlist), self.nrow, self.ncol)
+        raw_buf, buf=utils.create_shared_buffer(shape)
+        
+        if self.io_backend=='prefetch':
+            self._load_prefetch(file_yyyymm, offsets, buf)
+        else:
+            self._load_pool(file_yyyymm, offsets, raw_buf, shape)
+        
+        self.data=buf.reshape((self.nrec,-1))
+        self.varlist=varlist
+
+    def _load_pool(self, file_yyyymm, offsets, raw_buf, shape):
+        ''' load datasets by static split over a process pool '''
+        ntasks=self.ntasks
+       
+        # let's do the multiprocessing magic!
+        utils.write_log(print_prefix+'Multiprocessing initiated. Master process %s.' % os.getpid())
+
         len_file=len(file_yyyymm)
         len_per_task=len_file//ntasks
         results=[]
+        progress=lib.log_manager.Progress(len_file, print_prefix+'read', 'months')
         
-        # start process pool
-        process_pool = Pool(processes=ntasks)
+        # start process pool, workers write into the shared buffer
+        process_pool = Pool(processes=ntasks, 
+                initializer=_init, initargs=(raw_buf, shape, progress,))
         
         # open tasks ID 0 to ntasks-2
         for itsk in range(ntasks-1):  
@@ -123,7 +174,7 @@ class ERAMesh:
             
             result=process_pool.apply_async(
                 run_mtsk, 
-                args=(itsk, ifile_yyyymm, da_dic, self, ))
+                args=(itsk, ifile_yyyymm, offsets[itsk*len_per_task], self, ))
             results.append(result)
 
         # open ID ntasks-1 in case of residual
@@ -131,7 +182,7 @@ class ERAMesh:
 
         result=process_pool.apply_async(
             run_mtsk, 
-            args=(ntasks-1, ifile_yyyymm, da_dic, self, ))
+            args=(ntasks-1, ifile_yyyymm, offsets[(ntasks-1)*len_per_task], self, ))
 
         results.append(result)
         utils.write_log(print_prefix+'Waiting for all subprocesses done...')
@@ -139,91 +190,107 @@ class ERAMesh:
         process_pool.close()
         process_pool.join()
         
-        # reorg da_dict
+        # raise exceptions from subprocesses if any
+        for res in results:
+            res.get()
+        progress.close()
 
-        for idx, res in enumerate(results):
-            if idx==0:
-                da_dic=res.get()
-            else:
-                for var in varlist:
-                    da_dic[var]=xr.concat(
-                        [da_dic[var], res.get()[var]], dim='time') 
-        
-       
+    def _load_prefetch(self, file_yyyymm, offsets, buf):
+        ''' load datasets by the prefetching reader backend '''
+        utils.write_log(print_prefix+'Prefetch reader initiated. Master process %s.' % os.getpid())
         
-        self.data_dic = da_dic 
-        self.varlist=varlist
+        units=[]
+        for its_yyyymm in file_yyyymm:
+            fn_list=[]
+            for var in self.varlist:
+                nc_fn=get_var_fn(self.era_src, its_yyyymm, var, self.fn_dic)
+                if nc_fn not in fn_list:
+                    fn_list.append(nc_fn)
+            units.append(fn_list)
+
+        reader=lib.prefetch_reader.PrefetchReader(
+                units, decode_mem, (file_yyyymm, self,), nio=self.io_threads, 
+                nworkers=self.ntasks, depth=self.prefetch_depth, 
+                max_bytes=self.prefetch_mb*1024**2, warm=self.prefetch_warm)
         
-        # shape
-        temp_var=da_dic[varlist[0]]
-        shp=temp_var.shape
-        self.nrec=shp[0]
-        self.nrow=shp[1]
-        self.ncol=shp[2]
-        self.lon=temp_var['longitude'].values
-        self.lat=temp_var['latitude'].values
-
-def run_mtsk(itsk, file_yyyymm, da_dic, era_hdl):
+        lib.prefetch_reader.stream_to_buffer(
+                reader, self.varlist, offsets, buf)
+
+def run_mtsk(itsk, file_yyyymm, rec0, era_hdl):
     """
-    multitask read file
+    multitask read file, write records from rec0 on into shared buffer
     """
     era_src=era_hdl.era_src
     varlist=era_hdl.varlist
 
     all_ts=era_hdl.dateseries
 
-    len_files=len(file_yyyymm)
-    da_dic={}
-    
+    off=rec0
     
-    # read the first file in the list
-    its_yyyymm=file_yyyymm[0]
-    sub_ts=get_sub_ts(all_ts, its_yyyymm)
-    
-    utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (
-        print_prefix, itsk, 0,(len_files-1), its_yyyymm.strftime('%Y-%m')))
+    for its_yyyymm in file_yyyymm:
+        sub_ts=get_sub_ts(all_ts, its_yyyymm)
+        ds=get_mon_xr(era_src, its_yyyymm, sub_ts, era_hdl)
+        for ivar, var in enumerate(varlist):
+            s_buf[off:off+len(sub_ts), ivar]=ds[var].values
+        off+=len(sub_ts)
+        s_progress.update()
     
-    for var in varlist:
-        var_temp=get_var_xr(era_src,its_yyyymm,var)
-        
-        da_dic[var]=var_temp.sel(
-                time=sub_ts,
-                latitude=slice(era_hdl.e_sn,era_hdl.s_sn),
-                longitude=slice(era_hdl.s_we, era_hdl.e_we))
+    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
+
+def _init(raw_buf, shape, progress):
+    """ 
+        Each pool process calls this initializer. Map the shared 
+        output buffer and progress meter into that process's global namespace 
+    """
+    global s_buf, s_progress
+    s_buf=np.frombuffer(raw_buf, dtype=np.float64).reshape(shape)
+    s_progress=progress
+
+def decode_mem(idx, fn_list, file_yyyymm, era_hdl):
+    """
+    decode one month of prefetched files in the prefetch compute pool
+    """
+    its_yyyymm=file_yyyymm[idx]
+    sub_ts=get_sub_ts(era_hdl.dateseries, its_yyyymm)
+    return get_mon_xr(era_hdl.era_src, its_yyyymm, sub_ts, era_hdl)
+
+def get_mon_xr(src, ts, sub_ts, era_hdl):
+    ''' 
+        read all vars of one month, each monthly file is opened 
+        lazily once and only sub_ts and the lat/lon window are decoded
+    '''
     
-    # read the rest files in the list
-    for idx, its_yyyymm in enumerate(file_yyyymm[1:]):
-        
-        utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (
-            print_prefix, itsk, (idx+1), (len_files-1),its_yyyymm.strftime('%Y-%m')))
-        
-        sub_ts=get_sub_ts(all_ts, its_yyyymm)
-        
-        for var in varlist:
-            var_temp=get_var_xr(era_src,its_yyyymm,var)
-            var_temp=var_temp.sel(
+    # group vars by their source file
+    fn_dic={}
+    for var in era_hdl.varlist:
+        fn_dic.setdefault(get_var_fn(src, ts, var, era_hdl.fn_dic), []).append(var)
+
+    ds_list=[]
+    for nc_fn, fn_vars in fn_dic.items():
+        with xr.open_dataset(nc_fn) as ds:
+            ds_list.append(ds[fn_vars].sel(
                 time=sub_ts,
                 latitude=slice(era_hdl.e_sn,era_hdl.s_sn),
-                longitude=slice(era_hdl.s_we, era_hdl.e_we))
-            
-            da_dic[var]=xr.concat([da_dic[var],var_temp], dim='time')
-    
-    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
+                longitude=slice(era_hdl.s_we, era_hdl.e_we)).load())
     
-    return da_dic
+    return xr.merge(ds_list)
 
-def get_var_xr(src, ts, var):
-    ''' retrun var xr obj according to var name'''
+def get_var_fn(src, ts, var, fn_dic=None):
+    ''' 
+        retrun monthly file name according to var name,
+        looked up in the catalog fn_dic if given
+    '''
+    group=get_var_group(var)
+    if fn_dic is not None:
+        return fn_dic[(ts.strftime('%Y%m'), group)]
     
+    return src+'/'+ts.strftime('%Y%m')+'-'+group+'.nc'
+
+def get_var_group(var):
+    ''' monthly file group of var: h500 or surf '''
     if var=='z':
-        nc_fn=src+'/'+ts.strftime('%Y%m')+'-h500.nc'
-    else:
-        nc_fn=src+'/'+ts.strftime('%Y%m')+'-surf.nc'
-    
-    da=xr.load_dataset(nc_fn)
-    var_xr=da[var]
-   
-    return var_xr
+        return 'h500'
+    return 'surf'
 
 
 def get_varlist(cfg):
@@ -1,5 +1,12 @@
 #/usr/bin/env python
-"""Preprocessing the GFS input file"""
+"""
+Preprocessing the GFS input file
+
+Forecast files are read either as netCDF converted by ncl_convert2nc
+(gfs_fmt=nc) or directly as GRIB2 (gfs_fmt=grib2) by eccodes, or by
+cfgrib if eccodes is not installed. Fields are mapped to the canonical
+names of the ERA5 mesh (u10, v10, msl, z).
+"""
 
 import datetime
 import numpy as np
@@ -11,9 +18,37 @@ from multiprocessing import Pool
 import lib
 from utils import utils
 
+try:
+    import eccodes
+    HAS_ECCODES=True
+except ImportError:
+    HAS_ECCODES=False
+
+try:
+    import cfgrib
+    HAS_CFGRIB=True
+except ImportError:
+    HAS_CFGRIB=False
+
 print_prefix='lib.preprocess_gfsinp>>'
 CWD=sys.path[0]
 G=9.81
+
+# canonical names, in the order of the ERA5 mesh
+VARLIST=['u10','v10','msl','z']
+
+# ncl_convert2nc names to canonical names
+NC_VARS={
+    'UGRD_P0_L103_GLL0':'u10', 'VGRD_P0_L103_GLL0':'v10',
+    'PRMSL_P0_L101_GLL0':'msl', 'HGT_P0_L100_GLL0':'z'}
+
+# grib (shortName, typeOfLevel, level) to canonical names
+GRIB_VARS={
+    ('10u', 'heightAboveGround', 10):'u10',
+    ('10v', 'heightAboveGround', 10):'v10',
+    ('prmsl', 'meanSea', 0):'msl',
+    ('gh', 'isobaricInhPa', 500):'z'}
+
 class GFSMesh:
 
     '''
@@ -27,8 +62,11 @@ class GFSMesh:
     
     '''
     
-    def __init__(self, cfg, call_from='training'):
-        """ construct input wrf file names """
+    def __init__(self, cfg, call_from='training', fetcher=None):
+        """ 
+        construct input gfs file names, with a lib.gfs_fetcher.GFSFetcher 
+        the files are decoded as they are fetched 
+        """
         utils.write_log(print_prefix+'Init gfs_mesh obj...')
         utils.write_log(print_prefix+'Read input files...')
         
@@ -39,30 +77,56 @@ class GFSMesh:
         self.gfs_days=cfg['INFERENCE']['gfs_days']
 
         self.ntasks=int(cfg['SHARE']['ntasks'])
-        self.varlist=[
-                'UGRD_P0_L103_GLL0','VGRD_P0_L103_GLL0',
-                'PRMSL_P0_L101_GLL0', 'HGT_P0_L100_GLL0']
+        self.varlist=VARLIST
+        
+        # forecast file format: nc (converted) or grib2 (read directly)
+        self.gfs_fmt=cfg['INFERENCE'].get('gfs_fmt', fallback='nc')
+        self.grib_backend=None
+        if self.gfs_fmt=='grib2':
+            self.grib_backend=get_grib_backend()
+        elif self.gfs_fmt!='nc':
+            utils.throw_error(print_prefix, 'unknown gfs_fmt: '+self.gfs_fmt)
 
         self.dsmp_interval=int(cfg['SHARE']['dsmp_interval'])
+        
+        # reader backend: pool (static split) or prefetch (I/O threads + compute pool)
+        self.io_backend=cfg['SHARE'].get('io_backend', fallback='pool')
+        self.io_threads=int(cfg['SHARE'].get('io_threads', fallback='2'))
+        self.prefetch_depth=int(cfg['SHARE'].get('prefetch_depth', fallback='8'))
+        self.prefetch_mb=int(cfg['SHARE'].get('prefetch_mb', fallback='1024'))
+        self.prefetch_warm=cfg['SHARE'].getboolean('prefetch_warm', fallback=False)
 
         self.s_sn, self.e_sn = int(cfg['SHARE']['s_sn']),int(cfg['SHARE']['e_sn'])
         self.s_we, self.e_we = int(cfg['SHARE']['s_we']),int(cfg['SHARE']['e_we'])
         
         # ---read timestamp file
-        with open(self.gfs_src+'init_time','r') as f:
-            self.fc_init_ts=datetime.datetime.strptime(f.readline(),'%Y%m%d%H')
+        if fetcher is not None:
+            self.fc_init_ts=fetcher.init_ts
+        else:
+            with open(self.gfs_src+'init_time','r') as f:
+                self.fc_init_ts=datetime.datetime.strptime(f.readline(),'%Y%m%d%H')
 
-        # ---loop fcst files
-        fn_stream=subprocess.check_output(
-                'ls '+self.gfs_src+'gfs*nc', shell=True).decode('utf-8')
-        fn_list=fn_stream.split()
-       
-        self.fn_list=fn_list
-        
         self.dateseries=pd.date_range(
                 start=self.fc_init_ts, 
                 periods=int(self.gfs_days)*24/int(self.gfs_frq)+1, 
                 freq=self.gfs_frq+'H')
+
+        # ---loop fcst files
+        if fetcher is not None:
+            self.load_stream(fetcher)
+            return
+        
+        if cfg['SHARE'].getboolean('use_catalog', fallback=False):
+            # files by lead time, missing leads are skipped
+            catalog=lib.source_catalog.scan_gfs(
+                    self.gfs_src, self.fc_init_ts, self.gfs_fmt)
+            self.dateseries, self.fn_list=lib.source_catalog.lookup(
+                    catalog, self.dateseries, 'gfs lead times', hint=False)
+        else:
+            fn_stream=subprocess.check_output(
+                    'ls '+self.gfs_src+'gfs*'+self.gfs_fmt, shell=True).decode('utf-8')
+            self.fn_list=fn_stream.split()
+        
         self.load_data()
     
     def _pick_date_frame(self, cfg, all_dates):
@@ -87,24 +151,102 @@ class GFSMesh:
 
     def load_data(self):
         ''' load datasets '''
-        fn_list=self.fn_list
-        init_ts=self.dateseries[0] 
-        
         varlist=self.varlist
+        
+        # read the first file for metadata, lat is in north-south 
+        # order in all loaded fields to align with ERA5 convention 
+        utils.write_log(print_prefix+'Read first file for metadata')
+        self.lat, self.lon=get_fc_grid(self.fn_list[0], self)
+        
+        # shape
+        self.nrec=len(self.fn_list)
+        self.nrow=len(self.lat)
+        self.ncol=len(self.lon)
+        
+        # loaders fill one contiguous (nrec, nvar*nrow*ncol) buffer,
+        # which is adopted by prism without copy
+        shape=(self.nrec, len(varlist), self.nrow, self.ncol)
+        raw_buf, buf=utils.create_shared_buffer(shape)
+        
+        if self.io_backend=='prefetch':
+            self._load_prefetch(buf)
+        else:
+            self._load_pool(raw_buf, shape)
+       
+        self.data=buf.reshape((self.nrec,-1))
+        self.varlist=varlist
+
+    def load_stream(self, fetcher):
+        ''' 
+            decode forecast files in the compute pool as the fetcher
+            lands them, lead times that failed to fetch are skipped 
+        '''
+        utils.write_log(print_prefix+'Stream reader initiated. Master process %s.' % os.getpid())
+        nlead=len(self.dateseries)
+        self.fn_list=[None]*nlead
+        buf=None
+        progress=lib.log_manager.Progress(nlead, print_prefix+'fetch and read', 'leads')
+        
+        # workers are forked before the fetcher starts its threads
+        process_pool=Pool(processes=self.ntasks)
+        results={}
+        for ilead, fn in fetcher:
+            self.fn_list[ilead]=fn
+            results[ilead]=process_pool.apply_async(
+                    get_fc_xr, args=(fn, self.dateseries[ilead], self))
+            # fill decoded leads while the others are fetched
+            for jlead in [jlead for jlead, res in results.items() if res.ready()]:
+                buf=self._fill_lead(buf, jlead, results.pop(jlead).get())
+                progress.update()
+        for jlead, res in results.items():
+            buf=self._fill_lead(buf, jlead, res.get())
+            progress.update()
+        process_pool.close()
+        process_pool.join()
+        progress.close()
+        
+        found=np.array([fn is not None for fn in self.fn_list])
+        if not found.any():
+            utils.throw_error(print_prefix, 'no gfs file fetched')
+        if not found.all():
+            lib.source_catalog.report_missing(
+                    self.dateseries[~found], nlead, 'gfs lead times', hint=False)
+            buf=buf[found]
+            self.dateseries=self.dateseries[found]
+            self.fn_list=[fn for fn in self.fn_list if fn is not None]
+        
+        self.nrec=len(self.fn_list)
+        self.data=buf.reshape((self.nrec,-1))
+
+    def _fill_lead(self, buf, ilead, ds):
+        ''' write decoded lead ilead into buf, buf and grid info are set up by the first one '''
+        if buf is None:
+            self.lon=ds['lon'].values
+            self.lat=ds['lat'].values
+            self.nrow, self.ncol=len(self.lat), len(self.lon)
+            raw_buf, buf=utils.create_shared_buffer(
+                    (len(self.dateseries), len(self.varlist), self.nrow, self.ncol))
+        for ivar, var in enumerate(self.varlist):
+            buf[ilead, ivar]=ds[var].values
+        return buf
+
+    def _load_pool(self, raw_buf, shape):
+        ''' load datasets by static split over a process pool '''
+        fn_list=self.fn_list
         ntasks=self.ntasks
-        da_dic={}
        
         # let's do the multiprocessing magic!
         utils.write_log(print_prefix+'Multiprocessing initiated. Master process %s.' % os.getpid())
 
-       
         len_file=len(fn_list)
         len_per_task=len_file//ntasks
         
         results=[]
+        progress=lib.log_manager.Progress(len_file, print_prefix+'read')
         
-        # start process pool
-        process_pool = Pool(processes=ntasks)
+        # start process pool, workers write into the shared buffer
+        process_pool = Pool(processes=ntasks, 
+                initializer=_init, initargs=(raw_buf, shape, progress,))
         
         # open tasks ID 0 to ntasks-2
         for itsk in range(ntasks-1):  
@@ -115,7 +257,7 @@ class GFSMesh:
             
             result=process_pool.apply_async(
                 run_mtsk, 
-                args=(itsk, sub_list, sub_ts, da_dic, self, ))
+                args=(itsk, sub_list, sub_ts, itsk*len_per_task, self, ))
             results.append(result)
 
         # open ID ntasks-1 in case of residual
@@ -124,7 +266,7 @@ class GFSMesh:
 
         result=process_pool.apply_async(
             run_mtsk, 
-            args=(ntasks-1, sub_list, sub_ts, da_dic, self, ))
+            args=(ntasks-1, sub_list, sub_ts, (ntasks-1)*len_per_task, self, ))
 
         results.append(result)
         utils.write_log(print_prefix+'Waiting for all subprocesses done...')
@@ -132,82 +274,188 @@ class GFSMesh:
         process_pool.close()
         process_pool.join()
         
-        
-        # reorg da_dict
+        # raise exceptions from subprocesses if any
+        for res in results:
+            res.get()
+        progress.close()
 
-        for idx, res in enumerate(results):
-            if idx==0:
-                da_dic=res.get()
-            else:
-                for var in varlist:
-                    da_dic[var]=xr.concat(
-                        [da_dic[var], res.get()[var]], dim='time') 
-       
-        self.data_dic = da_dic 
-        self.varlist=varlist
+    def _load_prefetch(self, buf):
+        ''' load datasets by the prefetching reader backend '''
+        utils.write_log(print_prefix+'Prefetch reader initiated. Master process %s.' % os.getpid())
+        units=[[full_fn] for full_fn in self.fn_list]
         
-        # shape
-        temp_var=da_dic[varlist[0]]
-        shp=temp_var.shape
-        self.nrec=shp[0]
-        self.nrow=shp[1]
-        self.ncol=shp[2]
-        self.lon=temp_var['lon_0'].values
-        self.lat=temp_var['lat_0'].values
-
-def run_mtsk(itsk, sub_list, sub_ts, da_dic, gfs_hdl):
+        reader=lib.prefetch_reader.PrefetchReader(
+                units, decode_mem, (self,), nio=self.io_threads, 
+                nworkers=self.ntasks, depth=self.prefetch_depth, 
+                max_bytes=self.prefetch_mb*1024**2, warm=self.prefetch_warm)
+        
+        lib.prefetch_reader.stream_to_buffer(
+                reader, self.varlist, list(range(len(units))), buf)
+
+def run_mtsk(itsk, sub_list, sub_ts, rec0, gfs_hdl):
     """
-    multitask read file
+    multitask read file, write records from rec0 on into shared buffer
     """
 
     varlist=gfs_hdl.varlist
 
-
-    len_files=len(sub_list)
-    da_dic={}
+    for idx, full_fn in enumerate(sub_list):
+        ds=get_fc_xr(full_fn, sub_ts[idx], gfs_hdl)
+        for ivar, var in enumerate(varlist):
+            s_buf[rec0+idx, ivar]=ds[var].values
+        s_progress.update()
     
+    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
 
-    # get fn: gfs.t00z.pgrb2.0p25.f000.nc
-    fn=sub_list[0].split('/')[-1]
-    
-    utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (
-        print_prefix, itsk, 0,(len_files-1), fn))
+def _init(raw_buf, shape, progress):
+    """ 
+        Each pool process calls this initializer. Map the shared 
+        output buffer and progress meter into that process's global namespace 
+    """
+    global s_buf, s_progress
+    s_buf=np.frombuffer(raw_buf, dtype=np.float64).reshape(shape)
+    s_progress=progress
 
-    for var in varlist:
-        var_temp=get_var_xr(sub_list[0], sub_ts[0], var)
-        
-        da_dic[var]=var_temp.sel(
-                lat_0=slice(gfs_hdl.s_sn,gfs_hdl.e_sn),
-                lon_0=slice(gfs_hdl.s_we, gfs_hdl.e_we))
-    # read the rest files in the list
-    for idx, full_fn in enumerate(sub_list[1:]):
-        
-        fn=full_fn.split('/')[-1]
-        
-        utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (
-            print_prefix, itsk, (idx+1), (len_files-1), fn))
-        
-        for var in varlist:
-            var_temp=get_var_xr(full_fn, sub_ts[idx+1],var)
-            var_temp=var_temp.sel(
+def decode_mem(idx, fn_list, gfs_hdl):
+    """
+    decode one prefetched forecast file in the prefetch compute pool
+    """
+    return get_fc_xr(fn_list[0], gfs_hdl.dateseries[idx], gfs_hdl).expand_dims('time')
+
+def get_fc_xr(src, ts, gfs_hdl):
+    ''' 
+        read all vars from one forecast file in a single pass,
+        only the lat/lon hyperslab is decoded, return canonical
+        vars on (lat, lon) with lat in north-south order
+    '''
+    if gfs_hdl.gfs_fmt=='grib2':
+        return get_fc_grib(src, ts, gfs_hdl)
+
+    with xr.open_dataset(src) as ds:
+        ds_sub=ds[list(NC_VARS)].sel(
                 lat_0=slice(gfs_hdl.s_sn,gfs_hdl.e_sn),
-                lon_0=slice(gfs_hdl.s_we, gfs_hdl.e_we))
-            
-            da_dic[var]=xr.concat([da_dic[var],var_temp], dim='time')
-    
-    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
+                lon_0=slice(gfs_hdl.s_we, gfs_hdl.e_we)).load()
+    ds_sub=ds_sub.rename(dict(NC_VARS, lat_0='lat', lon_0='lon'))
     
     # convert gpm to m^2/s^2
-    da_dic['HGT_P0_L100_GLL0']=G*da_dic['HGT_P0_L100_GLL0']
-    return da_dic
+    ds_sub['z']=G*ds_sub['z']
+    # flip lat to north-south order
+    ds_sub=ds_sub.isel(lat=slice(None,None,-1)).assign_coords(time=ts)
+    
+    return ds_sub
+
+def get_fc_grid(src, gfs_hdl):
+    ''' (lat, lon) of the hyperslab in one forecast file, lat in north-south order '''
+    if gfs_hdl.gfs_fmt=='grib2':
+        ds=get_fc_grib(src, None, gfs_hdl)
+        return ds['lat'].values, ds['lon'].values
+    with xr.open_dataset(src) as ds:
+        ds_sub=ds.sel(
+            lat_0=slice(gfs_hdl.s_sn,gfs_hdl.e_sn),
+            lon_0=slice(gfs_hdl.s_we, gfs_hdl.e_we))
+        return ds_sub['lat_0'].values[::-1], ds_sub['lon_0'].values
+
+def get_grib_backend():
+    ''' grib2 decoder: eccodes if installed, else cfgrib '''
+    if HAS_ECCODES:
+        return 'eccodes'
+    if HAS_CFGRIB:
+        return 'cfgrib'
+    utils.throw_error(print_prefix, 'gfs_fmt=grib2 requires eccodes or cfgrib')
+
+def get_fc_grib(src, ts, gfs_hdl):
+    '''
+        read the canonical vars from one grib2 forecast file, other
+        messages are skipped undecoded
+    '''
+    if gfs_hdl.grib_backend=='cfgrib':
+        fields, lat, lon=_read_cfgrib(src, gfs_hdl)
+    else:
+        fields, lat, lon=_read_eccodes(src, gfs_hdl)
 
-def get_var_xr(src, ts, var):
-    ''' retrun var xr obj according to var name'''
+    miss=[var for var in VARLIST if var not in fields]
+    if miss:
+        raise ValueError('%s not found in %s' % (miss, src))
     
-    da=xr.load_dataset(src)
-    var_xr=da[var]
-    var_xr['time']=ts
-    return var_xr
+    # convert gpm to m^2/s^2
+    fields['z']=G*fields['z']
+    ds=xr.Dataset({var:(['lat','lon'], fields[var]) for var in VARLIST},
+            coords={'lat':lat, 'lon':lon})
+    if ts is not None:
+        ds=ds.assign_coords(time=ts)
+    return ds
+
+def _read_eccodes(src, gfs_hdl):
+    '''
+    decode the canonical fields by eccodes, return (fields, lat, lon),
+    messages are scanned by their headers (data sections are skipped),
+    only the matched ones are read again in full and unpacked. GRIB
+    packing has no partial decode, the lat/lon window is cut from the
+    unpacked field (the grib filter of gfs_fetcher already subsets the
+    region, so matched messages are small)
+    '''
+    fields, lat, lon={}, None, None
+    with open(src, 'rb') as f:
+        while len(fields) < len(GRIB_VARS):
+            pos=f.tell()
+            gid=eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if gid is None:
+                break
+            try:
+                key=(eccodes.codes_get(gid, 'shortName'),
+                        eccodes.codes_get(gid, 'typeOfLevel'),
+                        eccodes.codes_get(gid, 'level'))
+            finally:
+                eccodes.codes_release(gid)
+            if key not in GRIB_VARS or GRIB_VARS[key] in fields:
+                continue
+
+            end=f.tell()
+            f.seek(pos)
+            gid=eccodes.codes_grib_new_from_file(f)
+            try:
+                ni, nj=eccodes.codes_get(gid, 'Ni'), eccodes.codes_get(gid, 'Nj')
+                lat0=eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
+                lon0=eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees')
+                dlat=eccodes.codes_get(gid, 'jDirectionIncrementInDegrees')
+                dlon=eccodes.codes_get(gid, 'iDirectionIncrementInDegrees')
+                if eccodes.codes_get(gid, 'jScansPositively')==0:
+                    dlat=-dlat
+                if eccodes.codes_get(gid, 'iScansNegatively')==1:
+                    dlon=-dlon
+                values=eccodes.codes_get_values(gid).reshape(nj, ni)
+            finally:
+                eccodes.codes_release(gid)
+            f.seek(end)
+
+            # north-south, west-east order
+            glat=np.round(lat0+dlat*np.arange(nj), 6)
+            glon=np.round(lon0+dlon*np.arange(ni), 6)
+            if dlat > 0:
+                glat, values=glat[::-1], values[::-1]
+            if dlon < 0:
+                glon, values=glon[::-1], values[:,::-1]
+            ilat=(glat >= gfs_hdl.s_sn) & (glat <= gfs_hdl.e_sn)
+            ilon=(glon >= gfs_hdl.s_we) & (glon <= gfs_hdl.e_we)
+            fields[GRIB_VARS[key]]=values[ilat][:,ilon].astype(np.float64)
+            lat, lon=glat[ilat], glon[ilon]
+    return fields, lat, lon
+
+def _read_cfgrib(src, gfs_hdl):
+    ''' decode the canonical fields by cfgrib, return (fields, lat, lon) '''
+    fields, lat, lon={}, None, None
+    for (short_name, level_type, level), var in GRIB_VARS.items():
+        with xr.open_dataset(src, engine='cfgrib', backend_kwargs={
+                'indexpath':'', 'filter_by_keys':{
+                    'shortName':short_name, 'typeOfLevel':level_type, 'level':level}}) as ds:
+            if not ds.data_vars:
+                continue
+            da=ds[list(ds.data_vars)[0]].sortby('latitude', ascending=False).sel(
+                    latitude=slice(gfs_hdl.e_sn, gfs_hdl.s_sn),
+                    longitude=slice(gfs_hdl.s_we, gfs_hdl.e_we)).load()
+        fields[var]=da.values.astype(np.float64)
+        lat, lon=da['latitude'].values, da['longitude'].values
+    return fields, lat, lon
 
 
 def get_varlist(cfg):
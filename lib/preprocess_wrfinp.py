@@ -40,6 +40,16 @@ class WrfMesh:
         self.ntasks=int(cfg['SHARE']['ntasks'])
         self.varlist=lib.cfgparser.cfg_get_varlist(cfg,'SHARE','var')
         self.dsmp_interval=int(cfg['SHARE']['dsmp_interval'])
+        
+        # reader backend: pool (static split) or prefetch (I/O threads + compute pool)
+        self.io_backend=cfg['SHARE'].get('io_backend', fallback='pool')
+        self.io_threads=int(cfg['SHARE'].get('io_threads', fallback='2'))
+        self.prefetch_depth=int(cfg['SHARE'].get('prefetch_depth', fallback='8'))
+        self.prefetch_mb=int(cfg['SHARE'].get('prefetch_mb', fallback='1024'))
+        self.prefetch_warm=cfg['SHARE'].getboolean('prefetch_warm', fallback=False)
+        
+        # read source files in place through the source catalog
+        self.use_catalog=cfg['SHARE'].getboolean('use_catalog', fallback=False)
 
         self.s_sn, self.e_sn = int(cfg['SHARE']['s_sn']),int(cfg['SHARE']['e_sn'])
         self.s_we, self.e_we = int(cfg['SHARE']['s_we']),int(cfg['SHARE']['e_we'])
@@ -60,6 +70,18 @@ class WrfMesh:
                     start=timestamp_start, end=timestamp_end, freq='H')
 
             self.dateseries=self._pick_date_frame(cfg, all_dateseries)
+            if self.use_catalog:
+                catalog=lib.source_catalog.load_catalog(cfg, 'wrf')
+                self.dateseries, self.fn_list=lib.source_catalog.lookup(
+                        catalog, self.dateseries, 'wrfout_d01 times')
+
+        elif call_from=='inference' and self.use_catalog:
+            src_wrfpath, run_df=lib.source_catalog.realtime_run(cfg)
+            if cfg['INFERENCE'].getboolean('debug_mode'):
+                utils.write_log(print_prefix+'Debug mode turns on!')
+                run_df=run_df.iloc[:self.ntasks]
+            self.dateseries=pd.DatetimeIndex(run_df['valid_time'])
+            self.fn_list=run_df['path'].tolist()
 
         elif call_from=='inference':
             fn_stream=subprocess.check_output(
@@ -74,6 +96,11 @@ class WrfMesh:
             timestamp_start=datetime.datetime.strptime(start_basename[11:],'%Y-%m-%d_%H:%M:%S')
             timestamp_end=datetime.datetime.strptime(end_basename[11:],'%Y-%m-%d_%H:%M:%S')
             self.dateseries=pd.date_range(start=timestamp_start, end=timestamp_end, freq='H')
+        
+        if not self.use_catalog:
+            # files linked into the input dir
+            self.fn_list=[self.nc_fn_base+'wrfout_d01_'+datestamp.strftime('%Y-%m-%d_%H:%M:%S')
+                    for datestamp in self.dateseries]
     
         self.load_data()
     
@@ -99,122 +126,156 @@ class WrfMesh:
 
     def load_data(self):
         ''' load datasets '''
-        nc_fn_base=self.nc_fn_base
-        datestamp=self.dateseries[0] 
         varlist=self.varlist
+        
+        # ------global info
+        # -------read the first file to fill data structure
+        nc_fn=self.fn_list[0]
+        utils.write_log(print_prefix+'Read first file for metadata')
+        
+        ncfile=nc4.Dataset(nc_fn)
+        # lats lons on mass and staggered grids
+        self.xlat=get_var_sub(ncfile, 'XLAT', self)
+        self.xlong=get_var_sub(ncfile, 'XLONG', self)
+
+        ncfile.close()
+        
+        # shape
+        self.nrec=len(self.dateseries)
+        self.nrow, self.ncol=self.xlat.shape
+        
+        # loaders fill one contiguous (nrec, nvar*nrow*ncol) buffer,
+        # which is adopted by prism without copy
+        shape=(self.nrec, len(varlist), self.nrow, self.ncol)
+        raw_buf, buf=utils.create_shared_buffer(shape)
+        
+        if self.io_backend=='prefetch':
+            self._load_prefetch(buf)
+        else:
+            self._load_pool(raw_buf, shape)
+        
+        self.data=buf.reshape((self.nrec,-1))
+        self.varlist=varlist
+
+    def _load_pool(self, raw_buf, shape):
+        ''' load datasets by static split over a process pool '''
         ntasks=self.ntasks
-        da_dic={}
        
         # let's do the multiprocessing magic!
         utils.write_log(print_prefix+'Multiprocessing initiated. Master process %s.' % os.getpid())
         file_dates=self.dateseries
+        fn_list=self.fn_list
         len_file=len(file_dates)
         len_per_task=len_file//ntasks
         results=[]
+        progress=lib.log_manager.Progress(len_file, print_prefix+'read')
         
-        # start process pool
-        process_pool = Pool(processes=ntasks)
+        # start process pool, workers write into the shared buffer
+        process_pool = Pool(processes=ntasks, 
+                initializer=_init, initargs=(raw_buf, shape, progress,))
         
         # open tasks ID 0 to ntasks-2
         for itsk in range(ntasks-1):  
             
             ifile_dates=file_dates[itsk*len_per_task:(itsk+1)*len_per_task]
+            sub_list=fn_list[itsk*len_per_task:(itsk+1)*len_per_task]
             
             result=process_pool.apply_async(
                 run_mtsk, 
-                args=(itsk, ifile_dates, da_dic, self, ))
+                args=(itsk, ifile_dates, sub_list, itsk*len_per_task, self, ))
             results.append(result)
 
         # open ID ntasks-1 in case of residual
         ifile_dates=file_dates[(ntasks-1)*len_per_task:]
+        sub_list=fn_list[(ntasks-1)*len_per_task:]
 
         result=process_pool.apply_async(
             run_mtsk, 
-            args=(ntasks-1, ifile_dates, da_dic, self, ))
-
+            args=(ntasks-1, ifile_dates, sub_list, (ntasks-1)*len_per_task, self, ))
         results.append(result)
+
         utils.write_log(print_prefix+'Waiting for all subprocesses done...')
         
         process_pool.close()
         process_pool.join()
         
-        # reorg da_dict
+        # raise exceptions from subprocesses if any
+        for res in results:
+            res.get()
+        progress.close()
 
-        for idx, res in enumerate(results):
-            if idx==0:
-                da_dic=res.get()
-            else:
-                for var in varlist:
-                    da_dic[var]=xr.concat(
-                        [da_dic[var], res.get()[var]], dim='time') 
-        
-        # ------global info
-        # -------read the first file to fill data structure
-        nc_fn=nc_fn_base+'wrfout_d01_'+datestamp.strftime('%Y-%m-%d_%H:%M:%S')
-        utils.write_log(print_prefix+'Read first file for metadata')
+    def _load_prefetch(self, buf):
+        ''' load datasets by the prefetching reader backend '''
+        utils.write_log(print_prefix+'Prefetch reader initiated. Master process %s.' % os.getpid())
+        units=[[nc_fn] for nc_fn in self.fn_list]
         
-        ncfile=nc4.Dataset(nc_fn)
-        # lats lons on mass and staggered grids
-        self.xlat=wrf.getvar(ncfile,'XLAT').isel(
-                south_north=self.sn_range,
-                west_east=self.we_range)
-
-        self.xlong=wrf.getvar(ncfile,'XLONG').isel(
-                south_north=self.sn_range,
-                west_east=self.we_range)
-
-        ncfile.close()
-       
-
+        reader=lib.prefetch_reader.PrefetchReader(
+                units, decode_mem, (self,), nio=self.io_threads, 
+                nworkers=self.ntasks, depth=self.prefetch_depth, 
+                max_bytes=self.prefetch_mb*1024**2, warm=self.prefetch_warm)
         
-        self.data_dic = da_dic 
-        self.varlist=varlist
-        # shape
-        shp=self.data_dic[varlist[0]].shape
-        self.nrec=shp[0]
-        self.nrow=shp[1]
-        self.ncol=shp[2]
+        lib.prefetch_reader.stream_to_buffer(
+                reader, self.varlist, list(range(len(units))), buf)
 
-def run_mtsk(itsk, file_dates, da_dic, wrf_hdl):
+def run_mtsk(itsk, file_dates, sub_list, rec0, wrf_hdl):
     """
-    multitask read file
+    multitask read file, write records from rec0 on into shared buffer
     """
-    nc_fn_base=wrf_hdl.nc_fn_base
     varlist=wrf_hdl.varlist
-    len_files=len(file_dates)
-    da_dic={}
     
-    # read the first file in the list
-    datestamp=file_dates[0]
-    nc_fn=nc_fn_base+'wrfout_d01_'+datestamp.strftime('%Y-%m-%d_%H:%M:%S')
-    utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (print_prefix, itsk, 0,(len_files-1), nc_fn))
+    for idx, nc_fn in enumerate(sub_list):
+        ncfile=nc4.Dataset(nc_fn)
+        for ivar, var in enumerate(varlist):
+            s_buf[rec0+idx, ivar]=get_var_sub(ncfile, var, wrf_hdl).values
+        ncfile.close()
+        s_progress.update()
     
-    ncfile=nc4.Dataset(nc_fn)
-    for var in varlist:
-        var_temp=get_var_xr(ncfile,var)
-        da_dic[var]=var_temp.isel(
-                south_north=wrf_hdl.sn_range,
-                west_east=wrf_hdl.we_range)
+    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
+
+def _init(raw_buf, shape, progress):
+    """ 
+        Each pool process calls this initializer. Map the shared 
+        output buffer and progress meter into that process's global namespace 
+    """
+    global s_buf, s_progress
+    s_buf=np.frombuffer(raw_buf, dtype=np.float64).reshape(shape)
+    s_progress=progress
+
+def decode_mem(idx, fn_list, wrf_hdl):
+    """
+    decode one prefetched wrfout file in the prefetch compute pool
+    """
+    ncfile=nc4.Dataset(fn_list[0])
+    ds=xr.Dataset({var:(('time','south_north','west_east'), 
+        get_var_sub(ncfile, var, wrf_hdl).values[np.newaxis,:,:]) for var in wrf_hdl.varlist})
     ncfile.close()
+    return ds
+
+def get_var_sub(ncfile, var, wrf_hdl):
+    ''' 
+        retrun var xr obj on the strided subset [s_sn:e_sn:dsmp, s_we:e_we:dsmp],
+        raw 2d fields on mass grid are read as hyperslab directly, 
+        wrf-python diagnostics are computed on full domain and then subset
+    '''
     
-    # read the rest files in the list
-    for idx, datestamp in enumerate(file_dates[1:]):
-        nc_fn=nc_fn_base+'wrfout_d01_'+datestamp.strftime('%Y-%m-%d_%H:%M:%S')
-        utils.write_log('%sTASK[%02d]: Read %04d of %04d --- %s' % (print_prefix, itsk, (idx+1), (len_files-1), nc_fn))
-        #utils.write_log(print_prefix+'TASK[%02d]: Read '+nc_fn % itsk)
-        
-        ncfile=nc4.Dataset(nc_fn)
-        
-        for var in varlist:
-            var_temp=get_var_xr(ncfile,var)
-            var_temp=var_temp.isel(
-                south_north=wrf_hdl.sn_range,
-                west_east=wrf_hdl.we_range)
-            da_dic[var]=xr.concat([da_dic[var],var_temp], dim='time')
+    if is_raw_2d(ncfile, var):
+        nc_var=ncfile.variables[var]
+        nc_var.set_auto_mask(False)
+        values=nc_var[0,
+                wrf_hdl.s_sn:wrf_hdl.e_sn:wrf_hdl.dsmp_interval,
+                wrf_hdl.s_we:wrf_hdl.e_we:wrf_hdl.dsmp_interval]
+        return xr.DataArray(values, dims=['south_north','west_east'], name=var)
     
-        ncfile.close()
-    utils.write_log('%sTASK[%02d]: All files loaded.' % (print_prefix, itsk))
-    return da_dic
+    var_xr=get_var_xr(ncfile,var)
+    return var_xr.isel(
+            south_north=wrf_hdl.sn_range,
+            west_east=wrf_hdl.we_range)
+
+def is_raw_2d(ncfile, var):
+    ''' test if var is a raw (Time, south_north, west_east) field in wrfout '''
+    if var not in ncfile.variables:
+        return False
+    return ncfile.variables[var].dimensions == ('Time', 'south_north', 'west_east')
 
 def get_var_xr(ncfile, var):
     ''' retrun var xr obj according to var name'''
@@ -0,0 +1,169 @@
+#/usr/bin/env python
+"""
+Bulk reclassification of the ERA5 archive by the archived model
+
+The monthly files of the RECLASSIFY range are read by ERAMesh in chunks
+of reclass_chunk months, normalized by the archived mean/std and matched
+to their BMUs in bulk, so memory is bounded by one chunk. Each chunk is
+appended to a time-indexed csv, and the last completed month is kept in
+a state file next to it, so an interrupted run resumes after that month.
+
+    Functions:
+    -----------
+        reclassify(cfg): classify all time steps of the RECLASSIFY range
+        get_months(cfg, start, end): available months of era5_src
+        split_chunks(months, nmonths): consecutive months in chunks
+"""
+
+import os, sys, json, pickle
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import lib
+from utils import utils
+
+print_prefix='lib.reclassifier>>'
+CWD=sys.path[0]
+
+def get_months(cfg, start, end):
+    '''
+    months from start to end (YYYYMM) with the files of all groups in
+    era5_src (or the catalog if use_catalog), missing ones are reported
+    '''
+    months=pd.date_range(start=start+'01', end=end+'01', freq='MS')
+    groups=sorted({lib.preprocess_erainp.get_var_group(var)
+        for var in ['u10', 'v10', 'msl', 'z']})
+    use_catalog=cfg['SHARE'].getboolean('use_catalog', fallback=False)
+
+    fn_dic=None
+    if use_catalog:
+        catalog=lib.source_catalog.load_catalog(cfg, 'era5')
+        fn_dic={(ts.strftime('%Y%m'), grp):fn for ts, grp, fn in zip(
+            catalog['valid_time'], catalog['group'], catalog['path'])}
+
+    era_src=cfg['TRAINING']['era5_src']
+    found=np.array([all(
+        (ts.strftime('%Y%m'), grp) in fn_dic if use_catalog else
+        os.path.exists(era_src+'/'+ts.strftime('%Y%m')+'-'+grp+'.nc')
+        for grp in groups) for ts in months], dtype=bool)
+    if not found.all():
+        lib.source_catalog.report_missing(
+                months[~found], len(months), 'era5 months', hint=use_catalog)
+    return months[found]
+
+def split_chunks(months, nmonths):
+    ''' split months into chunks of at most nmonths consecutive months '''
+    chunks=[]
+    for ts in months:
+        if chunks and len(chunks[-1]) < nmonths and \
+                ts==chunks[-1][-1]+pd.offsets.MonthBegin(1):
+            chunks[-1].append(ts)
+        else:
+            chunks.append([ts])
+    return chunks
+
+def reclassify(cfg):
+    '''
+    classify every 6-hourly time step of reclass_start..reclass_end,
+    append (type2d_cor, type_id, bmu_dis) to reclass_out, resume from
+    the state file if reclass_resume. TRAINING options of cfg are
+    overwritten by the range of each chunk
+    '''
+    start=cfg['RECLASSIFY']['reclass_start']
+    end=cfg['RECLASSIFY']['reclass_end']
+    nmonths=int(cfg['RECLASSIFY'].get('reclass_chunk', fallback='12'))
+    resume=cfg['RECLASSIFY'].getboolean('reclass_resume', fallback=True)
+    out_fn=cfg['RECLASSIFY'].get('reclass_out', fallback='./output/reclass_era5.csv')
+    if not os.path.isabs(out_fn):
+        out_fn=os.path.join(CWD, out_fn)
+    state_fn=os.path.splitext(out_fn)[0]+'_state.json'
+
+    # archived model and normalization statistics
+    archive_fn=CWD+'/db/som_era5.archive'
+    with open(archive_fn, 'rb') as infile:
+        som=pickle.load(infile)
+    db_in=xr.load_dataset(CWD+'/db/som_cluster_era5.nc')
+    n_nodey=db_in.sizes['n_nodey']
+    mean, std=None, None
+    if db_in.attrs['preprocess_method']=='temporal_norm':
+        mean=db_in['mean'].values.reshape(-1)
+        std=db_in['std'].values.reshape(-1)
+    model_time=os.path.getmtime(archive_fn)
+
+    # bulk BMU search by the compiled or numpy kernel
+    backend=cfg['SHARE'].get('kernel_backend', fallback='minisom')
+    backend='numpy' if backend=='minisom' else lib.som_kernels.get_backend(backend)
+
+    state=_read_state(state_fn, out_fn, model_time) if resume else {}
+    if state:
+        # drop rows written after the last completed month
+        with open(out_fn, 'r+') as f:
+            f.truncate(state['size'])
+        utils.write_log('%sresume after %s, %d records in %s' % (
+            print_prefix, state['done_month'], state['nrec'], out_fn))
+    else:
+        if os.path.exists(out_fn):
+            os.remove(out_fn)
+        os.makedirs(os.path.dirname(out_fn), exist_ok=True)
+        state={'model_time':model_time, 'nrec':0}
+
+    months=get_months(cfg, start, end)
+    if 'done_month' in state:
+        months=months[months > pd.Timestamp(state['done_month']+'01')]
+    chunks=split_chunks(months, nmonths)
+    utils.write_log('%sreclassify %d months in %d chunks into %s' % (
+        print_prefix, len(months), len(chunks), out_fn))
+
+    # every time step of each chunk
+    cfg['TRAINING']['sub_hrs']='-1'
+    cfg['TRAINING']['sub_mons']='-1'
+    progress=lib.log_manager.Progress(len(months), print_prefix+'reclassify', 'months')
+    for chunk in chunks:
+        cfg['TRAINING']['training_start']=chunk[0].strftime('%Y%m%d')
+        cfg['TRAINING']['training_end']=(chunk[-1]+pd.offsets.MonthEnd(0)).strftime('%Y%m%d')
+        mesh=lib.preprocess_erainp.ERAMesh(cfg)
+
+        data=mesh.data
+        if data.shape[1]!=som._weights.shape[-1]:
+            utils.throw_error(print_prefix, 'era5 grid (%d points) does not match the model (%d)' % (
+                data.shape[1], som._weights.shape[-1]))
+        if mean is not None:
+            data-=mean
+            data/=std
+        idx, dis=lib.som_kernels.bmu(som, data, backend)
+
+        df_out=pd.DataFrame({
+            'type2d_cor':['(%d,%d)' % divmod(int(ii), n_nodey) for ii in idx],
+            'type_id':idx, 'bmu_dis':dis}, index=mesh.dateseries)
+        with open(out_fn, 'a') as f:
+            df_out.to_csv(f, header=(f.tell()==0), index_label='time')
+            size=f.tell()
+
+        state.update(done_month=chunk[-1].strftime('%Y%m'), size=size,
+                nrec=state['nrec']+len(df_out))
+        _write_state(state_fn, state)
+        progress.update(len(chunk))
+        del mesh, data
+    progress.close()
+
+    utils.write_log('%sreclassification is completed, %d records in %s' % (
+        print_prefix, state['nrec'], out_fn))
+
+def _read_state(state_fn, out_fn, model_time):
+    ''' state of a previous run of the same model, {} if none '''
+    if not (os.path.exists(state_fn) and os.path.exists(out_fn)):
+        return {}
+    with open(state_fn) as f:
+        state=json.load(f)
+    if state.get('model_time')!=model_time:
+        utils.write_log(print_prefix+'model archive changed since the last run, start over', 30)
+        return {}
+    return state
+
+def _write_state(state_fn, state):
+    ''' write the state file atomically '''
+    tmp_fn=state_fn+'.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_fn, state_fn)
@@ -0,0 +1,184 @@
+#/usr/bin/env python
+"""
+Regridding of inference fields to the training grid of the model
+
+Interpolation weights from a rectilinear source grid (lat/lon) to the
+model grid (lat/lon, or 2d xlat/xlong) are built once as a sparse matrix
+and cached in regrid_cache_dir keyed by a hash of the grid pair, later
+runs load them and regrid a whole batch of fields in one sparse matmul.
+
+    Classes:
+    -----------
+        Regridder: sparse weights of one grid pair
+
+    Functions:
+    -----------
+        get_regridder(src, tgt, method, cache_dir): cached regridder
+        same_grid(src, tgt): test if two grids are identical
+        bilinear_weights(src, tgt): bilinear weight matrix
+        conservative_weights(src, tgt): first-order conservative weights
+"""
+
+import os, hashlib
+import numpy as np
+
+from utils import utils
+
+try:
+    import scipy.sparse as sps
+    HAS_SCIPY=True
+except ImportError:
+    HAS_SCIPY=False
+
+print_prefix='lib.regridder>>'
+
+# grid coordinates are compared and hashed at this precision (degree)
+PRECISION=1e-6
+
+def same_grid(src, tgt):
+    ''' True if the (lat, lon) pairs src and tgt are the same grid '''
+    return all(np.shape(a)==np.shape(b) and np.allclose(a, b, atol=PRECISION)
+            for a, b in zip(src, tgt))
+
+def grid_key(method, src, tgt):
+    ''' hash of the method and the grid pair '''
+    sha=hashlib.sha1(method.encode())
+    for arr in (*src, *tgt):
+        arr=np.round(np.asarray(arr, dtype=np.float64)/PRECISION)
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    return sha.hexdigest()[:16]
+
+class Regridder:
+
+    '''
+    Sparse regridding weights from a source to a target grid
+
+    Attributes
+    -----------
+    method, str, bilinear or conservative
+    weights, scipy.sparse.csr_matrix, (ntarget, nsource) points
+    tgt_shape, tuple, (nrow, ncol) of the target grid
+
+    Methods
+    -----------
+    apply(data), regrid data(..., nsource) to (..., ntarget)
+
+    '''
+
+    def __init__(self, weights, method, tgt_shape):
+        """ construct regridder from weights """
+        self.weights=weights.tocsr()
+        self.method=method
+        self.tgt_shape=tuple(tgt_shape)
+
+    def apply(self, data):
+        ''' regrid data(..., nsource) with flat source points, one sparse matmul '''
+        lead=data.shape[:-1]
+        flat=np.ascontiguousarray(data).reshape(-1, data.shape[-1])
+        out=self.weights.dot(flat.T).T.astype(data.dtype, copy=False)
+        return out.reshape(lead+(self.weights.shape[0],))
+
+def get_regridder(src, tgt, method='bilinear', cache_dir='./db/'):
+    '''
+    regridder from src=(lat, lon) 1d to tgt=(lat, lon) 1d or 2d (xlat,
+    xlong), weights are loaded from cache_dir if built before
+    '''
+    if not HAS_SCIPY:
+        utils.throw_error(print_prefix, 'scipy is required to regrid')
+    tgt_shape=np.shape(tgt[0]) if np.ndim(tgt[0])==2 else (len(tgt[0]), len(tgt[1]))
+    cache_fn=os.path.join(cache_dir, 'regrid_%s_%s.npz' % (method, grid_key(method, src, tgt)))
+    if os.path.exists(cache_fn):
+        utils.write_log(print_prefix+'load regrid weights '+cache_fn)
+        return Regridder(sps.load_npz(cache_fn), method, tgt_shape)
+
+    utils.write_log('%sbuild %s weights from %dx%d to %dx%d grid...' % (
+        print_prefix, method, len(src[0]), len(src[1]), tgt_shape[0], tgt_shape[1]))
+    if method=='bilinear':
+        weights=bilinear_weights(src, tgt)
+    elif method=='conservative':
+        weights=conservative_weights(src, tgt)
+    else:
+        utils.throw_error(print_prefix, 'unknown regrid method: '+method)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fn=cache_fn[:-4]+'.tmp.npz'
+    sps.save_npz(tmp_fn, weights)
+    os.replace(tmp_fn, cache_fn)
+    utils.write_log(print_prefix+'regrid weights cached in '+cache_fn)
+    return Regridder(weights, method, tgt_shape)
+
+def bilinear_weights(src, tgt):
+    ''' bilinear weights, source points lat-major, target points row-major '''
+    src_lat, src_lon=np.asarray(src[0], dtype=np.float64), np.asarray(src[1], dtype=np.float64)
+    if np.ndim(tgt[0])==2:
+        tlat, tlon=np.asarray(tgt[0]).ravel(), np.asarray(tgt[1]).ravel()
+    else:
+        tlat, tlon=[arr.ravel() for arr in np.meshgrid(tgt[0], tgt[1], indexing='ij')]
+    tlon=_wrap_lon(tlon, src_lon)
+
+    ilat0, ilat1, flat=_axis_weights(src_lat, tlat, 'latitude')
+    ilon0, ilon1, flon=_axis_weights(src_lon, tlon, 'longitude')
+
+    nlon=len(src_lon)
+    rows=np.tile(np.arange(len(tlat)), 4)
+    cols=np.concatenate([ilat0*nlon+ilon0, ilat0*nlon+ilon1, ilat1*nlon+ilon0, ilat1*nlon+ilon1])
+    vals=np.concatenate([(1-flat)*(1-flon), (1-flat)*flon, flat*(1-flon), flat*flon])
+    weights=sps.coo_matrix((vals, (rows, cols)),
+            shape=(len(tlat), len(src_lat)*nlon)).tocsr()
+    weights.eliminate_zeros()
+    return weights
+
+def conservative_weights(src, tgt):
+    '''
+    first-order conservative weights between rectilinear grids, cell
+    edges halfway between centers, overlaps weighted by area on the sphere
+    '''
+    if np.ndim(tgt[0])==2:
+        utils.throw_error(print_prefix, 'conservative weights need a rectilinear target, use bilinear')
+    src_lon=np.asarray(src[1], dtype=np.float64)
+    wlat=_overlap_weights(
+            np.sin(np.deg2rad(np.clip(_edges(src[0]), -90, 90))),
+            np.sin(np.deg2rad(np.clip(_edges(tgt[0]), -90, 90))), 'latitude')
+    wlon=_overlap_weights(
+            _edges(src_lon), _edges(_wrap_lon(np.asarray(tgt[1], dtype=np.float64), src_lon)),
+            'longitude')
+    # cell area is separable in sin(lat) and lon
+    return sps.kron(wlat, wlon, format='csr')
+
+def _wrap_lon(lon, src_lon):
+    ''' shift lon into the 360 degree range starting at the source west edge '''
+    west=np.min(src_lon)
+    return west+np.mod(lon-west, 360.0)
+
+def _axis_weights(axis, pts, name):
+    ''' bracketing indices and fraction of pts along a monotonic axis '''
+    order=np.argsort(axis)
+    sorted_axis=axis[order]
+    outside=(pts < sorted_axis[0]-PRECISION) | (pts > sorted_axis[-1]+PRECISION)
+    if outside.any():
+        utils.throw_error(print_prefix, '%d target points outside the source %s range [%s, %s]' % (
+            outside.sum(), name, sorted_axis[0], sorted_axis[-1]))
+    idx=np.clip(np.searchsorted(sorted_axis, pts, side='right')-1, 0, len(axis)-2)
+    frac=np.clip((pts-sorted_axis[idx])/(sorted_axis[idx+1]-sorted_axis[idx]), 0.0, 1.0)
+    return order[idx], order[idx+1], frac
+
+def _edges(centers):
+    ''' cell edges of centers, halfway between neighbours '''
+    centers=np.asarray(centers, dtype=np.float64)
+    mid=(centers[1:]+centers[:-1])/2.0
+    return np.concatenate([[2*centers[0]-mid[0]], mid, [2*centers[-1]-mid[-1]]])
+
+def _overlap_weights(src_edges, tgt_edges, name):
+    ''' overlap fractions (ntarget, nsource) of target cells along one axis '''
+    s_lo=np.minimum(src_edges[:-1], src_edges[1:])
+    s_hi=np.maximum(src_edges[:-1], src_edges[1:])
+    t_lo=np.minimum(tgt_edges[:-1], tgt_edges[1:])
+    t_hi=np.maximum(tgt_edges[:-1], tgt_edges[1:])
+    overlap=np.clip(np.minimum(t_hi[:,np.newaxis], s_hi[np.newaxis,:])
+            -np.maximum(t_lo[:,np.newaxis], s_lo[np.newaxis,:]), 0.0, None)
+    cover=overlap.sum(axis=1)
+    if (cover < 0.5*(t_hi-t_lo)).any():
+        utils.throw_error(print_prefix, '%d target cells not covered by the source %s range' % (
+            (cover < 0.5*(t_hi-t_lo)).sum(), name))
+    return sps.csr_matrix(overlap/cover[:,np.newaxis])
@@ -0,0 +1,173 @@
+#/usr/bin/env python
+"""
+Compiled SOM kernels: BMU search and fused online training
+
+Kernels are compiled by Numba (parallel over nodes/records) when it is
+installed, otherwise the same loops run in pure NumPy.
+
+    Functions:
+    -----------
+        get_backend(name): resolve minisom/auto/numba/numpy backend
+        bmu(som, data, backend): flat BMU index and distance of records
+        train_segment(som, data, order, t0, t1, max_iteration, ...):
+            online gaussian updates t0..t1-1, winner search and update
+            fused in one pass over the codebook per step
+"""
+
+import os
+import numpy as np
+
+from utils import utils
+
+try:
+    import numba
+    HAS_NUMBA=True
+    # Prism forks process pools, the tbb layer may hang at exit after fork
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER='workqueue'
+except ImportError:
+    HAS_NUMBA=False
+
+print_prefix='lib.som_kernels>>'
+
+def get_backend(name='auto'):
+    '''
+    resolve the kernel backend: minisom (MiniSom loops, no kernel),
+    numba, numpy, or auto (numba if installed, else numpy)
+    '''
+    if name=='auto':
+        return 'numba' if HAS_NUMBA else 'numpy'
+    if name=='numba' and not HAS_NUMBA:
+        utils.write_log(print_prefix+'numba not available, fall back to numpy kernels', 30)
+        return 'numpy'
+    if name not in ('minisom', 'numba', 'numpy'):
+        utils.throw_error(print_prefix, 'unknown kernel_backend: '+name)
+    return name
+
+def bmu(som, data, backend='numpy', chunk=1024):
+    '''
+    flat BMU index (x*n_nodey+y) and euclidean distance of each record
+    in data(nrec, ngrids), return (idx, dis)
+    '''
+    weights=som._weights.reshape(-1, som._weights.shape[-1])
+    nrec=data.shape[0]
+    idx=np.empty(nrec, dtype=np.int64)
+    dis=np.empty(nrec)
+
+    if backend=='numba':
+        _bmu_nb(weights, data, idx, dis)
+        return idx, dis
+
+    w2=(weights**2).sum(axis=1)
+    for ii in range(0, nrec, chunk):
+        x=data[ii:ii+chunk]
+        # |x-w|^2 = |x|^2 + |w|^2 - 2 x.w
+        dis2=(x**2).sum(axis=1)[:,np.newaxis]+w2[np.newaxis,:]-2.0*x.dot(weights.T)
+        idx[ii:ii+chunk]=dis2.argmin(axis=1)
+        # exact distances to the BMU
+        dis[ii:ii+chunk]=np.linalg.norm(x-weights[idx[ii:ii+chunk]], axis=1)
+    return idx, dis
+
+def train_segment(som, data, order, t0, t1, max_iteration, nb_cutoff=0,
+        backend='numpy'):
+    '''
+    online updates t0..t1-1 on records data[order[t % len(order)]], gaussian
+    neighbourhood with MiniSom's asymptotic decay of sigma/learning rate,
+    truncated at nb_cutoff*sigma if nb_cutoff>0. The codebook is updated
+    in place.
+    '''
+    nx, ny, ngrids=som._weights.shape
+    weights=np.ascontiguousarray(som._weights.reshape(nx*ny, ngrids))
+    order=np.asarray(order, dtype=np.int64)
+    kernel=_train_segment_nb if backend=='numba' else _train_segment_np
+    kernel(weights, ny, data, order, t0, t1, float(max_iteration),
+            float(som._sigma), float(som._learning_rate), float(nb_cutoff))
+    som._weights=weights.reshape(nx, ny, ngrids)
+
+def _train_segment_np(weights, ny, data, order, t0, t1, max_iteration,
+        sigma0, lr0, nb_cutoff):
+    ''' numpy loop of train_segment '''
+    nnodes=weights.shape[0]
+    gx, gy=np.divmod(np.arange(nnodes), ny)
+    norder=len(order)
+    for t in range(t0, t1):
+        x=data[order[t % norder]]
+        diff=x-weights
+        win=np.einsum('ij,ij->i', diff, diff).argmin()
+
+        decay=1.0+t/(max_iteration/2.0)
+        eta, sig=lr0/decay, sigma0/decay
+        d2=(gx-gx[win])**2+(gy-gy[win])**2
+        if nb_cutoff > 0:
+            sel=np.nonzero(d2 <= (nb_cutoff*sig)**2)[0]
+            g=eta*np.exp(-d2[sel]/(2*sig*sig))
+            weights[sel]+=g[:,np.newaxis]*diff[sel]
+        else:
+            g=eta*np.exp(-d2/(2*sig*sig))
+            weights+=g[:,np.newaxis]*diff
+
+if HAS_NUMBA:
+
+    @numba.njit(parallel=True, cache=True)
+    def _bmu_nb(weights, data, idx, dis):
+        ''' BMU search, parallel over records '''
+        nnodes, ngrids=weights.shape
+        for ii in numba.prange(data.shape[0]):
+            best=np.inf
+            ibest=0
+            for jj in range(nnodes):
+                d2=0.0
+                for kk in range(ngrids):
+                    diff=data[ii,kk]-weights[jj,kk]
+                    d2+=diff*diff
+                if d2 < best:
+                    best=d2
+                    ibest=jj
+            idx[ii]=ibest
+            dis[ii]=np.sqrt(best)
+
+    @numba.njit(parallel=True, cache=True)
+    def _train_segment_nb(weights, ny, data, order, t0, t1, max_iteration,
+            sigma0, lr0, nb_cutoff):
+        '''
+        fused online loop, parallel over nodes: each pass over the codebook
+        updates node j for the current record and takes its distance to
+        the next record, so the winner search needs no extra pass
+        '''
+        nnodes, ngrids=weights.shape
+        norder=len(order)
+        d2=np.empty(nnodes)
+
+        # distances to the first record
+        x=data[order[t0 % norder]]
+        for jj in numba.prange(nnodes):
+            acc=0.0
+            for kk in range(ngrids):
+                diff=x[kk]-weights[jj,kk]
+                acc+=diff*diff
+            d2[jj]=acc
+
+        for t in range(t0, t1):
+            win=np.argmin(d2)
+            wx, wy=win//ny, win%ny
+            decay=1.0+t/(max_iteration/2.0)
+            eta, sig=lr0/decay, sigma0/decay
+            if nb_cutoff > 0:
+                r2max=(nb_cutoff*sig)**2
+            else:
+                r2max=np.inf
+
+            x=data[order[t % norder]]
+            xn=data[order[(t+1) % norder]]
+            for jj in numba.prange(nnodes):
+                dx, dy=jj//ny-wx, jj%ny-wy
+                r2=dx*dx+dy*dy
+                upd=r2 <= r2max
+                g=eta*np.exp(-r2/(2*sig*sig)) if upd else 0.0
+                acc=0.0
+                for kk in range(ngrids):
+                    if upd:
+                        weights[jj,kk]+=g*(x[kk]-weights[jj,kk])
+                    diff=xn[kk]-weights[jj,kk]
+                    acc+=diff*diff
+                d2[jj]=acc
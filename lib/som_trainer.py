@@ -0,0 +1,307 @@
+#/usr/bin/env python
+"""
+Training loops for the MiniSom codebook
+
+    Functions:
+    -----------
+        split_holdout(nrec, frac, seed): training and held-out record indexes
+        train_online(som, data, iterations, ...): segmented online training
+            with convergence-based early stopping
+        anneal_window(it, iterations, nanneal): decay steps annealing the
+            map after an early stop
+        train_batch(som, data, epochs, nworkers, ...): data-parallel batch
+            training, records sharded over a process pool
+        nb_window(som, c, sigma, radius): neighbourhood truncated at radius
+        update_truncated(som, x, win, t, max_iteration, nb_cutoff): online
+            update of the nodes within nb_cutoff*sigma of the winner
+"""
+
+import numpy as np
+import multiprocessing
+from multiprocessing import Pool
+
+import lib
+from utils import utils
+
+print_prefix='lib.som_trainer>>'
+
+def split_holdout(nrec, frac, seed=0):
+    '''
+    split record indexes into (train_idx, holdout_idx), holdout_idx is
+    a random frac of the records, None if frac<=0
+    '''
+    nhold=int(nrec*frac)
+    if nhold<=0:
+        return np.arange(nrec), None
+    perm=np.random.RandomState(seed).permutation(nrec)
+    return np.sort(perm[nhold:]), np.sort(perm[:nhold])
+
+def train_online(som, data, iterations, train_idx=None, monitor_idx=None,
+        segment=1000, tol=None, patience=2, nb_cutoff=None, backend='minisom',
+        verbose=False):
+    '''
+    online training in segments of MiniSom updates, same sequential order
+    and decay schedule (over the full iterations) as MiniSom.train.
+    With nb_cutoff, each update only touches nodes within nb_cutoff*sigma
+    of the winner (see update_truncated). With backend numba/numpy, each
+    segment runs in lib.som_kernels.train_segment (gaussian only).
+
+    After each segment the quantization and topographic errors are taken
+    on data[monitor_idx] (the training records if None). With tol, training
+    stops once the relative drop of quantization error is below tol for
+    patience consecutive segments, then one more segment anneals sigma and
+    learning rate from their current to their final values (see
+    anneal_window), so the map ends as annealed as after the full budget.
+
+    return (iterations used, [(iteration, q_err, t_err), ...])
+    '''
+    if train_idx is None:
+        train_idx=np.arange(data.shape[0])
+    monitor=data[monitor_idx] if monitor_idx is not None else data[train_idx]
+
+    if backend!='minisom' and som.neighborhood!=som._gaussian:
+        utils.write_log(print_prefix+'kernels support gaussian only, use minisom loop', 30)
+        backend='minisom'
+
+    history=[]
+    best_q_err=np.inf
+    nstall=0
+
+    it=0
+    while it < iterations:
+        end=min(it+segment, iterations)
+        _train_steps(som, data, train_idx, it, end, iterations, nb_cutoff, backend)
+        it=end
+
+        q_err=som.quantization_error(monitor)
+        t_err=som.topographic_error(monitor)
+        history.append((it, float(q_err), float(t_err)))
+        if verbose:
+            utils.write_log('%siteration %d/%d, q_err=%.4f, t_err=%.4f' % (
+                print_prefix, it, iterations, q_err, t_err))
+
+        if tol is None:
+            continue
+
+        # relative improvement over the best so far
+        if best_q_err-q_err < tol*best_q_err:
+            nstall+=1
+        else:
+            nstall=0
+        best_q_err=min(best_q_err, q_err)
+
+        if nstall >= patience and it < iterations:
+            nanneal=min(segment, iterations-it)
+            t0, t1=anneal_window(it, iterations, nanneal)
+            _train_steps(som, data, train_idx, t0, t1, t1, nb_cutoff, backend)
+            it+=nanneal
+            q_err=som.quantization_error(monitor)
+            t_err=som.topographic_error(monitor)
+            history.append((it, float(q_err), float(t_err)))
+            utils.write_log('%sconverged, annealed at iteration %d/%d (q_err=%.4f)' % (
+                print_prefix, it, iterations, q_err))
+            break
+
+    return it, history
+
+def anneal_window(it, iterations, nanneal):
+    '''
+    decay steps [t0, t1) with max_iteration=t1 that take the asymptotic
+    decay 1/(1+2t/max_iteration) of sigma and learning rate from its value
+    at it of iterations to its final value (t=max_iteration) in nanneal steps
+    '''
+    # t0/t1=it/iterations keeps the decay continuous at the switch
+    t1=int(round(nanneal*iterations/float(iterations-it)))
+    return t1-nanneal, t1
+
+def _train_steps(som, data, train_idx, t0, t1, max_iteration, nb_cutoff, backend):
+    ''' online updates t0..t1-1 on data[train_idx] with the decay over max_iteration '''
+    if backend!='minisom':
+        lib.som_kernels.train_segment(
+                som, data, train_idx, t0, t1, max_iteration, 
+                nb_cutoff=nb_cutoff or 0, backend=backend)
+        return
+    ntrain=len(train_idx)
+    for t in range(t0, t1):
+        x=data[train_idx[t % ntrain]]
+        if nb_cutoff:
+            update_truncated(som, x, som.winner(x), t, max_iteration, nb_cutoff)
+        else:
+            som.update(x, som.winner(x), t, max_iteration)
+
+def train_batch(som, data, epochs, nworkers=4, tol=None, patience=2, 
+        nb_cutoff=None, chunk=256, verbose=False):
+    '''
+    data-parallel batch training. Records are sharded over nworkers
+    processes sharing data in memory, each worker finds the BMUs of its
+    shard and accumulates per-node sums and counts, the parent reduces
+    them and sets each node to the neighbourhood-weighted mean
+        w_j = sum_b h(b,j) S_b / sum_b h(b,j) n_b
+    once per epoch, sigma decays as in MiniSom (asymptotic decay). 
+    With nb_cutoff, h(b,j) is zero beyond nb_cutoff*sigma and only the
+    nodes in reach of each BMU are accumulated.
+
+    The quantization error of each epoch is taken on all records before
+    its update, with tol the training stops as in train_online.
+    Pool workers (e.g. in grid search) train in-process.
+
+    return (epochs used, [(epoch, q_err, None), ...])
+    '''
+    nrec, ngrids=data.shape
+    nx, ny=som._weights.shape[:2]
+    nnodes=nx*ny
+    sigma0=som._sigma
+
+    if nworkers > 1 and multiprocessing.current_process().daemon:
+        nworkers=1
+    nworkers=max(min(nworkers, nrec), 1)
+
+    # data, codebook and per-worker partial sums in shared memory
+    raw_data=utils.get_shared_raw(data)
+    if raw_data is None or len(raw_data)!=data.size:
+        raw_data, buf=utils.create_shared_buffer(data.shape)
+        buf[:]=data
+    raw_w, weights=utils.create_shared_buffer((nnodes, ngrids))
+    raw_sums, sums=utils.create_shared_buffer((nworkers, nnodes, ngrids))
+    weights[:]=som._weights.reshape(nnodes, ngrids)
+
+    bounds=np.linspace(0, nrec, nworkers+1).astype(int)
+    nodes=[(ii, jj) for ii in range(nx) for jj in range(ny)]
+    initargs=(raw_data, raw_w, raw_sums, data.shape, nnodes)
+
+    utils.write_log('%sbatch training %dx%d map on %d records, %d workers' % (
+        print_prefix, nx, ny, nrec, nworkers))
+    
+    if nworkers > 1:
+        process_pool=Pool(processes=nworkers, initializer=_init, initargs=initargs)
+    else:
+        _init(*initargs)
+
+    history=[]
+    best_q_err=np.inf
+    nstall=0
+    
+    for ep in range(epochs):
+        if nworkers > 1:
+            results=[process_pool.apply_async(_shard_sums, 
+                args=(iw, bounds[iw], bounds[iw+1], chunk)) for iw in range(nworkers)]
+            results=[res.get() for res in results]
+        else:
+            results=[_shard_sums(0, 0, nrec, chunk)]
+
+        # reduce partial sums
+        counts=np.sum([res[0] for res in results], axis=0)
+        q_err=sum(res[1] for res in results)/nrec
+        node_sum=sums.sum(axis=0)
+
+        sigma=_asymptotic_decay(sigma0, ep, epochs)
+        if nb_cutoff:
+            # scatter each BMU's sums to the nodes in its reach only
+            num=np.zeros((nnodes, ngrids))
+            den=np.zeros(nnodes)
+            num_map, den_map=num.reshape(nx, ny, ngrids), den.reshape(nx, ny)
+            for b in np.nonzero(counts)[0]:
+                sx, sy, g=nb_window(som, nodes[b], sigma, nb_cutoff*sigma)
+                num_map[sx, sy]+=g[:,:,np.newaxis]*node_sum[b]
+                den_map[sx, sy]+=g*counts[b]
+        else:
+            # h[b,j], neighbourhood of node j around BMU b
+            h=np.stack([som.neighborhood(c, sigma).reshape(-1) for c in nodes])
+            num=h.T.dot(node_sum)
+            den=h.T.dot(counts)
+
+        # nodes out of reach of any record keep their weights
+        upd=den > 0
+        weights[upd]=num[upd]/den[upd, np.newaxis]
+
+        history.append((ep+1, float(q_err), None))
+        if verbose:
+            utils.write_log('%sepoch %d/%d, q_err=%.4f, sigma=%.4f' % (
+                print_prefix, ep+1, epochs, q_err, sigma))
+        
+        if tol is None:
+            continue
+        if best_q_err-q_err < tol*best_q_err:
+            nstall+=1
+        else:
+            nstall=0
+        best_q_err=min(best_q_err, q_err)
+        if nstall >= patience:
+            utils.write_log('%sconverged at epoch %d/%d (q_err=%.4f)' % (
+                print_prefix, ep+1, epochs, q_err))
+            break
+
+    if nworkers > 1:
+        process_pool.close()
+        process_pool.join()
+
+    som._weights=weights.reshape(nx, ny, ngrids).copy()
+    return len(history), history
+
+def _asymptotic_decay(val, t, max_iteration):
+    ''' MiniSom default decay of learning rate and sigma '''
+    return val/(1+t/(max_iteration/2))
+
+def nb_window(som, c, sigma, radius):
+    '''
+    neighbourhood of winner c truncated at radius (grid units),
+    return (slice_x, slice_y, g), g is zero outside the radius and only
+    evaluated in the bounding window of the cutoff
+    '''
+    nx, ny=som._weights.shape[:2]
+    r=int(np.floor(radius))
+    sx=slice(max(c[0]-r, 0), min(c[0]+r+1, nx))
+    sy=slice(max(c[1]-r, 0), min(c[1]+r+1, ny))
+    dx=np.arange(sx.start, sx.stop)-c[0]
+    dy=np.arange(sy.start, sy.stop)-c[1]
+    d2=dx[:,np.newaxis]**2+dy[np.newaxis,:]**2
+    
+    if som.neighborhood==som._gaussian:
+        g=np.exp(-d2/(2*sigma*sigma))
+    else:
+        # other functions are evaluated on the whole map
+        g=som.neighborhood(c, sigma)[sx, sy]
+    g[d2 > radius*radius]=0.0
+    return sx, sy, g
+
+def update_truncated(som, x, win, t, max_iteration, nb_cutoff):
+    ''' MiniSom update restricted to the nodes within nb_cutoff*sigma of win '''
+    eta=_asymptotic_decay(som._learning_rate, t, max_iteration)
+    sig=_asymptotic_decay(som._sigma, t, max_iteration)
+    sx, sy, g=nb_window(som, win, sig, nb_cutoff*sig)
+    
+    # view of the window, updated in place
+    weights=som._weights[sx, sy]
+    weights+=(g*eta)[:,:,np.newaxis]*(x-weights)
+
+def _shard_sums(iw, start, end, chunk):
+    ''' BMUs of records [start, end), per-node sums into slot iw, return (counts, q_err sum) '''
+    data=np.frombuffer(s_data, dtype=np.float64).reshape(s_shape)
+    weights=np.frombuffer(s_weights, dtype=np.float64).reshape((s_nnodes, -1))
+    sums=np.frombuffer(s_sums, dtype=np.float64).reshape((-1, s_nnodes, data.shape[1]))[iw]
+    
+    w2=(weights**2).sum(axis=1)
+    sums[:]=0.0
+    counts=np.zeros(s_nnodes)
+    q_sum=0.0
+    for ii in range(start, end, chunk):
+        x=data[ii:min(ii+chunk, end)]
+        # |x-w|^2 = |x|^2 + |w|^2 - 2 x.w
+        dis2=(x**2).sum(axis=1)[:,np.newaxis]+w2[np.newaxis,:]-2.0*x.dot(weights.T)
+        bmu=dis2.argmin(axis=1)
+        q_sum+=np.sqrt(np.maximum(dis2[np.arange(len(bmu)), bmu], 0.0)).sum()
+        # one-hot reduce, sums[b] += x of records won by b
+        onehot=np.zeros((s_nnodes, len(bmu)))
+        onehot[bmu, np.arange(len(bmu))]=1.0
+        sums+=onehot.dot(x)
+        counts+=onehot.sum(axis=1)
+    return counts, q_sum
+
+def _init(raw_data, raw_weights, raw_sums, shape, nnodes):
+    """ 
+        Each pool process calls this initializer. Load the shared
+        arrays into that process's global namespace 
+    """
+    global s_data, s_weights, s_sums, s_shape, s_nnodes
+    s_data, s_weights, s_sums=raw_data, raw_weights, raw_sums
+    s_shape, s_nnodes=shape, nnodes
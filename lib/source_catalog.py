@@ -0,0 +1,240 @@
+#/usr/bin/env python
+"""
+Source catalog of the raw input files
+
+The catalog maps the valid time of each source file to its path, it is
+built once by a parallel os.scandir over the source tree and kept as a
+csv (db/src_catalog_wrf.csv, db/src_catalog_era5.csv), loaders then read
+the source files in place and skip missing times instead of relinking.
+
+    Functions:
+    -----------
+        scan_tree(root, match, nworkers): recursive parallel scandir
+        build_catalog(source, root, catalog_fn, nworkers): scan and write
+        load_catalog(cfg, source): read the catalog, built if absent
+        lookup(catalog, dateseries, name): paths of dateseries, missing
+            times are reported and dropped
+        lookup_monthly(catalog, dateseries, groups, name): monthly files
+            of dateseries, months missing any group are dropped
+        realtime_run(cfg): latest available wrf forecast run
+        scan_gfs(gfs_src, init_ts, fmt): gfs forecast files by valid time
+        latest_run(df): one catalog row per valid time, latest init
+        link_files(fn_list, dest, clean): symlink files into dest
+"""
+
+import os, re, sys, datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import utils
+
+print_prefix='lib.source_catalog>>'
+CWD=sys.path[0]
+
+# file name patterns of the sources
+WRF_PAT=re.compile(r'^wrfout_d01_(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})$')
+ERA5_PAT=re.compile(r'^(\d{6})-(surf|h500)\.nc$')
+GFS_PAT=re.compile(r'^gfs\.t(\d{2})z\.pgrb2\.0p25\.f(\d{3})\.(nc|grib2)$')
+
+COLUMNS=['valid_time', 'init_time', 'group', 'path']
+
+def scan_tree(root, match, nworkers=8):
+    '''
+    recursive scandir of root, sub-directories are listed in parallel
+    by nworkers threads, return sorted paths of files whose name passes
+    match(name)
+    '''
+    files=[]
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        pending={pool.submit(_scan_dir, root, match)}
+        while pending:
+            done, pending=wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                sub_dirs, sub_files=fut.result()
+                files.extend(sub_files)
+                pending.update(pool.submit(_scan_dir, d, match) for d in sub_dirs)
+    return sorted(files)
+
+def _scan_dir(path, match):
+    ''' one scandir, return (sub-directories, matched files) '''
+    dirs, files=[], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif match(entry.name):
+                    files.append(entry.path)
+    except OSError as err:
+        utils.write_log('%scannot scan %s: %s' % (print_prefix, path, err), 30)
+    return dirs, files
+
+def _wrf_frame(paths):
+    '''
+    catalog rows of wrfout files, the init time is taken from the run
+    directory name (yyyymmddHH); a valid time found in several runs is
+    kept from the latest run initialized no later than it
+    '''
+    names=[os.path.basename(p) for p in paths]
+    valid=pd.to_datetime([WRF_PAT.match(n).group(1) for n in names],
+            format='%Y-%m-%d_%H:%M:%S')
+    init=pd.to_datetime([os.path.basename(os.path.dirname(p)) for p in paths],
+            format='%Y%m%d%H', errors='coerce')
+    df=pd.DataFrame({'valid_time':valid, 'init_time':init, 'group':'', 'path':paths})
+
+    return latest_run(df[~(df['init_time'] > df['valid_time'])])
+
+def latest_run(df):
+    ''' one row per valid time, the one of the latest init time (unknown first) '''
+    df=df.sort_values(['valid_time', 'init_time'], na_position='first')
+    return df.drop_duplicates('valid_time', keep='last')
+
+def _era5_frame(paths):
+    ''' catalog rows of monthly era5 files, valid_time is the first of month '''
+    matches=[ERA5_PAT.match(os.path.basename(p)) for p in paths]
+    df=pd.DataFrame({
+        'valid_time':pd.to_datetime([m.group(1) for m in matches], format='%Y%m'),
+        'init_time':pd.NaT, 'group':[m.group(2) for m in matches], 'path':paths})
+    return df.sort_values(['valid_time', 'group']).drop_duplicates(
+            ['valid_time', 'group'], keep='first')
+
+SOURCES={
+    'wrf':(WRF_PAT, _wrf_frame),
+    'era5':(ERA5_PAT, _era5_frame)}
+
+def build_catalog(source, root, catalog_fn=None, nworkers=8):
+    ''' scan root for files of source (wrf/era5), write the catalog csv if catalog_fn '''
+    pat, frame_func=SOURCES[source]
+    utils.write_log('%sbuild %s catalog of %s...' % (print_prefix, source, root))
+    paths=scan_tree(root, lambda name: pat.match(name) is not None, nworkers)
+    df=frame_func(paths) if paths else pd.DataFrame(columns=COLUMNS)
+    utils.write_log('%s%d files cataloged' % (print_prefix, len(df)))
+
+    if catalog_fn is not None:
+        df.to_csv(catalog_fn, index=False, columns=COLUMNS)
+    return df
+
+def get_root(cfg, source):
+    ''' source tree of source in cfg '''
+    if source=='wrf':
+        return cfg['OTHER']['src_wrf']
+    return cfg['TRAINING']['era5_src']
+
+def get_catalog_fn(cfg, source):
+    ''' catalog csv path of source '''
+    catalog_dir=cfg['SHARE'].get('catalog_dir', fallback='./db/')
+    if not os.path.isabs(catalog_dir):
+        catalog_dir=os.path.join(CWD, catalog_dir)
+    return os.path.join(catalog_dir, 'src_catalog_%s.csv' % source)
+
+def load_catalog(cfg, source, rebuild=None):
+    '''
+    read the catalog of source (wrf/era5), built once if absent or
+    if rebuild (default SHARE.catalog_rebuild)
+    '''
+    catalog_fn=get_catalog_fn(cfg, source)
+    if rebuild is None:
+        rebuild=cfg['SHARE'].getboolean('catalog_rebuild', fallback=False)
+
+    if rebuild or not os.path.exists(catalog_fn):
+        df=build_catalog(source, get_root(cfg, source), catalog_fn,
+                int(cfg['SHARE'].get('catalog_nworkers', fallback='8')))
+    else:
+        utils.write_log(print_prefix+'read catalog '+catalog_fn)
+        df=pd.read_csv(catalog_fn, parse_dates=['valid_time', 'init_time'],
+                keep_default_na=False, na_values={'init_time':['']})
+    return df
+
+def lookup(catalog, dateseries, name='source times', hint=True):
+    '''
+    paths of dateseries in catalog, a valid time found in several rows
+    is taken from the latest init time, return (found dateseries, paths),
+    missing times are reported
+    '''
+    fn=latest_run(catalog).set_index('valid_time')['path'].reindex(dateseries)
+    miss=fn.isna().values
+    if miss.any():
+        report_missing(dateseries[miss], len(dateseries), name, hint)
+    return dateseries[~miss], fn.values[~miss].tolist()
+
+def lookup_monthly(catalog, dateseries, groups, name='source months'):
+    '''
+    monthly files of dateseries in catalog, a month is kept only if the
+    files of all groups exist, return (found dateseries, path dict keyed
+    by (yyyymm, group)), missing months are reported
+    '''
+    fn_dic={(ts.strftime('%Y%m'), grp):fn for ts, grp, fn in zip(
+        catalog['valid_time'], catalog['group'], catalog['path'])}
+    months=pd.DatetimeIndex(np.unique(dateseries.to_period('M').to_timestamp()))
+    miss=np.array([any((ts.strftime('%Y%m'), grp) not in fn_dic for grp in groups)
+        for ts in months], dtype=bool)
+    if miss.any():
+        report_missing(months[miss], len(months), name)
+    keep=~dateseries.to_period('M').to_timestamp().isin(months[miss])
+    return dateseries[keep], fn_dic
+
+def report_missing(missing, ntotal, name='source times', hint=True, nshow=5):
+    ''' warn about missing times, the first nshow are listed '''
+    shown=', '.join(ts.strftime('%Y-%m-%d_%H') for ts in missing[:nshow])
+    if len(missing) > nshow:
+        shown+=', ...'
+    utils.write_log('%s%d/%d %s missing and skipped: %s' % (
+        print_prefix, len(missing), ntotal, name, shown), 30)
+    if hint:
+        utils.write_log(print_prefix+'rebuild the catalog if new files were added'
+                ' (SHARE.catalog_rebuild=True or run_prism.py catalog)', 30)
+
+def run_dir(cfg, day):
+    ''' wrf run directory initialized at 12Z of day '''
+    return cfg['OTHER']['src_wrf']+day.strftime('%Y/%Y%m/%Y%m%d12')
+
+def realtime_run(cfg):
+    '''
+    latest wrf run no later than relink_realtime_offsetday days ago,
+    return (run directory, catalog rows of its files by valid time)
+    '''
+    day=datetime.datetime.now()-datetime.timedelta(
+            days=int(cfg['OTHER']['relink_realtime_offsetday']))
+    while True:
+        src_wrfpath=run_dir(cfg, day)
+        if os.path.exists(src_wrfpath):
+            break
+        utils.write_log(src_wrfpath+' not found, try 1 day before',30)
+        day=day-datetime.timedelta(days=1)
+
+    dirs, paths=_scan_dir(src_wrfpath, lambda name: WRF_PAT.match(name) is not None)
+    utils.write_log('%s%d files found in %s' % (print_prefix, len(paths), src_wrfpath))
+    return src_wrfpath, _wrf_frame(sorted(paths))
+
+def scan_gfs(gfs_src, init_ts, fmt='nc'):
+    '''
+    gfs forecast files (gfs.tHHz.pgrb2.0p25.fFFF.<fmt>, fmt: nc/grib2)
+    in gfs_src, the cycle HH is taken on the day of init_ts (the day
+    before if later than init_ts), valid time is the cycle plus the lead
+    hours; a valid time found in several cycles is kept from the latest,
+    return catalog rows sorted by valid time
+    '''
+    match=lambda name: GFS_PAT.match(name) is not None and name.endswith('.'+fmt)
+    dirs, paths=_scan_dir(gfs_src, match)
+    matches=[GFS_PAT.match(os.path.basename(p)) for p in paths]
+    init_ts=pd.Timestamp(init_ts)
+    init=init_ts.normalize()+pd.to_timedelta([int(m.group(1)) for m in matches], unit='h')
+    init=init.where(init <= init_ts, init-pd.Timedelta(days=1))
+    df=pd.DataFrame({
+        'valid_time':init+pd.to_timedelta([int(m.group(2)) for m in matches], unit='h'),
+        'init_time':init, 'group':'', 'path':paths})
+    return latest_run(df)
+
+def link_files(fn_list, dest, clean=False):
+    ''' symlink files into dest (replace links of the same name), clean removes old entries first '''
+    if clean:
+        with os.scandir(dest) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    os.remove(entry.path)
+    for fn in fn_list:
+        link=os.path.join(dest, os.path.basename(fn))
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(fn, link)
@@ -0,0 +1,246 @@
+#/usr/bin/env python
+"""
+Weather-type analytics over cluster time series
+
+The type series of a cluster csv (db/train_cluster*.csv, the inference
+or reclassified outputs) is loaded as integer arrays and laid on its
+regular time step, so gaps never join two records. Frequencies, run
+lengths, transitions and lagged co-occurrences are computed by bincount
+and run-length operations over the whole series, with no python loop
+over records, and returned as xarray/pandas objects.
+
+    Functions:
+    -----------
+        load_types(fn): times and type ids of a cluster csv
+        frequency(times, ids, nnodes, by): type counts and frequencies
+        run_lengths(times, ids, step): runs of consecutive same types
+        persistence(times, ids, nnodes, step): run length stats per type
+        transition_matrix(times, ids, nnodes, by, step): one-step transitions
+        cooccurrence(times, ids, nnodes, lags, step): lagged co-occurrence
+        analyze(cfg, pipeline): all statistics of ana_src to ana_out
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import lib
+from utils import utils
+
+print_prefix='lib.type_analytics>>'
+CWD=sys.path[0]
+
+SEASONS=['DJF', 'MAM', 'JJA', 'SON']
+
+def load_types(fn):
+    '''
+    times (DatetimeIndex) and type ids (int64) of a cluster csv, the
+    type_id column, or the last one for csv files without header
+    '''
+    with open(fn) as f:
+        has_header='type_id' in f.readline()
+    df=pd.read_csv(fn, index_col=0, header=0 if has_header else None)
+    ids=(df['type_id'] if has_header else df.iloc[:,-1]).values.astype(np.int64)
+    # csv files of earlier versions stamp times as %Y%m%d_%H:%M:%S
+    try:
+        times=pd.DatetimeIndex(pd.to_datetime(df.index, format='%Y%m%d_%H:%M:%S'))
+    except (ValueError, TypeError):
+        times=pd.DatetimeIndex(pd.to_datetime(df.index))
+    order=np.argsort(times.values, kind='stable')
+    return times[order], ids[order]
+
+def get_step(times):
+    ''' most frequent positive interval of times '''
+    diff=np.diff(times.values.astype(np.int64))
+    diff=diff[diff > 0]
+    if len(diff)==0:
+        return pd.Timedelta(hours=1)
+    vals, counts=np.unique(diff, return_counts=True)
+    return pd.Timedelta(int(vals[counts.argmax()]), unit='ns')
+
+def get_positions(times, step):
+    '''
+    index of each time on the regular grid of step from times[0], times
+    off that grid or repeated cannot be placed and raise
+    '''
+    offset=times.values.astype(np.int64)-times.values[0].astype(np.int64)
+    off_grid=np.flatnonzero(offset%step.value)
+    if len(off_grid):
+        utils.throw_error(print_prefix, '%d times are not on the %s step from %s, first: %s' % (
+            len(off_grid), step, times[0], times[off_grid[0]]))
+    pos=offset//step.value
+    if (np.diff(pos)==0).any():
+        utils.throw_error(print_prefix, 'repeated time: '+str(times[np.flatnonzero(np.diff(pos)==0)[0]]))
+    return pos
+
+def group_keys(times, by):
+    ''' group index of each time and the group labels, by: month, season or hour '''
+    if by=='month':
+        return times.month.values-1, np.arange(1, 13)
+    if by=='season':
+        return (times.month.values%12)//3, np.array(SEASONS)
+    if by=='hour':
+        labels, keys=np.unique(times.hour.values, return_inverse=True)
+        return keys, labels
+    utils.throw_error(print_prefix, 'unknown grouping: '+str(by))
+
+def _get_nnodes(ids, nnodes):
+    ''' nnodes, or the largest type in ids if None '''
+    return int(ids.max())+1 if nnodes is None else nnodes
+
+def frequency(times, ids, nnodes=None, by=None):
+    ''' count and relative frequency of each type, overall or per group of by '''
+    nnodes=_get_nnodes(ids, nnodes)
+    types=np.arange(nnodes)
+    if by is None:
+        count=np.bincount(ids, minlength=nnodes)
+        dims, coords=['type_id'], {'type_id':types}
+    else:
+        keys, labels=group_keys(times, by)
+        count=np.bincount(keys*nnodes+ids,
+                minlength=len(labels)*nnodes).reshape(len(labels), nnodes)
+        dims, coords=[by, 'type_id'], {by:labels, 'type_id':types}
+    with np.errstate(invalid='ignore'):
+        freq=count/count.sum(axis=-1, keepdims=True)
+    return xr.Dataset({'count':(dims, count), 'freq':(dims, freq)}, coords=coords)
+
+def run_lengths(times, ids, step=None):
+    '''
+    runs of the same type on consecutive steps, a gap in times ends the
+    run, DataFrame of start, type_id and length (steps)
+    '''
+    step=get_step(times) if step is None else step
+    pos=get_positions(times, step)
+    brk=np.ones(len(ids), dtype=bool)
+    brk[1:]=(ids[1:]!=ids[:-1]) | (np.diff(pos)!=1)
+    starts=np.flatnonzero(brk)
+    lengths=np.diff(np.append(starts, len(ids)))
+    return pd.DataFrame({'start':times[starts], 'type_id':ids[starts], 'length':lengths})
+
+def persistence(times, ids, nnodes=None, step=None):
+    ''' number, mean and max length (hours) of the runs of each type '''
+    nnodes=_get_nnodes(ids, nnodes)
+    step=get_step(times) if step is None else step
+    runs=run_lengths(times, ids, step)
+    rid, rlen=runs['type_id'].values, runs['length'].values
+    nruns=np.bincount(rid, minlength=nnodes)
+    max_len=np.zeros(nnodes, dtype=np.int64)
+    np.maximum.at(max_len, rid, rlen)
+    hrs=step/pd.Timedelta(hours=1)
+    with np.errstate(invalid='ignore'):
+        mean_len=np.bincount(rid, weights=rlen, minlength=nnodes)/nruns
+    return pd.DataFrame({'nruns':nruns, 'mean_hrs':mean_len*hrs, 'max_hrs':max_len*hrs},
+            index=pd.Index(np.arange(nnodes), name='type_id'))
+
+def _pair_counts(pos, ids, keys, nkeys, nnodes, lag):
+    ''' counts of (key, type at t, type at t+lag steps) '''
+    full=np.full(pos[-1]+1, -1, dtype=np.int64)
+    full[pos]=ids
+    if lag >= len(full):
+        return np.zeros((nkeys, nnodes, nnodes), dtype=np.int64)
+    src, dst=full[:len(full)-lag], full[lag:]
+    valid=(src >= 0) & (dst >= 0)
+    if keys is None:
+        kidx=np.zeros(valid.sum(), dtype=np.int64)
+    else:
+        kfull=np.zeros(len(full), dtype=np.int64)
+        kfull[pos]=keys
+        kidx=kfull[:len(full)-lag][valid]
+    flat=(kidx*nnodes+src[valid])*nnodes+dst[valid]
+    return np.bincount(flat, minlength=nkeys*nnodes*nnodes).reshape(nkeys, nnodes, nnodes)
+
+def _row_norm(count):
+    ''' normalize the last axis to sum to 1, NaN for empty rows '''
+    with np.errstate(invalid='ignore'):
+        return count/count.sum(axis=-1, keepdims=True)
+
+def transition_matrix(times, ids, nnodes=None, by=None, step=None):
+    '''
+    counts and probabilities (rows sum to 1) of one-step transitions,
+    overall or per group of by (group of the from time)
+    '''
+    nnodes=_get_nnodes(ids, nnodes)
+    step=get_step(times) if step is None else step
+    pos=get_positions(times, step)
+    types=np.arange(nnodes)
+    if by is None:
+        count=_pair_counts(pos, ids, None, 1, nnodes, 1)[0]
+        dims, coords=['from_type', 'to_type'], {}
+    else:
+        keys, labels=group_keys(times, by)
+        count=_pair_counts(pos, ids, keys, len(labels), nnodes, 1)
+        dims, coords=[by, 'from_type', 'to_type'], {by:labels}
+    coords.update(from_type=types, to_type=types)
+    return xr.Dataset({'count':(dims, count), 'prob':(dims, _row_norm(count))}, coords=coords)
+
+def cooccurrence(times, ids, nnodes=None, lags=(1,), step=None):
+    '''
+    counts of (type at t, type at t+lag) for each lag in steps, prob is
+    the conditional frequency of the lagged type, lift its ratio to the
+    climatological frequency of that type
+    '''
+    nnodes=_get_nnodes(ids, nnodes)
+    step=get_step(times) if step is None else step
+    pos=get_positions(times, step)
+    count=np.stack([_pair_counts(pos, ids, None, 1, nnodes, lag)[0] for lag in lags])
+    prob=_row_norm(count)
+    clim=np.bincount(ids, minlength=nnodes)/len(ids)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lift=prob/clim[np.newaxis, np.newaxis, :]
+    dims=['lag', 'type_a', 'type_b']
+    types=np.arange(nnodes)
+    return xr.Dataset({'count':(dims, count), 'prob':(dims, prob), 'lift':(dims, lift)},
+            coords={'lag':np.asarray(lags), 'type_a':types, 'type_b':types},
+            attrs={'lag_unit':str(step)})
+
+def analyze(cfg, pipeline):
+    '''
+    frequencies and transitions by ana_groups, persistence and lagged
+    co-occurrence of ana_src, written to ana_out
+    '''
+    sfx='' if pipeline=='wrf' else '_era5'
+    src_fn=get_path(cfg['ANALYTICS'].get('ana_src', fallback='./db/train_cluster'+sfx+'.csv'))
+    out_fn=get_path(cfg['ANALYTICS'].get('ana_out', fallback='./output/type_analytics'+sfx+'.nc'))
+    groups=lib.cfgparser.cfg_get_varlist(cfg, 'ANALYTICS', 'ana_groups') \
+            if cfg['ANALYTICS'].get('ana_groups', fallback='').strip() else []
+    lags=[int(lag) for lag in lib.cfgparser.cfg_get_varlist(cfg, 'ANALYTICS', 'ana_lags')] \
+            if cfg['ANALYTICS'].get('ana_lags', fallback='').strip() else [1]
+
+    times, ids=load_types(src_fn)
+    # node count of the archived model, or the largest type in the series
+    nnodes=int(ids.max())+1
+    db_fn=CWD+'/db/som_cluster'+sfx+'.nc'
+    if os.path.exists(db_fn):
+        with xr.open_dataset(db_fn) as db_in:
+            nnodes=max(nnodes, db_in.sizes['n_nodex']*db_in.sizes['n_nodey'])
+    step=get_step(times)
+    utils.write_log('%s%d records of %d types in %s, step %s' % (
+        print_prefix, len(ids), nnodes, src_fn, step))
+
+    ds_list=[frequency(times, ids, nnodes)]
+    trans=transition_matrix(times, ids, nnodes, step=step)
+    ds_list.append(trans.rename(count='trans_count', prob='trans_prob'))
+    for by in groups:
+        ds_list.append(frequency(times, ids, nnodes, by).rename(
+            count='count_'+by, freq='freq_'+by))
+        ds_list.append(transition_matrix(times, ids, nnodes, by, step).rename(
+            count='trans_count_'+by, prob='trans_prob_'+by))
+    pers=persistence(times, ids, nnodes, step)
+    ds_list.append(xr.Dataset({'run_'+col:(['type_id'], pers[col].values)
+        for col in pers.columns}))
+    cooc=cooccurrence(times, ids, nnodes, lags, step)
+    ds_list.append(cooc.rename(count='cooc_count', prob='cooc_prob', lift='cooc_lift'))
+
+    ds_out=xr.merge(ds_list)
+    ds_out.attrs={'source':src_fn, 'nrecords':len(ids), 'step':str(step)}
+    os.makedirs(os.path.dirname(out_fn), exist_ok=True)
+    ds_out.to_netcdf(out_fn)
+    utils.write_log(print_prefix+'type analytics written to '+out_fn)
+    return ds_out
+
+def get_path(fn):
+    ''' paths relative to the Prism root '''
+    if os.path.isabs(fn):
+        return fn
+    return os.path.join(CWD, fn)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+'''
+Date: Oct 19, 2026
+Unified command-line entry point of Prism
+
+    build: train and archive the model
+    infer: cast the archived model on inference data
+    update: fine-tune the archived model on new records (UPDATE section)
+    bench: time the import, load, and construct stages without output
+    gs-worker: join a grid search broker (GRID_SEARCH.gs_mode=broker)
+    catalog: (re)build the source catalog of the training files
+    reclassify: classify the ERA5 archive by the archived model (RECLASSIFY section)
+    composite: per-type composites of the source files (COMPOSITE section)
+    analytics: frequencies, persistence and transitions of a type series (ANALYTICS section)
+    plan: estimate memory and runtime of a build, fit workers and sizes (PLAN section)
+
+Usage:
+    python3 run_prism.py build
+    python3 run_prism.py infer --pipeline era5-gfs
+    python3 run_prism.py update -s UPDATE.update_start=20210101 -s UPDATE.update_end=20210131
+    python3 run_prism.py infer --config conf/config.ini -s INFERENCE.match_hist=False
+    python3 run_prism.py bench --stage infer
+    python3 run_prism.py gs-worker --broker node01:50000
+    python3 run_prism.py catalog -s SHARE.catalog_nworkers=16
+    python3 run_prism.py reclassify --pipeline era5-gfs -s RECLASSIFY.reclass_start=197901
+    python3 run_prism.py composite -s COMPOSITE.comp_vars=T2,RAINNC
+    python3 run_prism.py analytics -s ANALYTICS.ana_src=./output/inference_cluster.csv
+    python3 run_prism.py plan --pipeline era5-gfs -s TRAINING.training_start=19790101
+
+Heavy modules (wrf-python, minisom, sklearn, the unused preprocessors)
+are only imported on the code paths that need them.
+
+Zhenning LI
+'''
+
+import time
+TIC_IMPORT=time.time()
+
+import sys, argparse
+
+import lib
+import core
+from utils import utils
+
+CWD=sys.path[0]
+
+# pipeline: default config, training mesh, inference mesh, prism module
+PIPELINES={
+    'wrf':{
+        'cfg':'config.ini',
+        'train_mesh':('preprocess_wrfinp', 'WrfMesh'),
+        'infer_mesh':('preprocess_wrfinp', 'WrfMesh'),
+        'prism':'prism'},
+    'era5-gfs':{
+        'cfg':'config.era5-gfs.ini',
+        'train_mesh':('preprocess_erainp', 'ERAMesh'),
+        'infer_mesh':('preprocess_gfsinp', 'GFSMesh'),
+        'prism':'prism_era5_gfs'}}
+
+# commands served by one pipeline only, its config is the default
+CMD_PIPELINES={'reclassify':'era5-gfs'}
+
+def parse_args(argv=None):
+    """ parse command line arguments """
+    parser=argparse.ArgumentParser(
+            prog='prism', description='SOM-based weather type classifier')
+    parser.add_argument(
+            'cmd', choices=['build', 'infer', 'update', 'bench', 'gs-worker', 'catalog', 'reclassify', 'composite', 'analytics', 'plan'],
+            help='build the model, infer on new data, update the model, bench the stages, join a grid search broker, build the source catalog, reclassify the ERA5 archive, composite fields by type, analyze a type series, or plan a build')
+    parser.add_argument(
+            '-p', '--pipeline', choices=list(PIPELINES), default=None,
+            help='wrf or era5-gfs, inferred from the config if not set')
+    parser.add_argument(
+            '-c', '--config', default=None,
+            help='config file, default ./conf/config.ini or ./conf/config.era5-gfs.ini')
+    parser.add_argument(
+            '-s', '--set', action='append', default=[], metavar='SECTION.key=value',
+            help='override a config option, can be repeated')
+    parser.add_argument(
+            '--stage', choices=['build', 'infer'], default='infer',
+            help='stage to bench, only for the bench command')
+    parser.add_argument(
+            '--broker', default=None, metavar='HOST:PORT',
+            help='grid search broker address, only for the gs-worker command')
+    parser.add_argument(
+            '--cache', default=None,
+            help='feature cache path on this host, only for the gs-worker command')
+    return parser.parse_args(argv)
+
+def load_cfg(args):
+    """ read config file and apply command line overrides """
+    pipeline=args.pipeline or CMD_PIPELINES.get(args.cmd, 'wrf')
+    cfg_fn=args.config or CWD+'/conf/'+PIPELINES[pipeline]['cfg']
+    cfg_hdl=lib.cfgparser.read_cfg(cfg_fn)
+
+    for item in args.set:
+        try:
+            key, value=item.split('=', 1)
+            section, option=key.split('.', 1)
+        except ValueError:
+            utils.throw_error('run_prism>>', 'bad override, use SECTION.key=value: '+item)
+        if not cfg_hdl.has_section(section.strip()):
+            utils.throw_error('run_prism>>', 'no [%s] section in %s for override %s' % (
+                section.strip(), cfg_fn, item))
+        cfg_hdl[section.strip()][option.strip()]=value.strip()
+
+    # infer pipeline from the config if not given
+    if args.pipeline is None:
+        if cfg_hdl.has_option('TRAINING', 'era5_src'):
+            pipeline='era5-gfs'
+
+    return cfg_hdl, pipeline
+
+def get_mesh(pipeline, stage):
+    """ get mesh class of the pipeline, only its preprocessor is imported """
+    mod_name, cls_name=PIPELINES[pipeline][stage+'_mesh']
+    return getattr(getattr(lib, mod_name), cls_name)
+
+def run_build(cfg_hdl, pipeline, time_mgr):
+    """ training pipeline """
+    use_catalog=cfg_hdl['SHARE'].getboolean('use_catalog', fallback=False)
+    if pipeline=='wrf' and cfg_hdl['OTHER'].getboolean('relink_pathwrf') and not use_catalog:
+        utils.write_log('Relink training pathwrf...')
+        utils.link_path(cfg_hdl)
+
+    # memory and runtime plan before loading, fitted options applied if plan_auto
+    if cfg_hdl.getboolean('PLAN', 'plan_before_build', fallback=True):
+        lib.build_planner.plan(cfg_hdl, pipeline)
+        time_mgr.toc('PLAN')
+
+    # init grid searcher for hyper-parameter optimazation
+    grid_searcher=lib.grid_searcher.GridSearcher(cfg_hdl)
+
+    # init mesh handler and read training data
+    mesh_hdl=get_mesh(pipeline, 'train')(cfg_hdl)
+    time_mgr.toc('LOAD')
+
+    # initiate clusterer
+    prism=getattr(core, PIPELINES[pipeline]['prism']).Prism(mesh_hdl, cfg_hdl)
+    time_mgr.toc('CONSTRUCT')
+
+    grid_searcher.search(cfg_hdl, prism)
+    time_mgr.toc('TRAIN')
+
+def run_infer(cfg_hdl, pipeline, time_mgr):
+    """ inference pipeline """
+    use_catalog=cfg_hdl['SHARE'].getboolean('use_catalog', fallback=False)
+    if pipeline=='wrf' and cfg_hdl['OTHER'].getboolean('relink_realtimewrf') and not use_catalog:
+        utils.write_log('Relink realtime pathwrf...')
+        utils.link_realtime(cfg_hdl)
+    time_mgr.toc('FETCH')
+
+    utils.write_log('Preprocess inference data...')
+    if pipeline=='era5-gfs' and cfg_hdl['INFERENCE'].getboolean('down_realtime_gfs'):
+        # lead times are decoded as they are downloaded
+        utils.write_log('Download realtime GFS...')
+        mesh_hdl=get_mesh(pipeline, 'infer')(cfg_hdl, 'inference',
+                fetcher=lib.gfs_fetcher.GFSFetcher(cfg_hdl))
+    else:
+        mesh_hdl=get_mesh(pipeline, 'infer')(cfg_hdl, 'inference')
+    time_mgr.toc('LOAD')
+
+    utils.write_log('Construct Prism...')
+    prism=getattr(core, PIPELINES[pipeline]['prism']).Prism(
+            mesh_hdl, cfg_hdl, 'inference')
+    time_mgr.toc('CONSTRUCT')
+
+    utils.write_log('Prism Cast...')
+    prism.cast()
+    time_mgr.toc('CAST')
+
+def run_update(cfg_hdl, pipeline, time_mgr):
+    """ update pipeline, fine-tune the archived model on new records """
+    # new records are read by the training mesh over the update range
+    cfg_hdl['TRAINING']['training_start']=cfg_hdl['UPDATE']['update_start']
+    cfg_hdl['TRAINING']['training_end']=cfg_hdl['UPDATE']['update_end']
+    
+    utils.write_log('Read new records...')
+    mesh_hdl=get_mesh(pipeline, 'train')(cfg_hdl)
+    time_mgr.toc('LOAD')
+
+    prism=getattr(core, PIPELINES[pipeline]['prism']).Prism(
+            mesh_hdl, cfg_hdl, 'update')
+    time_mgr.toc('CONSTRUCT')
+
+    utils.write_log('Prism Update...')
+    prism.update()
+    time_mgr.toc('TRAIN')
+    
+    prism.archive_update()
+    time_mgr.toc('ARCHIVE')
+
+def run_catalog(cfg_hdl, pipeline):
+    """ rebuild the source catalog of the training files """
+    source='wrf' if pipeline=='wrf' else 'era5'
+    lib.source_catalog.load_catalog(cfg_hdl, source, rebuild=True)
+
+def run_reclassify(cfg_hdl, pipeline, time_mgr):
+    """ classify the ERA5 archive in monthly chunks by the archived model """
+    if pipeline!='era5-gfs':
+        utils.throw_error('run_prism>>', 'reclassify is available for the era5-gfs pipeline only')
+    lib.reclassifier.reclassify(cfg_hdl)
+    time_mgr.toc('RECLASSIFY')
+
+def run_composite(cfg_hdl, pipeline, time_mgr):
+    """ per-type composites of the assigned records """
+    lib.composites.Composer(cfg_hdl, pipeline).run()
+    time_mgr.toc('COMPOSITE')
+
+def run_analytics(cfg_hdl, pipeline, time_mgr):
+    """ frequencies, persistence and transitions of a type series """
+    lib.type_analytics.analyze(cfg_hdl, pipeline)
+    time_mgr.toc('ANALYTICS')
+
+def run_plan(cfg_hdl, pipeline, time_mgr):
+    """ memory and runtime plan of a build, nothing is loaded """
+    lib.build_planner.plan(cfg_hdl, pipeline)
+    time_mgr.toc('PLAN')
+
+def run_bench(cfg_hdl, pipeline, stage, time_mgr):
+    """ load and construct only, no model training or output """
+    if stage=='build':
+        mesh_hdl=get_mesh(pipeline, 'train')(cfg_hdl)
+        call_from='trainning'
+    else:
+        mesh_hdl=get_mesh(pipeline, 'infer')(cfg_hdl, 'inference')
+        call_from='inference'
+    time_mgr.toc('LOAD')
+
+    getattr(core, PIPELINES[pipeline]['prism']).Prism(
+            mesh_hdl, cfg_hdl, call_from)
+    time_mgr.toc('CONSTRUCT')
+
+def main_run(argv=None):
+
+    print('*************************PRISM START*************************')
+
+    args=parse_args(argv)
+
+    # wall-clock ticks
+    time_mgr=lib.time_manager.TimeManager()
+    time_mgr.tic0=time_mgr.tic=TIC_IMPORT
+    time_mgr.toc('IMPORT')
+
+    # logging manager, records of forked workers go to one writer
+    lib.log_manager.setup(CWD+'/conf/logging_config.ini')
+
+    utils.write_log('Read Config...')
+    cfg_hdl, pipeline=load_cfg(args)
+    lib.log_manager.set_interval(cfg_hdl['SHARE'].get('progress_interval', fallback='10'))
+    utils.write_log('Run %s with %s pipeline...' % (args.cmd, pipeline))
+    time_mgr.toc('CONFIG')
+
+    if args.cmd=='build':
+        run_build(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='infer':
+        run_infer(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='update':
+        run_update(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='gs-worker':
+        broker=args.broker or cfg_hdl['GRID_SEARCH'].get('gs_broker')
+        lib.gs_broker.run_worker(
+                lib.gs_broker.parse_address(broker), 
+                lib.gs_broker.get_authkey(cfg_hdl),
+                cache_fn=args.cache)
+    elif args.cmd=='catalog':
+        run_catalog(cfg_hdl, pipeline)
+    elif args.cmd=='reclassify':
+        run_reclassify(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='composite':
+        run_composite(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='analytics':
+        run_analytics(cfg_hdl, pipeline, time_mgr)
+    elif args.cmd=='plan':
+        run_plan(cfg_hdl, pipeline, time_mgr)
+    else:
+        run_bench(cfg_hdl, pipeline, args.stage, time_mgr)
+        time_mgr.dump()
+
+    print('*********************PRISM ACCOMPLISHED*********************')
+
+if __name__=='__main__':
+    main_run()
@@ -0,0 +1,141 @@
+#/usr/bin/env python
+"""
+Tests of lib.analog against a brute-force scan of a small synthetic
+history store, integer-valued records so that distance ties are exact
+"""
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.analog
+import lib.hist_store
+
+NNODES=6
+
+def day365(dateseries):
+    ''' day of a non-leap year, Feb 29 as Feb 28 '''
+    dateseries=pd.DatetimeIndex(dateseries)
+    day=np.where((dateseries.month==2) & (dateseries.day==29), 28, dateseries.day)
+    return np.array([pd.Timestamp(2001, m, d).dayofyear-1
+        for m, d in zip(dateseries.month, day)])
+
+def brute_topk(query, data, k, mask):
+    ''' top-k by distance, then by record, over the records in mask '''
+    idx=np.full((len(query), k), -1)
+    dis=np.full((len(query), k), np.inf)
+    for iq, q in enumerate(query):
+        cand=np.flatnonzero(mask[iq])
+        d=np.sqrt(((data[cand]-q)**2).sum(axis=1))
+        sel=np.lexsort((cand, d))[:k]
+        idx[iq,:len(sel)], dis[iq,:len(sel)]=cand[sel], d[sel]
+    return idx, dis
+
+class TestAnalog(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp=tempfile.mkdtemp()
+        rng=np.random.default_rng(0)
+        # 2011-2013 with the 2012 leap year, twice a day
+        cls.ts=pd.date_range('2011-01-01', '2013-12-31 12:00', freq='12H')
+        cls.data=rng.integers(0, 3, (len(cls.ts), 8)).astype(np.float64)
+        cls.nodes=rng.integers(0, NNODES, len(cls.ts))
+        cls.centroids=np.stack([cls.data[cls.nodes==n].mean(axis=0) for n in range(NNODES)])
+
+        cls.hist_fn=os.path.join(cls.tmp, 'som_hist.nc')
+        lib.hist_store.write_hist(cls.hist_fn, cls.data, cls.ts, dtype='float64', chunk=64)
+        with lib.hist_store.open_hist(cls.hist_fn) as hist_ds:
+            index=lib.analog.build_index(cls.ts, cls.nodes, NNODES, hist_ds, cls.centroids)
+        lib.hist_store.append_index(cls.hist_fn, index)
+        cls.hist_ds=lib.hist_store.open_hist(cls.hist_fn)
+
+        # queries on calendar edges, perturbed archive records and new vectors
+        cls.qts=pd.DatetimeIndex(['2014-01-01', '2014-02-28', '2016-02-29', '2014-03-01',
+            '2014-12-31', '2016-12-31', '2014-06-15', '2014-07-01'])
+        cls.query=np.concatenate([cls.data[[5, 117, 300, 999]],
+            rng.integers(0, 3, (4, 8)).astype(np.float64)])
+        cls.qnodes=rng.integers(0, NNODES, len(cls.qts))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hist_ds.close()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def window_mask(self, window_days):
+        ''' records within +/-window_days on the 365-day calendar '''
+        diff=np.abs(day365(self.qts)[:,np.newaxis]-day365(self.ts)[np.newaxis,:])
+        return np.minimum(diff, 365-diff) <= window_days
+
+    def check(self, idx, dis, ref_idx, ref_dis):
+        np.testing.assert_array_equal(idx, ref_idx)
+        np.testing.assert_allclose(dis, ref_dis, rtol=0, atol=1e-9)
+
+    def test_calendar_day(self):
+        cday=lib.analog.calendar_day(pd.DatetimeIndex(
+            ['2011-01-01', '2011-02-28', '2012-02-29', '2011-03-01', '2011-12-31', '2012-12-31']))
+        np.testing.assert_array_equal(cday, [0, 58, 59, 60, 365, 365])
+
+    def test_whole_archive(self):
+        mask=np.ones((len(self.query), len(self.ts)), dtype=bool)
+        for k in (1, 5, 40):
+            idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=k, chunk=50)
+            self.check(idx, dis, *brute_topk(self.query, self.data, k, mask))
+
+    def test_calendar_window(self):
+        for window_days in (0, 1, 3):
+            mask=self.window_mask(window_days)
+            idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=4,
+                    query_ts=self.qts, window_days=window_days, chunk=50)
+            self.check(idx, dis, *brute_topk(self.query, self.data, 4, mask))
+
+    def test_window_wraps_year_end(self):
+        cand=lib.analog.get_candidates(lib.analog.load_index(self.hist_ds),
+                lib.analog.calendar_day(pd.DatetimeIndex(['2014-01-01']))[0], window_days=1)
+        days=sorted(set(zip(self.ts[cand].month, self.ts[cand].day)))
+        self.assertEqual(days, [(1, 1), (1, 2), (12, 31)])
+        self.assertEqual(sorted(set(self.ts[cand].year)), [2011, 2012, 2013])
+
+    def test_window_and_node(self):
+        mask=self.window_mask(5) & (self.nodes[np.newaxis,:]==self.qnodes[:,np.newaxis])
+        idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=3,
+                query_ts=self.qts, window_days=5, query_nodes=self.qnodes, chunk=7)
+        self.check(idx, dis, *brute_topk(self.query, self.data, 3, mask))
+
+    def test_fewer_candidates_than_k(self):
+        mask=self.window_mask(0) & (self.nodes[np.newaxis,:]==self.qnodes[:,np.newaxis])
+        k=int(mask.sum(axis=1).max())+2
+        idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=k,
+                query_ts=self.qts, window_days=0, query_nodes=self.qnodes)
+        self.check(idx, dis, *brute_topk(self.query, self.data, k, mask))
+        self.assertTrue((idx[:,-1]==-1).all())
+
+    def test_node_search(self):
+        mask=np.ones((len(self.query), len(self.ts)), dtype=bool)
+        for k in (1, 5, 40):
+            for query_nodes in (None, self.qnodes):
+                idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=k,
+                        query_nodes=query_nodes, centroids=self.centroids,
+                        same_node=False, method='node')
+                self.check(idx, dis, *brute_topk(self.query, self.data, k, mask))
+
+    def test_node_search_same_node(self):
+        mask=self.nodes[np.newaxis,:]==self.qnodes[:,np.newaxis]
+        idx, dis=lib.analog.retrieve_analogs(self.query, self.hist_ds, k=6,
+                query_nodes=self.qnodes, centroids=self.centroids, method='node')
+        self.check(idx, dis, *brute_topk(self.query, self.data, 6, mask))
+
+    def test_node_index_sorted(self):
+        index=lib.analog.load_index(self.hist_ds)
+        order, offset, cdis=index['node_order'], index['node_offset'], index['node_cdis']
+        for n in range(NNODES):
+            rec=order[offset[n]:offset[n+1]]
+            self.assertTrue((self.nodes[rec]==n).all())
+            np.testing.assert_allclose(cdis[offset[n]:offset[n+1]],
+                    np.linalg.norm(self.data[rec]-self.centroids[n], axis=1))
+            self.assertTrue((np.diff(cdis[offset[n]:offset[n+1]]) >= 0).all())
+        self.assertEqual(offset[-1], len(self.ts))
+
+if __name__=='__main__':
+    unittest.main()
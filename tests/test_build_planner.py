@@ -0,0 +1,114 @@
+#/usr/bin/env python
+"""
+Tests of lib.build_planner byte estimates of tiny configs, the host and
+its benchmark rates are fixed
+"""
+
+import os, sys, shutil, tempfile, unittest, configparser
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.build_planner as bp
+
+RATES={'gemm':1e9, 'membw':1e9, 'iter':1e-4}
+# training buffer of the era5 config: 120 records x 4 vars x 3x3 grid
+BUF=120*36*8.0
+UNIT=2.0*31*4*36*8
+
+class TestBuildPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+        era5_src=os.path.join(self.tmp, 'era5')
+        os.makedirs(era5_src)
+        # only the Jan surf file exists, 2.5 deg grid
+        xr.Dataset({'u10':(['time', 'latitude', 'longitude'], np.zeros((1, 5, 5)))},
+            coords={'time':pd.date_range('2020-01-01', periods=1),
+                'latitude':np.arange(30.0, 19.0, -2.5),
+                'longitude':np.arange(100.0, 111.0, 2.5)}).to_netcdf(
+            os.path.join(era5_src, '202001-surf.nc'))
+        self.surf_bytes=os.path.getsize(os.path.join(era5_src, '202001-surf.nc'))
+
+        self.cfg=configparser.ConfigParser()
+        self.cfg.read_dict({
+            'SHARE':{'ntasks':'2', 'dsmp_interval':'1', 'var':'T2, U10',
+                's_sn':'21', 'e_sn':'29', 's_we':'101', 'e_we':'109'},
+            'TRAINING':{'era5_src':era5_src, 'training_start':'20200101',
+                'training_end':'20200229', 'sub_hrs':'0, 12', 'sub_mons':'-1',
+                'n_nodex':'2', 'n_nodey':'3', 'grid_search_opt':'False',
+                'preprocess_method':'temporal_norm', 'iterations':'1000'},
+            'GRID_SEARCH':{'gs_sigma':'1.0', 'gs_learning_rate':'0.5',
+                'gs_nodexy':'2x3, 3x4', 'gs_nb_func':'gaussian',
+                'gs_iterations':'1000', 'gs_nworkers':'4'}})
+
+        self.saved=bp.CWD, bp.host_resources, bp.measure_rates
+        bp.CWD=self.tmp
+        bp.host_resources=lambda: (64*bp.GB, 8)
+        bp.measure_rates=lambda nfea, nnodes: dict(RATES)
+
+    def tearDown(self):
+        bp.CWD, bp.host_resources, bp.measure_rates=self.saved
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def stages(self, build_plan):
+        ''' peak bytes and seconds of each stage by the configured options '''
+        if not build_plan.stages:
+            build_plan.estimate()
+        return {stage:(peak, secs) for stage, peak, secs, note in build_plan.stages}
+
+    def test_era5_bytes(self):
+        build_plan=bp.BuildPlan(self.cfg, 'era5-gfs')
+        self.assertEqual((build_plan.nrec, build_plan.nrow, build_plan.ncol), (120, 3, 3))
+        self.assertEqual((build_plan.nfea, build_plan.nunits), (36, 2))
+        self.assertEqual(build_plan.buf_bytes, BUF)
+        self.assertEqual(build_plan.unit_bytes, UNIT)
+        # missing files count 2 bytes per value
+        self.assertEqual(build_plan.src_bytes, self.surf_bytes+(31+29+29)*4*9*2.0)
+
+        stages=self.stages(build_plan)
+        self.assertNotIn('grid search', stages)
+        self.assertEqual(stages['load'][0], BUF+2*UNIT)
+        self.assertEqual(stages['normalize'][0], BUF+(2*120+3)*36*8)
+        self.assertEqual(stages['train'][0], BUF+4*6*36*8)
+        self.assertEqual(stages['evaluate'][0], BUF+120**2*8)
+        self.assertEqual(stages['archive'][0], 1.5*BUF)
+        self.assertAlmostEqual(stages['train'][1], 1000*1e-4+2.0*120*6*36/1e9)
+
+    def test_grid_search_bytes(self):
+        self.cfg['TRAINING']['grid_search_opt']='True'
+        self.cfg['TRAINING']['eval_sample']='50'
+        stages=self.stages(bp.BuildPlan(self.cfg, 'era5-gfs'))
+        # two workers, each with a sampled silhouette and the 3x4 codebook
+        worker=50**2*8+50*36*8+4*12*36*8
+        self.assertEqual(stages['grid search'][0], BUF+2*worker)
+        self.assertEqual(stages['evaluate'][0], BUF+50**2*8+50*36*8)
+
+    def test_wrf_without_files(self):
+        self.cfg['TRAINING'].update(training_end='20200102', sub_hrs='-1')
+        build_plan=bp.BuildPlan(self.cfg, 'wrf')
+        self.assertEqual((build_plan.nrec, build_plan.nvar), (25, 2))
+        self.assertEqual((build_plan.nrow, build_plan.ncol), (8, 8))
+        self.assertEqual(build_plan.buf_bytes, 25*2*64*8.0)
+        self.assertEqual(build_plan.src_bytes, 25*2*64*8.0)
+
+    def test_fit_to_budget(self):
+        # room for the buffer and one and a half decoded months
+        bp.host_resources=lambda: (BUF+1.5*UNIT, 8)
+        self.cfg['PLAN']={'plan_mem_frac':'1.0'}
+        build_plan=bp.plan(self.cfg, 'era5-gfs', apply=True)
+        self.assertEqual(build_plan.fitted[('SHARE', 'ntasks')], 1)
+        self.assertEqual(build_plan.fitted[('TRAINING', 'norm_chunk')], 16)
+        self.assertEqual(build_plan.fitted[('TRAINING', 'eval_sample')], 0)
+        self.assertEqual(self.cfg['SHARE']['ntasks'], '1')
+        self.assertEqual(self.stages(build_plan)['load'][0], BUF+UNIT)
+
+    def test_no_records(self):
+        self.cfg['TRAINING']['sub_mons']='7'
+        with self.assertRaises(SystemExit):
+            bp.BuildPlan(self.cfg, 'era5-gfs')
+
+if __name__=='__main__':
+    unittest.main()
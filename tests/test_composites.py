@@ -0,0 +1,119 @@
+#/usr/bin/env python
+"""
+Tests of lib.composites, per-node mean and std of a toy ERA5 archive
+against numpy
+"""
+
+import os, sys, shutil, tempfile, unittest, configparser
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.composites
+
+LAT=np.arange(30.0, 19.0, -2.5)
+LON=np.arange(100.0, 111.0, 2.5)
+
+class TestComposites(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+        rng=np.random.default_rng(0)
+        era5_src=os.path.join(self.tmp, 'era5')
+        os.makedirs(era5_src)
+        os.makedirs(os.path.join(self.tmp, 'db'))
+
+        # three months of 6-hourly fields, Feb has no file
+        self.fields={}
+        for month in ('2020-01', '2020-02', '2020-03'):
+            ts=pd.date_range(month+'-01', pd.Timestamp(month+'-01')+pd.offsets.MonthEnd(0)
+                    +pd.Timedelta(hours=18), freq='6H')
+            shape=(len(ts), len(LAT), len(LON))
+            surf={var:rng.normal(size=shape) for var in ('t2m', 'u10')}
+            h500={'z':5500.0+10.0*rng.normal(size=shape)}
+            for var, arr in list(surf.items())+list(h500.items()):
+                self.fields[(month, var)]=pd.Series(list(arr), index=ts)
+            if month=='2020-02':
+                continue
+            yyyymm=month.replace('-', '')
+            for grp, dic in (('surf', surf), ('h500', h500)):
+                xr.Dataset({var:(['time', 'latitude', 'longitude'], arr) for var, arr in dic.items()},
+                    coords={'time':ts, 'latitude':LAT, 'longitude':LON}).to_netcdf(
+                    os.path.join(era5_src, yyyymm+'-'+grp+'.nc'))
+
+        xr.Dataset({'type_id':(['n_nodex', 'n_nodey'], np.arange(6).reshape(2, 3))}).to_netcdf(
+            os.path.join(self.tmp, 'db', 'som_cluster_era5.nc'))
+
+        # a subset of the records, node 5 is never assigned
+        times=pd.date_range('2020-01-01', '2020-03-31 18:00', freq='6H')
+        times=times[rng.random(len(times)) < 0.6]
+        self.assign=pd.Series(rng.integers(0, 5, len(times)), index=times)
+        self.assign_fn=os.path.join(self.tmp, 'assign.csv')
+        pd.DataFrame({'type_id':self.assign}).to_csv(self.assign_fn, index_label='time')
+
+        self.cfg=configparser.ConfigParser()
+        self.cfg.read_dict({
+            'SHARE':{'ntasks':'2', 'use_catalog':'False', 'dsmp_interval':'1',
+                's_sn':'21', 'e_sn':'29', 's_we':'101', 'e_we':'109'},
+            'TRAINING':{'era5_src':era5_src},
+            'COMPOSITE':{'comp_vars':'t2m, z', 'comp_assign':self.assign_fn,
+                'comp_out':os.path.join(self.tmp, 'out', 'comp.nc')}})
+
+        self.cwd=lib.composites.CWD
+        lib.composites.CWD=self.tmp
+
+    def tearDown(self):
+        lib.composites.CWD=self.cwd
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_era5_composite(self):
+        lib.composites.Composer(self.cfg, 'era5-gfs').run()
+        with xr.open_dataset(os.path.join(self.tmp, 'out', 'comp.nc')) as ds:
+            ds.load()
+
+        # window 21-29N, 101-109E on the 2.5 deg grid
+        ilat=(LAT >= 21) & (LAT <= 29)
+        ilon=(LON >= 101) & (LON <= 109)
+        np.testing.assert_array_equal(ds['lat'].values, LAT[ilat])
+        np.testing.assert_array_equal(ds['lon'].values, LON[ilon])
+
+        assign=self.assign[self.assign.index.month!=2]
+        self.assertEqual(ds.attrs['nrecords'], len(assign))
+        for node in range(6):
+            ix, iy=divmod(node, 3)
+            sel=assign.index[assign.values==node]
+            self.assertEqual(int(ds['count'][ix, iy]), len(sel))
+            for ivar, var in enumerate(('t2m', 'z')):
+                comp_mean=ds['comp_mean'].values[ix, iy, ivar]
+                comp_std=np.sqrt(ds['comp_var'].values[ix, iy, ivar])
+                if len(sel)==0:
+                    self.assertTrue(np.isnan(comp_mean).all())
+                    continue
+                arr=np.stack([self.fields[(ts.strftime('%Y-%m'), var)][ts] for ts in sel])
+                arr=arr[:, ilat][:, :, ilon]
+                np.testing.assert_allclose(comp_mean, arr.mean(axis=0), rtol=1e-10)
+                np.testing.assert_allclose(comp_std, arr.std(axis=0), rtol=1e-6, atol=1e-8)
+
+    def test_accumulate_merge(self):
+        rng=np.random.default_rng(1)
+        fields=rng.normal(size=(50, 2, 3, 4))
+        type_ids=rng.integers(0, 4, 50)
+        acc_list=[lib.composites.new_acc(4, (2, 3, 4)) for ii in range(3)]
+        for acc, part in zip(acc_list, np.array_split(np.arange(50), 3)):
+            lib.composites.accumulate(acc, type_ids[part], fields[part])
+        acc=lib.composites.merge(acc_list)
+        for node in range(4):
+            sel=fields[type_ids==node]
+            self.assertEqual(acc['count'][node], len(sel))
+            np.testing.assert_allclose(acc['sum'][node], sel.sum(axis=0), rtol=1e-12)
+            np.testing.assert_allclose(acc['sumsq'][node], (sel*sel).sum(axis=0), rtol=1e-12)
+
+    def test_unknown_var(self):
+        self.cfg['COMPOSITE']['comp_vars']='t2m, tp'
+        with self.assertRaises(SystemExit):
+            lib.composites.Composer(self.cfg, 'era5-gfs')
+
+if __name__=='__main__':
+    unittest.main()
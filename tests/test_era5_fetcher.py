@@ -0,0 +1,105 @@
+#/usr/bin/env python
+"""
+Tests of lib.era5_fetcher with a stub CDS client writing small monthly
+files, no request leaves the host
+"""
+
+import os, sys, json, shutil, tempfile, threading, unittest, configparser
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.era5_fetcher
+
+def write_month(fn, yyyymm, group, short=False):
+    ''' monthly file of group, one time step missing if short '''
+    ntime=pd.Timestamp(yyyymm+'01').days_in_month*lib.era5_fetcher.STEPS_PER_DAY-int(short)
+    with nc4.Dataset(fn, 'w') as nc:
+        nc.createDimension('time', ntime)
+        nc.createDimension('latitude', 2)
+        nc.createDimension('longitude', 2)
+        for var in lib.era5_fetcher.GROUPS[group][2]:
+            nc.createVariable(var, 'f4', ('time', 'latitude', 'longitude'))[:]=np.zeros((ntime, 2, 2))
+
+class StubClient:
+    ''' cdsapi.Client stand-in, the first answer of each key in short misses a time step '''
+
+    calls, short=[], set()
+    lock=threading.Lock()
+
+    def retrieve(self, dataset, req, target):
+        group='surf' if 'single' in dataset else 'h500'
+        yyyymm=req['year']+req['month']
+        key=yyyymm+'-'+group
+        with self.lock:
+            self.calls.append(key)
+            short=key in self.short
+            self.short.discard(key)
+        write_month(target, yyyymm, group, short=short)
+
+class TestERA5Retriever(unittest.TestCase):
+
+    def setUp(self):
+        self.era_src=tempfile.mkdtemp()
+        self.cfg=configparser.ConfigParser()
+        self.cfg['TRAINING']={
+            'era5_src':self.era_src, 'era5_fetch_start':'201001', 'era5_fetch_end':'201003',
+            'era5_nrequests':'2', 'era5_retries':'1', 'era5_backoff':'0'}
+        StubClient.calls, StubClient.short=[], set()
+
+    def tearDown(self):
+        shutil.rmtree(self.era_src, ignore_errors=True)
+
+    def get_progress(self):
+        with open(os.path.join(self.era_src, 'fetch_progress.json')) as f:
+            return json.load(f)
+
+    def test_skip_present(self):
+        write_month(os.path.join(self.era_src, '201002-surf.nc'), '201002', 'surf')
+        failed=lib.era5_fetcher.ERA5Retriever(
+                self.cfg, groups=['surf'], client_factory=StubClient).run()
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(StubClient.calls), ['201001-surf', '201003-surf'])
+        self.assertEqual(self.get_progress()['201002-surf']['status'], 'done')
+
+    def test_verification_failure(self):
+        StubClient.short={'201001-h500'}
+        failed=lib.era5_fetcher.ERA5Retriever(
+                self.cfg, groups=['h500'], client_factory=StubClient).run()
+        self.assertEqual(failed, [])
+        self.assertEqual(StubClient.calls.count('201001-h500'), 2)
+        rec=self.get_progress()['201001-h500']
+        self.assertEqual((rec['status'], rec['attempts'], rec['error']), ('done', 2, None))
+        self.assertFalse(os.path.exists(os.path.join(self.era_src, '201001-h500.nc.part')))
+
+    def test_resume_from_progress(self):
+        self.cfg['TRAINING']['era5_retries']='0'
+        StubClient.short={'201003-surf'}
+        failed=lib.era5_fetcher.ERA5Retriever(
+                self.cfg, groups=['surf'], client_factory=StubClient).run()
+        self.assertEqual(failed, [('201003', 'surf')])
+        self.assertEqual(self.get_progress()['201003-surf']['status'], 'failed')
+
+        # done records of the same size are trusted without a request
+        StubClient.calls=[]
+        failed=lib.era5_fetcher.ERA5Retriever(
+                self.cfg, groups=['surf'], client_factory=StubClient).run()
+        self.assertEqual(failed, [])
+        self.assertEqual(StubClient.calls, ['201003-surf'])
+
+    def test_groups_share_progress(self):
+        # getERA5-sl.py and getERA5-pl.py running at once
+        threads=[threading.Thread(target=lib.era5_fetcher.ERA5Retriever(
+                self.cfg, groups=[group], client_factory=StubClient).run)
+                for group in ('surf', 'h500')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        progress=self.get_progress()
+        self.assertEqual(len(progress), 6)
+        self.assertTrue(all(rec['status']=='done' for rec in progress.values()))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#/usr/bin/env python
+"""
+Tests of lib.gfs_fetcher against a local http.server stand-in of the
+NOMADS grib filter, the converter copies the served netCDF bytes
+"""
+
+import os, sys, glob, shutil, tempfile, threading, unittest, configparser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import netCDF4 as nc4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.gfs_fetcher
+
+# converter stand-in, same arguments as ncl_convert2nc: grib_fn -o out_dir
+CONVERTER='''
+import os, sys, shutil
+src, out=sys.argv[1], sys.argv[3]
+nc_fn=os.path.join(out, os.path.basename(src)[:-6]+'.nc')
+shutil.copy(src, nc_fn)
+if os.environ.get('FAKE_CONVERT_FAIL'):
+    # partial output, then a crash
+    with open(nc_fn, 'r+b') as f:
+        f.truncate(os.path.getsize(nc_fn)//2)
+    sys.exit(1)
+'''
+
+def make_nc(fn, lead):
+    ''' small netCDF file standing in for one converted lead time '''
+    with nc4.Dataset(fn, 'w') as nc:
+        nc.createDimension('lat_0', 4)
+        nc.createDimension('lon_0', 5)
+        var=nc.createVariable('PRMSL_P0_L101_GLL0', 'f4', ('lat_0', 'lon_0'))
+        var[:]=np.full((4, 5), lead, dtype=np.float32)
+
+class _Handler(BaseHTTPRequestHandler):
+    ''' grib filter stand-in, the first response of f003 is cut halfway '''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name=parse_qs(urlparse(self.path).query)['file'][0]
+        body=self.server.blobs[name]
+        rng=self.headers.get('Range')
+        self.server.requests.append((name, rng))
+        if rng:
+            offset=int(rng.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Length', str(len(body)-offset))
+            self.end_headers()
+            self.wfile.write(body[offset:])
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if name.endswith('f003') and name not in self.server.dropped:
+            self.server.dropped.add(name)
+            self.wfile.write(body[:len(body)//2])
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+class TestGFSFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+        self.gfs_src=os.path.join(self.tmp, 'gfs')
+
+        self.srv=ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.srv.requests, self.srv.dropped, self.srv.blobs=[], set(), {}
+        for lead in (0, 3, 6):
+            fn=os.path.join(self.tmp, 'src_%03d.nc' % lead)
+            make_nc(fn, lead)
+            with open(fn, 'rb') as f:
+                self.srv.blobs['gfs.t00z.pgrb2.0p25.f%03d' % lead]=f.read()
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+
+        conv_fn=os.path.join(self.tmp, 'fakeconv.py')
+        with open(conv_fn, 'w') as f:
+            f.write(CONVERTER)
+
+        self.cfg=configparser.ConfigParser()
+        self.cfg['SHARE']={'s_sn':'10', 'e_sn':'60', 's_we':'60', 'e_we':'170'}
+        self.cfg['INFERENCE']={
+            'gfs_src':self.gfs_src,
+            'gfs_url':'http://127.0.0.1:%d/cgi-bin/filter_gfs_0p25.pl' % self.srv.server_address[1],
+            'gfs_init':'00', 'gfs_days':'0', 'gfs_frq':'3', 'realtime_offsetday':'0',
+            'gfs_retries':'2', 'gfs_backoff':'0.01', 'gfs_timeout':'10',
+            'gfs_converter':'%s %s' % (sys.executable, conv_fn)}
+
+    def tearDown(self):
+        os.environ.pop('FAKE_CONVERT_FAIL', None)
+        self.srv.shutdown()
+        self.srv.server_close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def get_fetcher(self):
+        ''' fetcher of three lead times, f000 to f006 '''
+        fetcher=lib.gfs_fetcher.GFSFetcher(self.cfg)
+        fetcher.leads=[0, 3, 6]
+        return fetcher
+
+    def test_fetch_resume_convert(self):
+        fetcher=self.get_fetcher()
+        fn_list=fetcher.fetch_all()
+        self.assertEqual(fetcher.failed, [])
+        for lead, fn in zip(fetcher.leads, fn_list):
+            with nc4.Dataset(fn) as nc:
+                self.assertTrue((nc['PRMSL_P0_L101_GLL0'][:]==lead).all())
+        # the cut body of f003 is resumed from its partial file
+        ranges=[rng for name, rng in self.srv.requests if name.endswith('f003')]
+        self.assertEqual(ranges[0], None)
+        self.assertTrue(ranges[1].startswith('bytes='))
+        self.assertEqual(glob.glob(os.path.join(self.gfs_src, '.convert_*')), [])
+
+    def test_rerun_checks_leftover(self):
+        fetcher=self.get_fetcher()
+        fn_list=fetcher.fetch_all()
+        # a truncated netCDF file and a stale conversion of a killed run
+        with open(fn_list[1], 'r+b') as f:
+            f.truncate(os.path.getsize(fn_list[1])//2)
+        os.remove(fetcher.get_fn(3, '.grib2'))
+        os.makedirs(os.path.join(self.gfs_src, '.convert_stale'))
+
+        self.srv.requests.clear()
+        fetcher=self.get_fetcher()
+        fn_list=fetcher.fetch_all()
+        self.assertEqual([name for name, rng in self.srv.requests], ['gfs.t00z.pgrb2.0p25.f003'])
+        with nc4.Dataset(fn_list[1]) as nc:
+            self.assertTrue((nc['PRMSL_P0_L101_GLL0'][:]==3).all())
+        self.assertEqual(glob.glob(os.path.join(self.gfs_src, '.convert_*')), [])
+
+    def test_failed_conversion_leaves_no_output(self):
+        os.environ['FAKE_CONVERT_FAIL']='1'
+        fetcher=self.get_fetcher()
+        fn_list=fetcher.fetch_all()
+        self.assertEqual(sorted(fetcher.failed), [0, 3, 6])
+        self.assertEqual(fn_list, [None]*3)
+        self.assertEqual(glob.glob(os.path.join(self.gfs_src, '*.nc')), [])
+        self.assertEqual(glob.glob(os.path.join(self.gfs_src, '.convert_*')), [])
+        # grib2 files stay for the next run
+        self.assertEqual(len(glob.glob(os.path.join(self.gfs_src, '*.grib2'))), 3)
+
+if __name__=='__main__':
+    unittest.main()
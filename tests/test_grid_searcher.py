@@ -0,0 +1,31 @@
+#/usr/bin/env python
+"""
+Tests of lib.grid_searcher selection of the best combination
+"""
+
+import os, sys, unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.grid_searcher
+
+def get_edic(score, nodexy, iterations):
+    nodex, nodey=[int(n) for n in nodexy.split('x')]
+    return {'silhouette_score':score, 'best_sigma':1.0+score, 'best_lrate':0.5,
+        'best_1dnodex':nodex, 'best_1dnodey':nodey, 'best_nb_func':'gaussian',
+        'best_iterations':iterations}
+
+class TestSetBest(unittest.TestCase):
+
+    def test_non_square_map(self):
+        prism=SimpleNamespace(sigma=None, lrate=None, n_nodex=1, n_nodey=1,
+                nb_func=None, iterations=None)
+        searcher=lib.grid_searcher.GridSearcher.__new__(lib.grid_searcher.GridSearcher)
+        searcher._set_best(prism, [get_edic(0.2, '1x8', 1000),
+            get_edic(0.6, '12x20', 5000), get_edic(0.4, '3x3', 2000)])
+        self.assertEqual((prism.n_nodex, prism.n_nodey), (12, 20))
+        self.assertEqual((prism.sigma, prism.iterations), (1.6, 5000))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#/usr/bin/env python
+"""
+Tests of lib.gs_broker with several workers on one host, run_comb is
+replaced by a stub that raises, kills or stalls its worker on demand
+"""
+
+import os, sys, time, signal, socket, shutil, tempfile, unittest
+import numpy as np
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.gs_broker
+import lib.grid_searcher
+
+AUTHKEY=b'test-broker'
+POLL, TIMEOUT=0.2, 2
+
+def stub_comb(prism, cfg, itms, train_data):
+    '''
+    run_comb stand-in: 'bad' raises, 'kill' exits its worker and 'stall'
+    stops it on the first attempt (marker file in prism['tmp'])
+    '''
+    marker=os.path.join(prism['tmp'], str(itms))
+    first=not os.path.exists(marker)
+    if first:
+        open(marker, 'w').close()
+    if itms=='bad':
+        raise ValueError('bad combination')
+    if itms=='kill' and first:
+        os._exit(1)
+    if itms=='stall' and first:
+        # alive but silent, heartbeat thread included
+        os.kill(os.getpid(), signal.SIGSTOP)
+    return {'comb':itms, 'pid':os.getpid(), 'nrec':int(train_data.shape[0])}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def remote_worker(address):
+    ''' worker started outside the broker, waits for it to listen '''
+    for ii in range(100):
+        try:
+            lib.gs_broker.run_worker(address, AUTHKEY, poll=POLL)
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+
+class TestGSBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+        self.address=('127.0.0.1', free_port())
+        self.prism={'tmp':self.tmp}
+        self.cache_fn=os.path.join(self.tmp, 'gs_cache.npy')
+        self.run_comb=lib.grid_searcher.run_comb
+        # workers are forked and inherit the stub
+        lib.grid_searcher.run_comb=stub_comb
+
+    def tearDown(self):
+        lib.grid_searcher.run_comb=self.run_comb
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def serve(self, comb, nlocal):
+        return lib.gs_broker.serve(self.prism, {}, comb, np.zeros((7, 3)),
+                self.address, AUTHKEY, self.cache_fn, nlocal=nlocal,
+                poll=POLL, timeout=TIMEOUT, retries=1)
+
+    def test_local_workers(self):
+        comb=['c%d' % ii for ii in range(6)]+['bad', 'kill']
+        edic_list=self.serve(comb, nlocal=3)
+        # every good combination once, in order, the raising one dropped
+        self.assertEqual([edic['comb'] for edic in edic_list],
+                [itms for itms in comb if itms!='bad'])
+        self.assertTrue(all(edic['nrec']==7 for edic in edic_list))
+
+    def test_stalled_worker(self):
+        workers=[Process(target=remote_worker, args=(self.address,)) for ii in range(2)]
+        for worker in workers:
+            worker.start()
+        try:
+            comb=['stall', 'c0', 'c1', 'c2']
+            edic_list=self.serve(comb, nlocal=0)
+            self.assertEqual([edic['comb'] for edic in edic_list], comb)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+
+    def test_default_authkey_refused(self):
+        import configparser
+        cfg=configparser.ConfigParser()
+        cfg['GRID_SEARCH']={'gs_authkey':lib.gs_broker.DEFAULT_AUTHKEY}
+        with self.assertRaises(SystemExit):
+            lib.gs_broker.get_authkey(cfg)
+        cfg['GRID_SEARCH']['gs_authkey']='secret'
+        self.assertEqual(lib.gs_broker.get_authkey(cfg), b'secret')
+
+if __name__=='__main__':
+    unittest.main()
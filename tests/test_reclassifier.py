@@ -0,0 +1,144 @@
+#/usr/bin/env python
+"""
+Tests of lib.reclassifier, ERAMesh is replaced by a stub that builds
+6-hourly records from their time, the model and statistics are written
+to a temporary db
+"""
+
+import os, sys, json, pickle, shutil, tempfile, unittest, configparser
+import numpy as np
+import pandas as pd
+import xarray as xr
+from minisom import MiniSom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.preprocess_erainp
+import lib.reclassifier
+
+NGRIDS=4
+
+class StubMesh:
+    ''' ERAMesh stand-in: every 6 hours of the training range, fail_at raises '''
+    fail_at=None
+
+    def __init__(self, cfg):
+        start=pd.Timestamp(cfg['TRAINING']['training_start'])
+        if StubMesh.fail_at is not None and start >= StubMesh.fail_at:
+            raise RuntimeError('interrupted')
+        end=pd.Timestamp(cfg['TRAINING']['training_end'])+pd.Timedelta(hours=18)
+        self.dateseries=pd.date_range(start, end, freq='6H')
+        hrs=(self.dateseries-pd.Timestamp('2000-01-01')).total_seconds().values/3600.0
+        self.data=np.stack([np.sin(hrs*(ii+1)/97.0) for ii in range(NGRIDS)], axis=1)
+
+class TestReclassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'db'))
+        era5_src=os.path.join(self.tmp, 'era5')
+        os.makedirs(era5_src)
+        # Feb 2020 misses its h500 file
+        for month in pd.date_range('2020-01-01', '2020-06-01', freq='MS').strftime('%Y%m'):
+            open(os.path.join(era5_src, month+'-surf.nc'), 'w').close()
+            if month!='202002':
+                open(os.path.join(era5_src, month+'-h500.nc'), 'w').close()
+
+        som=MiniSom(2, 3, NGRIDS, random_seed=0)
+        som._weights=np.random.default_rng(0).normal(size=(2, 3, NGRIDS))
+        with open(os.path.join(self.tmp, 'db', 'som_era5.archive'), 'wb') as f:
+            pickle.dump(som, f)
+        db_out=xr.Dataset({
+            'mean':(['ngrids'], np.full(NGRIDS, 0.1)),
+            'std':(['ngrids'], np.full(NGRIDS, 0.5)),
+            'type_id':(['n_nodex', 'n_nodey'], np.arange(6).reshape(2, 3))})
+        db_out.attrs['preprocess_method']='temporal_norm'
+        db_out.to_netcdf(os.path.join(self.tmp, 'db', 'som_cluster_era5.nc'))
+
+        self.cfg=configparser.ConfigParser()
+        self.cfg.read_dict({
+            'SHARE':{'use_catalog':'False', 'kernel_backend':'numpy'},
+            'TRAINING':{'era5_src':era5_src},
+            'RECLASSIFY':{'reclass_start':'202001', 'reclass_end':'202006',
+                'reclass_chunk':'2', 'reclass_out':'./out/reclass.csv'}})
+        self.out_fn=os.path.join(self.tmp, 'out', 'reclass.csv')
+        self.state_fn=os.path.join(self.tmp, 'out', 'reclass_state.json')
+
+        self.saved=lib.reclassifier.CWD, lib.preprocess_erainp.ERAMesh
+        lib.reclassifier.CWD=self.tmp
+        lib.preprocess_erainp.ERAMesh=StubMesh
+        StubMesh.fail_at=None
+
+    def tearDown(self):
+        lib.reclassifier.CWD, lib.preprocess_erainp.ERAMesh=self.saved
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def read_out(self):
+        with open(self.out_fn) as f:
+            return f.read()
+
+    def test_full_run(self):
+        lib.reclassifier.reclassify(self.cfg)
+        df=pd.read_csv(self.out_fn, index_col='time', parse_dates=['time'])
+        months=sorted(set(df.index.strftime('%Y%m')))
+        self.assertEqual(months, ['202001', '202003', '202004', '202005', '202006'])
+        self.assertFalse(df.index.duplicated().any())
+
+        # type ids against a direct bmu search of the stub records
+        with open(os.path.join(self.tmp, 'db', 'som_era5.archive'), 'rb') as f:
+            som=pickle.load(f)
+        data=np.concatenate([StubMesh(self.chunk_cfg(m)).data for m in months])
+        ref=[som.winner(x) for x in (data-0.1)/0.5]
+        np.testing.assert_array_equal(df['type_id'].values, [ix*3+iy for ix, iy in ref])
+        self.assertEqual(list(df['type2d_cor']), ['(%d,%d)' % c for c in ref])
+
+        with open(self.state_fn) as f:
+            state=json.load(f)
+        self.assertEqual((state['done_month'], state['nrec']), ('202006', len(df)))
+
+    def chunk_cfg(self, month):
+        start=pd.Timestamp(month+'01')
+        return {'TRAINING':{'training_start':start.strftime('%Y%m%d'),
+            'training_end':(start+pd.offsets.MonthEnd(0)).strftime('%Y%m%d')}}
+
+    def test_resume_truncates(self):
+        lib.reclassifier.reclassify(self.cfg)
+        ref=self.read_out()
+        shutil.rmtree(os.path.join(self.tmp, 'out'))
+
+        # chunks [Jan], [Mar, Apr], [May, Jun], interrupted in the last one
+        StubMesh.fail_at=pd.Timestamp('2020-05-01')
+        with self.assertRaises(RuntimeError):
+            lib.reclassifier.reclassify(self.cfg)
+        with open(self.state_fn) as f:
+            self.assertEqual(json.load(f)['done_month'], '202004')
+        # rows of a half-written chunk
+        with open(self.out_fn, 'a') as f:
+            f.write('2020-05-01 00:00:00,"(0,0)",0,0.1\n2020-05-01 06:')
+
+        StubMesh.fail_at=None
+        lib.reclassifier.reclassify(self.cfg)
+        self.assertEqual(self.read_out(), ref)
+
+    def test_model_change_starts_over(self):
+        StubMesh.fail_at=pd.Timestamp('2020-03-01')
+        with self.assertRaises(RuntimeError):
+            lib.reclassifier.reclassify(self.cfg)
+        archive_fn=os.path.join(self.tmp, 'db', 'som_era5.archive')
+        mtime=os.path.getmtime(archive_fn)+10
+        os.utime(archive_fn, (mtime, mtime))
+
+        StubMesh.fail_at=None
+        lib.reclassifier.reclassify(self.cfg)
+        df=pd.read_csv(self.out_fn, index_col='time', parse_dates=['time'])
+        self.assertEqual(df.index[0], pd.Timestamp('2020-01-01'))
+        self.assertFalse(df.index.duplicated().any())
+
+    def test_split_chunks(self):
+        months=pd.DatetimeIndex(['2020-01-01', '2020-02-01', '2020-03-01',
+            '2020-05-01', '2020-06-01'])
+        chunks=lib.reclassifier.split_chunks(months, 2)
+        self.assertEqual([[ts.month for ts in c] for c in chunks], [[1, 2], [3], [5, 6]])
+
+if __name__=='__main__':
+    unittest.main()
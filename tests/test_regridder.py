@@ -0,0 +1,80 @@
+#/usr/bin/env python
+"""
+Tests of lib.regridder weights against analytic fields
+"""
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.regridder
+
+def linear(lat, lon):
+    ''' field linear in lat and lon, reproduced exactly by bilinear '''
+    return 3.0*lat-0.5*lon+7.0
+
+class TestRegridder(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir=tempfile.mkdtemp()
+        # GFS order, lat north-south
+        self.src=(np.arange(60, 9.9, -0.5), np.arange(60, 170.1, 0.5))
+        self.src_lat, self.src_lon=np.meshgrid(*self.src, indexing='ij')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def regrid(self, field, tgt, method):
+        rgd=lib.regridder.get_regridder(self.src, tgt, method, self.cache_dir)
+        return rgd.apply(field.ravel()[np.newaxis])[0].reshape(rgd.tgt_shape)
+
+    def test_bilinear_linear_field(self):
+        field=linear(self.src_lat, self.src_lon)
+        tgt=(np.linspace(15.3, 55.1, 17), np.linspace(70.2, 160.7, 23))
+        out=self.regrid(field, tgt, 'bilinear')
+        tlat, tlon=np.meshgrid(*tgt, indexing='ij')
+        np.testing.assert_allclose(out, linear(tlat, tlon), rtol=0, atol=1e-9)
+
+    def test_bilinear_curvilinear_target(self):
+        field=linear(self.src_lat, self.src_lon)
+        ii, jj=np.meshgrid(np.arange(12), np.arange(15), indexing='ij')
+        xlat, xlong=20.0+2.1*ii+0.3*jj, 80.0+3.3*jj-0.2*ii
+        out=self.regrid(field, (xlat, xlong), 'bilinear')
+        np.testing.assert_allclose(out, linear(xlat, xlong), rtol=0, atol=1e-9)
+
+    def test_bilinear_at_source_points(self):
+        field=np.random.default_rng(0).random(self.src_lat.shape)
+        out=self.regrid(field, self.src, 'bilinear')
+        np.testing.assert_allclose(out, field, rtol=0, atol=1e-12)
+
+    def test_conservative_constant_field(self):
+        field=np.full(self.src_lat.shape, 5.0)
+        tgt=(np.arange(55, 14, -2.0), np.arange(65, 165.1, 2.5))
+        out=self.regrid(field, tgt, 'conservative')
+        np.testing.assert_allclose(out, 5.0, rtol=1e-12)
+
+    def test_conservative_area_mean(self):
+        # each target cell covers 2x2 source cells exactly
+        self.src=(np.arange(60, 10.1, -0.5), np.arange(60, 169.6, 0.5))
+        field=np.random.default_rng(1).random((len(self.src[0]), len(self.src[1])))
+        tgt=tuple(axis.reshape(-1, 2).mean(axis=1) for axis in self.src)
+        out=self.regrid(field, tgt, 'conservative')
+
+        # source cell area on the sphere, per lat row
+        edges=np.deg2rad(np.arange(60.25, 10.0, -0.5))
+        area=np.abs(np.diff(np.sin(edges))).reshape(-1, 2, 1, 1)
+        sub=field.reshape(len(tgt[0]), 2, len(tgt[1]), 2)
+        ref=(sub*area).sum(axis=(1, 3))/(2*area.sum(axis=1).reshape(-1, 1))
+        np.testing.assert_allclose(out, ref, rtol=1e-10)
+
+    def test_weights_cached(self):
+        tgt=(np.linspace(15, 55, 9), np.linspace(70, 160, 11))
+        lib.regridder.get_regridder(self.src, tgt, 'bilinear', self.cache_dir)
+        cache=os.listdir(self.cache_dir)
+        self.assertEqual(len(cache), 1)
+        rgd=lib.regridder.get_regridder(self.src, tgt, 'bilinear', self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), cache)
+        self.assertEqual(rgd.weights.shape, (9*11, self.src_lat.size))
+
+if __name__=='__main__':
+    unittest.main()
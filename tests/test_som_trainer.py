@@ -0,0 +1,150 @@
+#/usr/bin/env python
+"""
+Tests of lib.som_trainer and lib.som_kernels on random data, against
+MiniSom and against each other
+"""
+
+import os, sys, unittest
+import numpy as np
+from minisom import MiniSom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib
+import lib.som_kernels
+import lib.som_trainer
+
+def get_som(nx=6, ny=9, ngrids=5, sigma=2.0, seed=0):
+    ''' gaussian map with random weights '''
+    som=MiniSom(nx, ny, ngrids, sigma=sigma, learning_rate=0.5, random_seed=seed)
+    som._weights=np.random.default_rng(seed).random((nx, ny, ngrids))
+    return som
+
+def copy_som(som):
+    twin=get_som(*som._weights.shape, sigma=som._sigma)
+    twin._weights=som._weights.copy()
+    return twin
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.data=np.random.default_rng(1).random((300, 5))
+        self.order=np.random.default_rng(2).permutation(300)
+
+    def test_bmu_numpy(self):
+        som=get_som()
+        idx, dis=lib.som_kernels.bmu(som, self.data, 'numpy', chunk=64)
+        ny=som._weights.shape[1]
+        ref=[som.winner(x) for x in self.data]
+        np.testing.assert_array_equal(idx, [ix*ny+iy for ix, iy in ref])
+        np.testing.assert_allclose(dis, [np.linalg.norm(x-som._weights[c])
+            for x, c in zip(self.data, ref)])
+
+    @unittest.skipUnless(lib.som_kernels.HAS_NUMBA, 'numba not installed')
+    def test_bmu_numba(self):
+        som=get_som()
+        idx, dis=lib.som_kernels.bmu(som, self.data, 'numba')
+        ref_idx, ref_dis=lib.som_kernels.bmu(som, self.data, 'numpy')
+        np.testing.assert_array_equal(idx, ref_idx)
+        np.testing.assert_allclose(dis, ref_dis, rtol=1e-12)
+
+    def test_segment_numpy_vs_minisom(self):
+        for nb_cutoff in (0, 1.5):
+            som, ref=get_som(), get_som()
+            lib.som_kernels.train_segment(som, self.data, self.order, 100, 400, 1000,
+                    nb_cutoff=nb_cutoff, backend='numpy')
+            lib.som_trainer._train_steps(ref, self.data, self.order, 100, 400, 1000,
+                    nb_cutoff, 'minisom')
+            np.testing.assert_allclose(som._weights, ref._weights, rtol=0, atol=1e-12)
+
+    @unittest.skipUnless(lib.som_kernels.HAS_NUMBA, 'numba not installed')
+    def test_segment_numba_vs_numpy(self):
+        for nb_cutoff in (0, 1.5):
+            som, ref=get_som(), get_som()
+            lib.som_kernels.train_segment(som, self.data, self.order, 100, 400, 1000,
+                    nb_cutoff=nb_cutoff, backend='numba')
+            lib.som_kernels.train_segment(ref, self.data, self.order, 100, 400, 1000,
+                    nb_cutoff=nb_cutoff, backend='numpy')
+            np.testing.assert_allclose(som._weights, ref._weights, rtol=0, atol=1e-10)
+
+class TestTruncated(unittest.TestCase):
+
+    def test_nb_window(self):
+        som=get_som()
+        for c in [(0, 0), (3, 4), (5, 8), (2, 0)]:
+            for sigma, radius in [(2.0, 3.0), (1.2, 2.5), (0.8, 1.0)]:
+                sx, sy, g=lib.som_trainer.nb_window(som, c, sigma, radius)
+                full=som.neighborhood(c, sigma)
+                gx, gy=np.meshgrid(np.arange(6), np.arange(9), indexing='ij')
+                inside=(gx-c[0])**2+(gy-c[1])**2 <= radius*radius
+                trunc=np.zeros_like(full)
+                trunc[sx, sy]=g
+                np.testing.assert_allclose(trunc[inside], full[inside], rtol=1e-12)
+                self.assertTrue((trunc[~inside]==0).all())
+
+    def test_update_truncated(self):
+        som=get_som()
+        ref=copy_som(som)
+        x=np.random.default_rng(3).random(5)
+        win, t, max_iteration, nb_cutoff=(2, 3), 10, 100, 1.5
+        lib.som_trainer.update_truncated(som, x, win, t, max_iteration, nb_cutoff)
+        ref.update(x, win, t, max_iteration)
+
+        sig=lib.som_trainer._asymptotic_decay(som._sigma, t, max_iteration)
+        gx, gy=np.meshgrid(np.arange(6), np.arange(9), indexing='ij')
+        inside=(gx-win[0])**2+(gy-win[1])**2 <= (nb_cutoff*sig)**2
+        np.testing.assert_allclose(som._weights[inside], ref._weights[inside], rtol=1e-12)
+        np.testing.assert_array_equal(som._weights[~inside], get_som()._weights[~inside])
+
+class TestTraining(unittest.TestCase):
+
+    def setUp(self):
+        self.data=np.random.default_rng(4).random((400, 5))
+
+    def test_batch_workers(self):
+        som1, som2=get_som(), get_som()
+        n1, hist1=lib.som_trainer.train_batch(som1, self.data, 5, nworkers=1)
+        n2, hist2=lib.som_trainer.train_batch(som2, self.data, 5, nworkers=3)
+        self.assertEqual((n1, n2), (5, 5))
+        np.testing.assert_allclose(som1._weights, som2._weights, rtol=0, atol=1e-10)
+        np.testing.assert_allclose([h[1] for h in hist1], [h[1] for h in hist2], rtol=1e-10)
+
+    def test_batch_cutoff_covers_map(self):
+        # a cutoff beyond the map diagonal is the full neighbourhood
+        som1, som2=get_som(), get_som()
+        lib.som_trainer.train_batch(som1, self.data, 4, nworkers=2)
+        lib.som_trainer.train_batch(som2, self.data, 4, nworkers=2, nb_cutoff=20.0)
+        np.testing.assert_allclose(som1._weights, som2._weights, rtol=0, atol=1e-10)
+
+    def test_anneal_window(self):
+        for it, iterations, nanneal in [(2000, 10000, 1000), (500, 3000, 250), (9000, 10000, 1000)]:
+            t0, t1=lib.som_trainer.anneal_window(it, iterations, nanneal)
+            self.assertEqual(t1-t0, nanneal)
+            # decay continuous at the switch, final value at the end
+            self.assertAlmostEqual(t0/t1, it/iterations, delta=1.0/t1)
+
+    def test_early_stop(self):
+        som=get_som()
+        # any drop below 100% counts as a stall, the first segment sets the best
+        used, history=lib.som_trainer.train_online(som, self.data, 5000,
+                segment=500, tol=1.0, patience=2, backend='numpy')
+        self.assertEqual(used, 2000)
+        self.assertEqual([h[0] for h in history], [500, 1000, 1500, 2000])
+        self.assertLess(history[-1][1], history[-2][1])
+
+        full=get_som()
+        used_full, history_full=lib.som_trainer.train_online(full, self.data, 5000,
+                segment=500, backend='numpy')
+        self.assertEqual(used_full, 5000)
+        self.assertEqual(len(history_full), 10)
+        # the annealed map ends close to the one trained on the full budget
+        self.assertLess(history[-1][1], 1.1*history_full[-1][1])
+
+    def test_no_early_stop(self):
+        som=get_som()
+        used, history=lib.som_trainer.train_online(som, self.data, 1200,
+                segment=500, tol=1e-9, patience=2, backend='numpy')
+        self.assertEqual(used, 1200)
+        self.assertEqual([h[0] for h in history], [500, 1000, 1200])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#/usr/bin/env python
+"""
+Tests of lib.source_catalog on small wrf, era5 and gfs trees of empty files
+"""
+
+import os, sys, shutil, tempfile, unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.source_catalog
+
+def touch(*parts):
+    fn=os.path.join(*parts)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    open(fn, 'w').close()
+    return fn
+
+class TestSourceCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_wrf_latest_run(self):
+        root=os.path.join(self.tmp, 'wrf')
+        # two overlapping runs, 2020-01-02 12Z is in both
+        for run, hours in [('2020010112', range(12, 37, 12)), ('2020010212', range(0, 25, 12))]:
+            init=pd.Timestamp(run[:8]+' '+run[8:]+':00')
+            for h in hours:
+                ts=init+pd.Timedelta(hours=h)
+                touch(root, run[:4], run[:6], run, ts.strftime('wrfout_d01_%Y-%m-%d_%H:%M:%S'))
+        touch(root, '2020', 'README')
+
+        catalog_fn=os.path.join(self.tmp, 'src_catalog_wrf.csv')
+        df=lib.source_catalog.build_catalog('wrf', root, catalog_fn, nworkers=2)
+        self.assertEqual(list(df['valid_time']), list(pd.date_range(
+            '2020-01-02', '2020-01-03 12:00', freq='12H')))
+        self.assertEqual(df.set_index('valid_time').loc['2020-01-02 12:00', 'init_time'],
+                pd.Timestamp('2020-01-02 12:00'))
+
+        dateseries=pd.date_range('2020-01-01 12:00', '2020-01-04', freq='12H')
+        found, paths=lib.source_catalog.lookup(df, dateseries, hint=False)
+        self.assertEqual(list(found), list(df['valid_time']))
+        self.assertTrue(all(os.path.basename(fn)==ts.strftime('wrfout_d01_%Y-%m-%d_%H:%M:%S')
+            for ts, fn in zip(found, paths)))
+        self.assertIn('2020010212', paths[1])
+
+    def test_lookup_duplicates(self):
+        # a catalog with repeated valid times, e.g. edited by hand
+        df=pd.DataFrame({
+            'valid_time':pd.to_datetime(['2020-01-01 06:00', '2020-01-01 00:00', '2020-01-01 06:00']),
+            'init_time':pd.to_datetime(['2020-01-01 06:00', '2020-01-01 00:00', '2020-01-01 00:00']),
+            'group':'', 'path':['b06', 'a00', 'a06']})
+        found, paths=lib.source_catalog.lookup(df,
+                pd.date_range('2020-01-01', periods=3, freq='6H'), hint=False)
+        self.assertEqual(list(found), list(pd.to_datetime(['2020-01-01 00:00', '2020-01-01 06:00'])))
+        self.assertEqual(paths, ['a00', 'b06'])
+
+    def test_era5_monthly(self):
+        root=os.path.join(self.tmp, 'era5')
+        for month in ('202001', '202002', '202003'):
+            touch(root, month[:4], month+'-surf.nc')
+        for month in ('202001', '202003'):
+            touch(root, month[:4], month+'-h500.nc')
+        df=lib.source_catalog.build_catalog('era5', root)
+        self.assertEqual(len(df), 5)
+
+        dateseries=pd.date_range('2020-01-01', '2020-03-31 18:00', freq='6H')
+        found, fn_dic=lib.source_catalog.lookup_monthly(df, dateseries, ['surf', 'h500'])
+        self.assertEqual(sorted(set(found.month)), [1, 3])
+        self.assertTrue(fn_dic[('202003', 'h500')].endswith('202003-h500.nc'))
+
+    def test_gfs_overlapping_cycles(self):
+        gfs_src=os.path.join(self.tmp, 'gfs')
+        for lead in (0, 3, 6, 9):
+            touch(gfs_src, 'gfs.t00z.pgrb2.0p25.f%03d.nc' % lead)
+        for lead in (0, 3, 6):
+            touch(gfs_src, 'gfs.t06z.pgrb2.0p25.f%03d.nc' % lead)
+        touch(gfs_src, 'gfs.t06z.pgrb2.0p25.f009.grib2')
+        touch(gfs_src, '.convert_1', 'gfs.t06z.pgrb2.0p25.f012.nc')
+
+        init_ts=pd.Timestamp('2020-01-01 06:00')
+        df=lib.source_catalog.scan_gfs(gfs_src, init_ts, 'nc')
+        self.assertEqual(list(df['valid_time']), list(pd.date_range(
+            '2020-01-01 00:00', '2020-01-01 12:00', freq='3H')))
+        names=[os.path.basename(fn) for fn in df['path']]
+        self.assertEqual(names, ['gfs.t00z.pgrb2.0p25.f000.nc', 'gfs.t00z.pgrb2.0p25.f003.nc',
+            'gfs.t06z.pgrb2.0p25.f000.nc', 'gfs.t06z.pgrb2.0p25.f003.nc',
+            'gfs.t06z.pgrb2.0p25.f006.nc'])
+
+        found, paths=lib.source_catalog.lookup(df,
+                pd.date_range(init_ts, periods=4, freq='3H'), hint=False)
+        self.assertEqual(list(found), list(pd.date_range(init_ts, periods=3, freq='3H')))
+        self.assertEqual(paths, list(df['path'])[2:])
+
+    def test_gfs_cycle_of_previous_day(self):
+        gfs_src=os.path.join(self.tmp, 'gfs')
+        touch(gfs_src, 'gfs.t18z.pgrb2.0p25.f006.grib2')
+        df=lib.source_catalog.scan_gfs(gfs_src, '2020-01-02 00:00', 'grib2')
+        self.assertEqual(df['init_time'].iloc[0], pd.Timestamp('2020-01-01 18:00'))
+        self.assertEqual(df['valid_time'].iloc[0], pd.Timestamp('2020-01-02 00:00'))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#/usr/bin/env python
+"""
+Tests of lib.type_analytics on a hand-built 6-hourly series across the
+SON/DJF boundary with one missing step
+"""
+
+import os, sys, unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.type_analytics as ta
+
+# 2020-12-01 06Z is missing
+TIMES=pd.date_range('2020-11-30 12:00', periods=8, freq='6H').delete(3)
+IDS=np.array([1, 1, 1, 1, 2, 2, 0])
+
+class TestTypeAnalytics(unittest.TestCase):
+
+    def test_step_and_positions(self):
+        step=ta.get_step(TIMES)
+        self.assertEqual(step, pd.Timedelta(hours=6))
+        np.testing.assert_array_equal(ta.get_positions(TIMES, step), [0, 1, 2, 4, 5, 6, 7])
+
+    def test_off_grid_raises(self):
+        times=TIMES.insert(4, pd.Timestamp('2020-12-01 09:00'))
+        with self.assertRaises(SystemExit):
+            ta.get_positions(times, pd.Timedelta(hours=6))
+        with self.assertRaises(SystemExit):
+            ta.run_lengths(times, np.append(IDS, 0), pd.Timedelta(hours=6))
+        with self.assertRaises(SystemExit):
+            ta.get_positions(TIMES.insert(1, TIMES[1]), pd.Timedelta(hours=6))
+
+    def test_run_lengths(self):
+        runs=ta.run_lengths(TIMES, IDS)
+        self.assertEqual(list(runs['start']), list(pd.to_datetime(['2020-11-30 12:00',
+            '2020-12-01 12:00', '2020-12-01 18:00', '2020-12-02 06:00'])))
+        self.assertEqual(list(runs['type_id']), [1, 1, 2, 0])
+        self.assertEqual(list(runs['length']), [3, 1, 2, 1])
+
+        pers=ta.persistence(TIMES, IDS, nnodes=4)
+        self.assertEqual(list(pers['nruns']), [1, 2, 1, 0])
+        np.testing.assert_array_equal(pers['mean_hrs'].values, [6.0, 12.0, 12.0, np.nan])
+        self.assertEqual(list(pers['max_hrs']), [6.0, 18.0, 12.0, 0.0])
+
+    def test_transitions(self):
+        trans=ta.transition_matrix(TIMES, IDS, nnodes=3)
+        ref=np.zeros((3, 3), dtype=np.int64)
+        ref[1, 1], ref[1, 2], ref[2, 2], ref[2, 0]=2, 1, 1, 1
+        np.testing.assert_array_equal(trans['count'].values, ref)
+        np.testing.assert_allclose(trans['prob'].values[1], [0, 2/3, 1/3])
+        self.assertTrue(np.isnan(trans['prob'].values[0]).all())
+
+        # grouped by the season of the from time
+        trans=ta.transition_matrix(TIMES, IDS, nnodes=3, by='season')
+        self.assertEqual(list(trans['season'].values), ta.SEASONS)
+        son=np.zeros((3, 3), dtype=np.int64)
+        son[1, 1]=2
+        np.testing.assert_array_equal(trans['count'].sel(season='SON').values, son)
+        np.testing.assert_array_equal(trans['count'].sel(season='DJF').values, ref-son)
+        self.assertEqual(int(trans['count'].sel(season=['MAM', 'JJA']).sum()), 0)
+
+    def test_frequency_by_season(self):
+        freq=ta.frequency(TIMES, IDS, nnodes=3, by='season')
+        np.testing.assert_array_equal(freq['count'].sel(season='DJF').values, [1, 2, 2])
+        np.testing.assert_array_equal(freq['count'].sel(season='SON').values, [0, 2, 0])
+        np.testing.assert_allclose(freq['freq'].sel(season='DJF').values, [0.2, 0.4, 0.4])
+        self.assertTrue(np.isnan(freq['freq'].sel(season='JJA').values).all())
+
+        total=ta.frequency(TIMES, IDS)
+        np.testing.assert_array_equal(total['count'].values, [1, 4, 2])
+
+    def test_cooccurrence(self):
+        cooc=ta.cooccurrence(TIMES, IDS, nnodes=3, lags=(1, 2))
+        ref=np.zeros((3, 3), dtype=np.int64)
+        ref[1, 1], ref[1, 2], ref[2, 0]=2, 1, 1
+        np.testing.assert_array_equal(cooc['count'].sel(lag=2).values, ref)
+        np.testing.assert_array_equal(cooc['count'].sel(lag=1).values,
+                ta.transition_matrix(TIMES, IDS, nnodes=3)['count'].values)
+        # P(type 2 two steps after type 1)/P(type 2)
+        self.assertAlmostEqual(float(cooc['lift'].sel(lag=2, type_a=1, type_b=2)), (1/3)/(2/7))
+
+if __name__=='__main__':
+    unittest.main()
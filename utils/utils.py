@@ -9,13 +9,23 @@
     throw_error(source, msg):
         Throw error with call source and error message
 
+    update_std_dim0(data, mean0, std0, n0):
+        Standardize new records with statistics merged from n0 old records
+
+    create_shared_buffer(shape):
+        Create float64 array in shared memory for forked workers
+
 """
 import datetime
 import os, sys
+import ctypes
+from multiprocessing import sharedctypes
 import numpy as np
 import pandas as pd
 import logging
 
+import lib
+
 DEG2RAD=np.pi/180.0
 CWD=sys.path[0]
 
@@ -41,87 +51,81 @@ def write_log(msg, lvl=20):
     logging.log(lvl, msg)
 
 def down_gfs(cfg):
-    """ download gfs to archive dir """
-    lat_s=cfg['SHARE']['s_sn']
-    lat_n=cfg['SHARE']['e_sn']
-    lon_w=cfg['SHARE']['s_we']
-    lon_e=cfg['SHARE']['e_we']
-    gfs_src=cfg['INFERENCE']['gfs_src']
-    offset=int(cfg['INFERENCE']['realtime_offsetday'])
-    gfs_days=cfg['INFERENCE']['gfs_days']
-    gfs_init=cfg['INFERENCE']['gfs_init']
-    gfs_frq=cfg['INFERENCE']['gfs_frq']
-    
-    today=datetime.datetime.now()
-    today=today-datetime.timedelta(days=offset)
-    
-    os.system('sh ./gidgat/gfs_slicer.sh '+
-            gfs_src+' '+
-            today.strftime('%Y%m%d')+gfs_init+' '+
-            gfs_days+' '+
-            lon_w+' '+
-            lon_e+' '+
-            lat_n+' '+
-            lat_s+' '+
-            gfs_frq)
-
-    with open(gfs_src+'/init_time', 'w') as f:
-        f.write(today.strftime('%Y%m%d')+gfs_init)
+    """ download gfs to archive dir, lead times are fetched and converted concurrently """
+    fetcher=lib.gfs_fetcher.GFSFetcher(cfg)
+    fetcher.fetch_all()
+    if fetcher.failed:
+        write_log('gfs lead times not fetched: %s' % sorted(fetcher.failed), 30)
 
 def link_path(cfg):
-    """ link path wrfout to input dir """
-    dateseries=pd.date_range(start=cfg['TRAINING']['training_start'], end=cfg['TRAINING']['training_end'])
-    len_date=len(dateseries)
-    for idx, datestamp in enumerate(dateseries):
-        
-        if idx % 100 ==0:
-            write_log('''wrfout_d01 relink done by %d/%d, 
-            please be patient, may take several minutes for long-term data...''' % (idx, len_date))
-
-        yyyy=datestamp.strftime('%Y')
-        mm=datestamp.strftime('%m')
-        dd=datestamp.strftime('%d')
-        
-        datestamp_p1=datestamp+datetime.timedelta(days=1)
-        yyyy_p1=datestamp_p1.strftime('%Y')
-        mm_p1=datestamp_p1.strftime('%m')
-        dd_p1=datestamp_p1.strftime('%d')
-
-        src_wrfpath=cfg['OTHER']['src_wrf']+yyyy
-        src_wrfpath=src_wrfpath+'/'+yyyy+mm+'/'+yyyy+mm+dd+'12'
-        
-        try:
-            os.system('ln -sf '+src_wrfpath+'/wrfout_d01_'+yyyy+'-'+mm+'-'+dd+'* '+CWD+'/input/training/')
-            os.system('ln -sf '+src_wrfpath+'/wrfout_d01_'+yyyy_p1+'-'+mm_p1+'-'+dd_p1+'_0* '+CWD+'/input/training/')
-            os.system('ln -sf '+src_wrfpath+'/wrfout_d01_'+yyyy_p1+'-'+mm_p1+'-'+dd_p1+'_1[0-1]* '+CWD+'/input/training/')
-        except:
-            write_log('wrfout_d01_'+yyyy+'-'+mm+'-'+dd+'_12:00:00 not found',30)
+    """ link path wrfout to input dir, files are resolved by the source catalog """
+    # run of day D covers D_12 to D+1_11
+    dateseries=pd.date_range(
+            start=cfg['TRAINING']['training_start']+' 12:00',
+            end=pd.Timestamp(cfg['TRAINING']['training_end'])+datetime.timedelta(hours=35),
+            freq='H')
+    catalog=lib.source_catalog.load_catalog(cfg, 'wrf')
+    dateseries, fn_list=lib.source_catalog.lookup(catalog, dateseries, 'wrfout_d01 times')
+    lib.source_catalog.link_files(fn_list, CWD+'/input/training/')
+    write_log('%d wrfout_d01 files linked' % len(fn_list))
 
 def link_realtime(cfg):
     """ link realtime wrfout to input dir """
-    today=datetime.datetime.now()
-    offset_day=int(cfg['OTHER']['relink_realtime_offsetday'])
-    today=today-datetime.timedelta(days=offset_day)
-    while 1:
-        yyyy=today.strftime('%Y')
-        mm=today.strftime('%m')
-        dd=today.strftime('%d')
-        src_wrfpath=cfg['OTHER']['src_wrf']+yyyy
-        src_wrfpath=src_wrfpath+'/'+yyyy+mm+'/'+yyyy+mm+dd+'12'
-        # test if file exist
-        if os.path.exists(src_wrfpath):
-            os.system('rm -f  '+CWD+'/input/inference/*')
-            os.system('ln -sf '+src_wrfpath+'/wrfout_d01* '+CWD+'/input/inference/')
-            write_log(src_wrfpath+' has been successfully linked!')
-            break
-        else:
-            write_log(src_wrfpath+' not found, try 1 day before',30)
-            today=today-datetime.timedelta(days=1)
-
-def get_std_dim0(data):
-    """ standardize the series on the 0 dim """
+    src_wrfpath, run_df=lib.source_catalog.realtime_run(cfg)
+    lib.source_catalog.link_files(run_df['path'], CWD+'/input/inference/', clean=True)
+    write_log(src_wrfpath+' has been successfully linked!')
+
+def get_std_dim0(data, chunk=1024):
+    """ 
+        standardize the series on the 0 dim in place, 
+        std is accumulated by chunks to avoid a full-size temporary
+    """
+    nrec=data.shape[0]
     data_mean=data.mean(axis=0)
-    data_std=data.std(axis=0)
-    data=(data-data_mean)/data_std
+    data_var=np.zeros(data.shape[1:])
+    for ii in range(0, nrec, chunk):
+        data_var+=((data[ii:ii+chunk]-data_mean)**2).sum(axis=0)
+    data_std=np.sqrt(data_var/nrec)
+    for ii in range(0, nrec, chunk):
+        data[ii:ii+chunk]-=data_mean
+        data[ii:ii+chunk]/=data_std
     return data, data_mean, data_std
 
+def update_std_dim0(data, mean0, std0, n0, chunk=1024):
+    """ 
+        merge mean/std of n0 old records with the new series (pairwise 
+        variance update), standardize the new series on the 0 dim in place
+    """
+    nrec=data.shape[0]
+    data_mean=data.mean(axis=0)
+    data_var=np.zeros(data.shape[1:])
+    for ii in range(0, nrec, chunk):
+        data_var+=((data[ii:ii+chunk]-data_mean)**2).sum(axis=0)
+    
+    ntot=n0+nrec
+    delta=data_mean-mean0
+    mean=mean0+delta*nrec/ntot
+    std=np.sqrt((std0**2*n0+data_var+delta**2*n0*nrec/ntot)/ntot)
+    
+    for ii in range(0, nrec, chunk):
+        data[ii:ii+chunk]-=mean
+        data[ii:ii+chunk]/=std
+    return data, mean, std
+
+def create_shared_buffer(shape):
+    """ 
+        create float64 array in shared memory, 
+        return (raw ctypes array, ndarray view)
+        the raw array can be passed to pool initializers 
+    """
+    raw_buf=sharedctypes.RawArray(ctypes.c_double, int(np.prod(shape)))
+    return raw_buf, np.frombuffer(raw_buf, dtype=np.float64).reshape(shape)
+
+def get_shared_raw(np_array):
+    """ return the raw shared ctypes array behind np_array, None if not shared """
+    base=np_array
+    while isinstance(base, np.ndarray):
+        base=base.base
+    if isinstance(base, ctypes.Array):
+        return base
+    return None